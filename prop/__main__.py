@@ -1,48 +1,40 @@
 #!/usr/bin/env python
+import codecs
+import collections
+import contextlib
+import copy
 import glob
+import html
+import importlib
+import itertools
 import json
 import logging
 import math
 import mimetypes
 import os
-import platform
 import re
 import shutil
 import socket
-import subprocess
 import sys
 import tempfile
-from multiprocessing import Process
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from random import uniform
 from socket import gaierror
-from time import sleep
-from importlib.metadata import metadata
+from time import sleep, time
+from html.parser import HTMLParser
 from urllib.error import URLError
 from urllib.parse import unquote, urldefrag, urljoin, urlparse
 
-import requests
-from bs4 import BeautifulSoup as bs
-from fake_useragent import FakeUserAgentError, UserAgent
-from packaging.version import parse
-from requests.auth import HTTPBasicAuth
-from requests.packages import urllib3
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from robotsparsetools import NotFoundError, Parse
-from tqdm import tqdm
-
 try:
     import msvcrt
 except:
     import termios
 
 try:
-    metadata("prop-request")
-    _binary = False
-except:
-    _binary = True
-    _prop_directory = os.path.join(os.environ.get("HOME"), ".prop-datas")
-    if not os.path.isdir(_prop_directory):
-        os.mkdir(_prop_directory)
+    import resource
+except ImportError:
+    resource = None
 
 """
 下記コマンド実行必要
@@ -50,15 +42,125 @@ pip install requests numpy beautifulsoup4 requests[socks] fake-useragent tqdm
 (urllib3はrequests付属)
 """
 
-urllib3.disable_warnings(InsecureRequestWarning)
+class _lazy:
+    """
+    最初に使われたときにimportするモジュール(attrを渡すとその属性)
+    --versionや短いGETでも重いモジュールを全て読み込まないように、起動に要らないものはこれを通して使う
+    loaderを渡すと最初に使われたときにloader()の戻り値を作る(requestsなどのクラスを継承するクラスに使う)
+    """
+    def __init__(self, module: str=None, attr: str=None, loader=None):
+        self._module = module
+        self._attr = attr
+        self._loader = loader
+        self._target = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def deferred(cls, loader) -> '_lazy':
+        """
+        クラスを作る関数を、最初に使われたときに一度だけ呼ぶようにするデコレータ
+        """
+        return cls(loader=loader)
+
+    def _load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    if self._loader is not None:
+                        self._target = self._loader()
+                    else:
+                        target = importlib.import_module(self._module)
+                        self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __instancecheck__(self, instance) -> bool:
+        return isinstance(instance, self._load())
+
+    def __mro_entries__(self, bases) -> tuple:
+        return (self._load(),)
+
+def _import_requests():
+    import requests
+    requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+    return requests
+
+requests = _lazy(loader=_import_requests)
+urllib3 = _lazy('urllib3')
+urllib3_connection = _lazy('urllib3.connection')
+bs = _lazy('bs4', 'BeautifulSoup')
+UnicodeDammit = _lazy('bs4.dammit', 'UnicodeDammit')
+EncodingDetector = _lazy('bs4.dammit', 'EncodingDetector')
+tqdm = _lazy('tqdm', 'tqdm')
+fake_useragent = _lazy('fake_useragent')
+robotsparsetools = _lazy('robotsparsetools')
+parse = _lazy('packaging.version', 'parse')
+metadata = _lazy('importlib.metadata', 'metadata')
+parsedate_to_datetime = _lazy('email.utils', 'parsedate_to_datetime')
+http_server = _lazy('http.server')
+multiprocessing = _lazy('multiprocessing')
+Process = _lazy('multiprocessing', 'Process')
+ProcessPoolExecutor = _lazy('concurrent.futures', 'ProcessPoolExecutor')
+Queue = _lazy('multiprocessing', 'Queue')
+hashlib = _lazy('hashlib')
+platform = _lazy('platform')
+sqlite3 = _lazy('sqlite3')
+subprocess = _lazy('subprocess')
+tracemalloc = _lazy('tracemalloc')
+soupsieve = _lazy('soupsieve')
+lxml_html = _lazy('lxml.html')
+find_spec = _lazy('importlib.util', 'find_spec')
+
+_binary = None
+
+def _is_binary() -> bool:
+    """
+    pipで入れたものでなければ(バイナリファイルなら)True
+    importlib.metadataは遅いので、必要になったときに一度だけ調べる
+    """
+    global _binary
+    if _binary is None:
+        try:
+            metadata("prop-request")
+            _binary = False
+        except:
+            _binary = True
+    return _binary
 
-VERSION = parse("1.2.8")
+class _data_path:
+    """
+    ログや設定ファイル, キャッシュ, 履歴の置き場所を表すクラス属性
+    バイナリファイルなら~/.prop-datas配下、それ以外はこのファイルと同じディレクトリ
+    置き場所は使われたときに決め、ディレクトリは書き込むときに作る
+    """
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, instance, owner) -> str:
+        if _is_binary():
+            return os.path.join(os.environ.get("HOME"), ".prop-datas", self.name)
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), self.name)
+
+VERSION = "1.2.8"
+
+_xml_declaration = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+_attribute_pattern = re.compile(r"""(=[ \t\r\n]*)(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))""")
+
+_url_pattern = re.compile(r"https?://[\w!\?/\+\-_~=;\.,\*&@#\$%\(\)'\[\]]+")
 
 
 _open = open
 
 def open(*args, **kwargs):
-    if 'wb' not in args and 'rb' not in args:
+    if 'b' not in (args[1] if 1 < len(args) else kwargs.get('mode', 'r')):
         kwargs['encoding'] = 'utf-8'
     return _open(*args, **kwargs)
 
@@ -84,12 +186,28 @@ class LoggingHandler(logging.StreamHandler):
             self.handleError(record)
 
 class LoggingFileHandler(logging.Handler):
+    """
+    ファイルは最初に書き込むときに開く(ログを出さずに終わる場合はファイルもディレクトリも作らない)
+    """
     def __init__(self, file, mode="a", level=logging.NOTSET):
         super().__init__(level)
-        self.file = open(file, mode)
+        self.path = file
+        self.mode = mode
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
     def emit(self, record):
         try:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, self.mode)
             record.msg = re.sub('\033\\[[+-]?\\d+m', '', str(record.msg))
             record.levelname = re.sub('\033\\[[+-]?\\d+m', '', record.levelname)
             msg = self.format(record)
@@ -103,39 +221,42 @@ class setting:
     """
     オプション設定やファイルへのログを定義するクラス
     """
-    if _binary:
-        log_file = os.path.join(_prop_directory, 'log.log')
-        config_file = os.path.join(_prop_directory, 'config.json')
-    else:
-        log_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log.log')
-        config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+    log_file = _data_path('log.log')
+    config_file = _data_path('config.json')
+    # ログの出力先と設定ファイルの内容はプロセスで一度だけ用意して使い回す(-Rで行ごとに作り直さないため)
+    _fh = None
+    _config = None
 
     def __init__(self):
         # 設定できるオプションたち
         # 他からimportしてもこの辞書を弄ることで色々できる
-        self.options = {'download_name': '', 'limit': 0, 'only_body': False, 'debug': False, 'parse': False, 'types': 'get', 'payload': None, 'output': True, 'filename': None, 'timeout': (3.0, 60.0), 'redirect': True, 'upload': None, 'json': False, 'search': None, 'header': {'User-Agent': 'Prop/1.1.2'}, 'cookie': None, 'proxy': {"http": os.environ.get("http_proxy") or os.environ.get("HTTP_PROXY"), "https": os.environ.get("https_proxy") or os.environ.get("HTTPS_PROXY")}, 'auth': None, 'bytes': False, 'recursive': 0, 'body': True, 'content': True, 'conversion': True, 'reconnect': 5, 'caperror': True, 'noparent': False, 'no_downloaded': False, 'interval': 1, 'start': None, 'format': '%(file)s', 'info': False, 'multiprocess': False, 'ssl': True, 'parser': 'html.parser', 'no_dl_external': True, 'save_robots': True, 'check_only': False}
+        self.options = {'download_name': '', 'limit': 0, 'only_body': False, 'debug': False, 'parse': False, 'types': 'get', 'payload': None, 'output': True, 'filename': None, 'timeout': (3.0, 60.0), 'redirect': True, 'upload': None, 'json': False, 'search': None, 'header': {'User-Agent': 'Prop/1.1.2'}, 'cookie': None, 'proxy': {"http": os.environ.get("http_proxy") or os.environ.get("HTTP_PROXY"), "https": os.environ.get("https_proxy") or os.environ.get("HTTPS_PROXY")}, 'auth': None, 'bytes': False, 'recursive': 0, 'body': True, 'content': True, 'conversion': True, 'reconnect': 5, 'caperror': True, 'noparent': False, 'no_downloaded': False, 'interval': 1, 'start': None, 'format': '%(file)s', 'info': False, 'multiprocess': False, 'ssl': True, 'parser': 'auto', 'no_dl_external': True, 'save_robots': True, 'check_only': False, 'workers': 8, 'host_workers': 1, 'batch_workers': 1, 'http_cache': True, 'cache_size': 1024, 'segments': 1, 'max_rate': None, 'retry_budget': 100, 'parallel': 1, 'stdin': False, 'metrics': None, 'profile': None, 'cprofile': False, 'tracemalloc': False, 'parse_workers': None, 'delimiter': None}
         # 以下logger設定
         logger = logging.getLogger('Log of Prop')
-        logger.setLevel(20)
-        sh = LoggingHandler()
-        self.fh = LoggingFileHandler(setting.log_file)
-        logger.addHandler(sh)
-        logger.addHandler(self.fh)
-        format = logging.Formatter('%(asctime)s:[%(levelname)s]> %(message)s')
-        sh.setFormatter(format)
-        self.fh.setFormatter(format)
+        if setting._fh is None:
+            logger.setLevel(20)
+            sh = LoggingHandler()
+            setting._fh = LoggingFileHandler(setting.log_file)
+            logger.addHandler(sh)
+            logger.addHandler(setting._fh)
+            format = logging.Formatter('%(asctime)s:[%(levelname)s]> %(message)s')
+            sh.setFormatter(format)
+            setting._fh.setFormatter(format)
+        self.fh = setting._fh
         self.log = logger.log
 
     def config_load(self) -> None:
         """
         設定ファイルをロード
         """
-        if os.path.isfile(setting.config_file):
+        if setting._config is None and os.path.isfile(setting.config_file):
             with open(setting.config_file, 'r') as f:
                 config = json.load(f)
             if isinstance(config['timeout'], list):
                 config['timeout'] = tuple(config['timeout'])
-            self.options.update(config)
+            setting._config = config
+        if setting._config is not None:
+            self.options.update(copy.deepcopy(setting._config))
 
     def config(self, key: str, value: str or bool or None) -> None:
         """
@@ -143,96 +264,1685 @@ class setting:
         """
         self.options[key] = value
 
-class cache:
-    """
-    キャッシュ(stylesheet)を扱うクラス
-    """
-    if _binary:
-        root = os.path.join(_prop_directory, 'cache')
-    else:
-        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
-    configfile = os.path.join(root, '.cache_info')
-    if os.path.isfile(configfile):
-        with open(configfile, 'r') as f:
-            _caches = json.load(f)
-    else:
-        _caches = dict()
-
-    def __init__(self, url, parse):
-        self.parse = parse
-        host = self.parse.get_hostname(url) 
-        if not os.path.isdir(self.root):
-            os.mkdir(self.root)
-        self.directory = os.path.join(cache.root, host)
-        if not os.path.isdir(self.directory):
-            os.mkdir(self.directory)
+class cache:
+    """
+    キャッシュを扱うクラス
+    本文は内容のsha256をファイル名にして一度だけ保存し(同じ内容の本文は共有する)、URLとの対応はsqliteの索引で管理する
+    合計サイズが上限を超えたら、最後に使われたのが古い本文から削除する
+    kindは用途(stylesheetは'style', HTTPキャッシュは'http')
+    """
+    root = _data_path('cache')
+    # 以前の形式のキャッシュの索引
+    configfile = _data_path(os.path.join('cache', '.cache_info'))
+    _store = None
+    _open_lock = threading.Lock()
+
+    def __init__(self, limit: int=1024*1048576):
+        self.limit = limit
+        self.objects = os.path.join(cache.root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache.root, 'index.sqlite3'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, size INTEGER, last_access REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS objects_last_access ON objects (last_access)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries (url TEXT, kind TEXT, hash TEXT, etag TEXT, last_modified TEXT, cache_control TEXT, headers TEXT, stored REAL, PRIMARY KEY (url, kind))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        self._migrate()
+
+    @classmethod
+    def open(cls, limit: int=None) -> 'cache':
+        """
+        プロセスで共有するキャッシュを返す(最初に呼ばれたときに開く)
+        """
+        with cls._open_lock:
+            if cls._store is None:
+                cls._store = cls()
+            if limit is not None:
+                cls._store.limit = limit
+            return cls._store
+
+    def _migrate(self) -> None:
+        """
+        以前の形式のキャッシュ(.cache_infoと<host>/<filename>)を取り込む
+        """
+        if not os.path.isfile(cache.configfile):
+            return
+        with open(cache.configfile, 'r') as f:
+            caches = json.load(f)
+        for url, path in caches.items():
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    self.put(url, f.read(), 'style')
+                os.remove(path)
+        os.remove(cache.configfile)
+        for directory in os.listdir(cache.root):
+            directory = os.path.join(cache.root, directory)
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def _write_object(self, digest: str, write) -> str:
+        """
+        本文がまだ保存されていなければ一時ファイルに書いてから置き換える
+        """
+        path = self._object_path(digest)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp, path)
+        return path
+
+    def put(self, url: str, body: bytes, kind: str, headers: dict=None) -> str or None:
+        """
+        本文を保存してそのパスを返す
+        上限より大きい本文は保存せずにNoneを返す(そのURLの古いキャッシュは消す)
+        """
+        if self.limit < len(body):
+            self.remove(url, kind)
+            return None
+        digest = hashlib.sha256(body).hexdigest()
+        self._write_object(digest, lambda f: f.write(body))
+        self._index(url, kind, digest, len(body), headers)
+        return self._object_path(digest)
+
+    def put_file(self, url: str, path: str, kind: str, headers: dict=None) -> str or None:
+        """
+        ファイルの内容を保存する(渡したファイルは移動または削除される)
+        上限より大きい場合はputと同じく保存せずにNoneを返す
+        """
+        if self.limit < os.path.getsize(path):
+            os.remove(path)
+            self.remove(url, kind)
+            return None
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        size = os.path.getsize(path)
+        target = self._object_path(digest)
+        if os.path.isfile(target):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        self._index(url, kind, digest, size, headers)
+        return target
+
+    def _index(self, url: str, kind: str, digest: str, size: int, headers: dict=None) -> None:
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        with self._lock, self._db:
+            old = self._db.execute('SELECT hash FROM entries WHERE url = ? AND kind = ?', (url, kind)).fetchone()
+            if self._db.execute('INSERT OR IGNORE INTO objects VALUES (?, ?, ?)', (digest, size, time())).rowcount:
+                self._size += size
+            else:
+                self._db.execute('UPDATE objects SET last_access = ? WHERE hash = ?', (time(), digest))
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (url, kind, digest, headers.get('etag'), headers.get('last-modified'), headers.get('cache-control'), json.dumps(headers), time()))
+            removed = self._release(old[0]) if old and old[0] != digest else []
+            removed += self._evict()
+        self._unlink(removed)
+
+    def entry(self, url: str, kind: str) -> dict or None:
+        """
+        URLに対応するキャッシュの情報(本文のパスはpath)を返す
+        見つかった本文は最後に使われた日時を更新する
+        """
+        with self._lock:
+            row = self._db.execute('SELECT e.hash, e.etag, e.last_modified, e.cache_control, e.headers, o.size FROM entries e JOIN objects o ON e.hash = o.hash WHERE e.url = ? AND e.kind = ?', (url, kind)).fetchone()
+            if row is None or not os.path.isfile(self._object_path(row[0])):
+                return None
+            with self._db:
+                self._db.execute('UPDATE objects SET last_access = ? WHERE hash = ?', (time(), row[0]))
+        return {'url': url, 'kind': kind, 'hash': row[0], 'etag': row[1], 'last_modified': row[2], 'cache_control': row[3], 'headers': json.loads(row[4] or '{}'), 'size': row[5], 'path': self._object_path(row[0])}
+
+    def entries(self, kind: str) -> list:
+        with self._lock:
+            urls = [url for url, in self._db.execute('SELECT url FROM entries WHERE kind = ?', (kind,))]
+        return list(filter(None, (self.entry(url, kind) for url in urls)))
+
+    def get_cache(self, url: str) -> str or None:
+        """
+        stylesheetのキャッシュのパスを返す
+        """
+        entry = self.entry(url, 'style')
+        self.record(entry is not None, entry['size'] if entry else 0)
+        return entry and entry['path']
+
+    def update_validators(self, url: str, kind: str, headers) -> None:
+        with self._lock, self._db:
+            self._db.execute('UPDATE entries SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), cache_control = COALESCE(?, cache_control), stored = ? WHERE url = ? AND kind = ?', (headers.get('etag'), headers.get('last-modified'), headers.get('cache-control'), time(), url, kind))
+
+    def remove(self, url: str, kind: str) -> None:
+        with self._lock, self._db:
+            old = self._db.execute('SELECT hash FROM entries WHERE url = ? AND kind = ?', (url, kind)).fetchone()
+            self._db.execute('DELETE FROM entries WHERE url = ? AND kind = ?', (url, kind))
+            removed = self._release(old[0]) if old else []
+        self._unlink(removed)
+
+    def record(self, hit: bool, saved: int=0) -> None:
+        """
+        ヒット率と転送しなくて済んだバイト数を記録
+        """
+        with self._lock, self._db:
+            for name, value in (('hits' if hit else 'misses', 1), ('bytes_saved', saved)):
+                self._db.execute('INSERT INTO stats VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', (name, value))
+
+    def _release(self, digest: str) -> list:
+        """
+        どのURLからも参照されなくなった本文を索引から消す(ロックを取った状態で呼ぶ)
+        """
+        if self._db.execute('SELECT 1 FROM entries WHERE hash = ? LIMIT 1', (digest,)).fetchone():
+            return []
+        return self._drop([digest])
+
+    def _evict(self) -> list:
+        """
+        合計サイズが上限を超えていたら、最後に使われたのが古い本文から索引を消す(ロックを取った状態で呼ぶ)
+        """
+        victims: list = []
+        total = self._size
+        if self.limit < total:
+            for digest, size in self._db.execute('SELECT hash, size FROM objects ORDER BY last_access'):
+                victims.append(digest)
+                total -= size
+                if total <= self.limit:
+                    break
+        return self._drop(victims)
+
+    def _drop(self, digests: list) -> list:
+        for digest in digests:
+            size = self._db.execute('SELECT size FROM objects WHERE hash = ?', (digest,)).fetchone()
+            if size:
+                self._size -= size[0]
+            self._db.execute('DELETE FROM entries WHERE hash = ?', (digest,))
+            self._db.execute('DELETE FROM objects WHERE hash = ?', (digest,))
+        return digests
+
+    def _unlink(self, digests: list) -> None:
+        for digest in digests:
+            if os.path.isfile(self._object_path(digest)):
+                os.remove(self._object_path(digest))
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._db.execute('SELECT name, value FROM stats').fetchall())
+            entries = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            objects = self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+            size = self._size
+        hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+        return {'entries': entries, 'objects': objects, 'size': size, 'limit': self.limit, 'hits': hits, 'misses': misses, 'hit rate': round(hits / (hits+misses), 3) if hits+misses else 0.0, 'bytes saved': stats.get('bytes_saved', 0)}
+
+    @staticmethod
+    def update(option):
+        """
+        stylesheetのキャッシュを条件付きリクエストで並列に確認し、変更されていたものだけを更新する
+        stylesディレクトリにコピーしたファイルがあればそれも更新する
+        """
+        file = os.path.join('styles', '.prop_info.json')
+        if os.path.isfile(file):
+            with open(file, 'r') as f:
+                info_dict = json.load(f)
+        else:
+            info_dict = dict()
+        store = cache.open(option['cache_size']*1048576)
+        entries = {entry['url']: entry for entry in store.entries('style')}
+        if not entries:
+            return
+        session = requests.Session()
+        retry_policy.mount(session, option, retry_budget(option['retry_budget']))
+        def refresh(url):
+            entry = entries[url]
+            try:
+                r = session.get(url, timeout=option['timeout'], proxies=option['proxy'], headers=dict(option['header'], **http_cache.validators(entry)), verify=option['ssl'])
+            except Exception as e:
+                return 'failed', e
+            if r.status_code == 304 or (r.status_code == 200 and hashlib.sha256(r.content).hexdigest() == entry['hash']):
+                store.update_validators(url, 'style', r.headers)
+                return 'unchanged', None
+            elif r.status_code != 200:
+                return 'failed', '{}: {}'.format(r.status_code, parser.status_messages.get(r.status_code, 'unknown'))
+            # 上限より大きい本文はキャッシュに残らないが、stylesディレクトリのファイルは更新する
+            store.put(url, r.content, 'style', r.headers)
+            return 'updated', r.content
+        summary: dict = {'unchanged': 0, 'updated': 0, 'failed': 0}
+        # 以前と同じく同じホストへは0.5秒おきにリクエストを送る
+        with fetch_pool(dict(option, interval=0.5), jitter=0, session=session) as pool:
+            for url, _, (state, detail) in tqdm(pool.map(refresh, {url: url for url in entries}), total=len(entries)):
+                summary[state] += 1
+                if state == 'failed':
+                    tqdm.write(f"\033[33mfailed to update '{url}' ({detail})\033[0m")
+                elif state == 'updated':
+                    tqdm.write(f"updated '{url}'")
+                    if url in info_dict:
+                        with open(info_dict[url], 'wb') as f:
+                            f.write(detail)
+                        tqdm.write(f"updated '{info_dict[url]}'")
+        print(', '.join(f'{k}: {v}' for k, v in summary.items()))
+
+class http_cache:
+    """
+    GETで取得したリソースを検証子(ETag, Last-Modified)とCache-Controlと一緒にcacheへ保存するクラス
+    同じURLを再び取得するときは条件付きリクエストを送り、304が返ってきたら保存した本文を使う
+    cacheは使うときに開く(索引がまだなければ、保存するレスポンスが来るまで作らない)
+    """
+    # これより大きい本文は保存しない
+    max_entry = 64*1048576
+    # 本文と一緒に保存しないヘッダー(保存するのはデコード済みの本文なので)
+    _skip_headers = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+    _local = threading.local()
+
+    def __init__(self, store: cache=None, limit: int=None):
+        self._store = store
+        self.limit = limit
+
+    @property
+    def store(self) -> cache:
+        if self._store is None:
+            self._store = cache.open(self.limit)
+        return self._store
+
+    @property
+    def opened(self) -> bool:
+        return self._store is not None or cache._store is not None or os.path.isfile(os.path.join(cache.root, 'index.sqlite3'))
+
+    @classmethod
+    @contextlib.contextmanager
+    def no_store(cls):
+        """
+        このスレッドで送るリクエストの本文は保存しない(-o, -Oのファイルに書き出す本文を二重に持たないため)
+        保存済みのものがあれば条件付きリクエストには使う
+        """
+        cls._local.no_store = True
+        try:
+            yield
+        finally:
+            cls._local.no_store = False
+
+    @classmethod
+    def storing(cls) -> bool:
+        return not getattr(cls._local, 'no_store', False)
+
+    def get(self, url: str) -> dict or None:
+        if not self.opened:
+            return None
+        return self.store.entry(url, 'http')
+
+    @staticmethod
+    def validators(entry: dict) -> dict:
+        """
+        条件付きリクエストのヘッダー
+        """
+        headers: dict = dict()
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @staticmethod
+    def storable(response) -> bool:
+        if not (response.headers.get('etag') or response.headers.get('last-modified')):
+            return False
+        if 'no-store' in response.headers.get('cache-control', '').lower() or response.headers.get('vary', '').strip() == '*':
+            return False
+        try:
+            return int(response.headers.get('content-length', 0)) <= http_cache.max_entry
+        except ValueError:
+            return True
+
+    def spool(self, url: str) -> str:
+        """
+        本文を書き込む一時ファイルのパス(storeでキャッシュに移す)
+        """
+        return os.path.join(self.store.objects, f'{hashlib.sha256(url.encode()).hexdigest()}.{threading.get_ident()}.part')
+
+    def store_response(self, url: str, response, spool: str) -> None:
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in http_cache._skip_headers}
+        self.store.put_file(url, spool, 'http', headers)
+
+    def remove(self, url: str) -> None:
+        self.store.remove(url, 'http')
+
+    def fill(self, response, entry: dict) -> None:
+        """
+        304のレスポンスを、保存しておいた本文を持つ200のレスポンスに置き換える
+        """
+        with open(entry['path'], 'rb') as f:
+            body = f.read()
+        headers = dict(entry['headers'])
+        headers.update({k: v for k, v in response.headers.items() if k.lower() not in http_cache._skip_headers})
+        response.headers.clear()
+        response.headers.update(headers)
+        response.headers['Content-Length'] = str(len(body))
+        response.status_code = 200
+        response.reason = 'OK'
+        response._content = body
+        response._content_consumed = True
+        response.from_cache = True
+        self.store.update_validators(entry['url'], 'http', response.headers)
+        self.store.record(True, len(body))
+
+class _tee_raw:
+    """
+    urllib3のレスポンスを読みながら、読んだ本文をファイルにも書き出すラッパー
+    最後まで読み終えたときだけon_completeを呼ぶ
+    """
+    def __init__(self, raw, spool: str, on_complete):
+        self._raw = raw
+        self._spool = spool
+        self._on_complete = on_complete
+
+    def stream(self, amt=65536, decode_content=None):
+        f = open(self._spool, 'wb')
+        try:
+            size = 0
+            for chunk in self._raw.stream(amt, decode_content=decode_content):
+                if f is not None:
+                    size += len(chunk)
+                    if size <= http_cache.max_entry:
+                        f.write(chunk)
+                    else:
+                        f.close()
+                        f = None
+                yield chunk
+            if f is not None:
+                f.close()
+                f = None
+                self._on_complete()
+        finally:
+            if f is not None:
+                f.close()
+            if os.path.isfile(self._spool):
+                os.remove(self._spool)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+class metrics:
+    """
+    リクエストごとの時間(名前解決, 接続とTLS, 最初のバイトまで, 転送)とバイト数, 再試行回数を記録し、実行の最後にまとめるクラス(--metrics)
+    timed_adapterを通るリクエストを記録し、installするとurllib3の接続にかかった時間もそのリクエストに割り当てる
+    """
+    phases = ('dns', 'connect', 'ttfb', 'transfer', 'total')
+    quantiles = (0.5, 0.9, 0.99)
+    _store = None
+    _local = threading.local()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: list = []
+        self.started = time()
+
+    @classmethod
+    def open(cls) -> 'metrics' or None:
+        """
+        記録が有効ならプロセスで共有するmetricsを返す(無効ならNone)
+        """
+        return cls._store
+
+    @classmethod
+    def install(cls) -> None:
+        """
+        記録を有効にし、urllib3の接続(名前解決を含む)を時間を測るものに置き換える
+        """
+        if cls._store is not None:
+            return
+        cls._store = cls()
+        for klass in (urllib3_connection.HTTPConnection, urllib3_connection.HTTPSConnection):
+            klass.connect = cls._timed_connect(klass.connect)
+
+    @classmethod
+    def _timed_connect(cls, connect):
+        def timed_connect(self, *args, **kwargs):
+            record = getattr(cls._local, 'record', None)
+            if record is None or getattr(cls._local, 'connecting', False):
+                return connect(self, *args, **kwargs)
+            cls._local.connecting = True
+            dns = record['dns']
+            start = time()
+            try:
+                return connect(self, *args, **kwargs)
+            finally:
+                cls._local.connecting = False
+                # 名前解決の時間はdns_cacheが別に足している
+                record['connect'] += time() - start - (record['dns'] - dns)
+        return timed_connect
+
+    @classmethod
+    def add(cls, phase: str, seconds: float) -> None:
+        """
+        このスレッドで送っているリクエストの記録に時間を足す
+        """
+        record = getattr(cls._local, 'record', None)
+        if record is not None:
+            record[phase] += seconds
+
+    def begin(self, request) -> dict:
+        record: dict = {'url': request.url, 'host': urlparse(request.url).hostname, 'method': request.method, 'status': None, 'error': None, 'dns': 0.0, 'connect': 0.0, 'ttfb': 0.0, 'transfer': None, 'bytes': 0, 'retries': 0, 'total': 0.0}
+        metrics._local.record = record
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def skipped(self, url: str, error: str) -> None:
+        """
+        リクエストを送る前に失敗したURL(名前解決できなかったなど)を記録
+        """
+        with self._lock:
+            self.records.append({'url': url, 'host': urlparse(url).hostname, 'method': None, 'status': None, 'error': error, 'dns': None, 'connect': None, 'ttfb': None, 'transfer': None, 'bytes': 0, 'retries': 0, 'total': 0.0})
+
+    @staticmethod
+    def end(record: dict, start: float, response=None, error: Exception=None) -> None:
+        metrics._local.record = None
+        record['ttfb'] = max(0.0, time() - start - record['dns'] - record['connect'])
+        record['total'] = time() - start
+        if error is not None:
+            record['error'] = type(error).__name__
+        if response is not None:
+            record['status'] = response.status_code
+            retries = getattr(response.raw, 'retries', None)
+            record['retries'] = len(retries.history) if retries is not None else 0
+
+    @staticmethod
+    def finish(record: dict, size: int, seconds: float) -> None:
+        """
+        本文を最後まで読み終えたときに呼ばれる
+        """
+        record['bytes'] = size
+        record['transfer'] = seconds
+        record['total'] += seconds
+
+    @staticmethod
+    def percentile(values: list, q: float) -> float:
+        """
+        昇順に並んだvaluesのq分位数(nearest-rank)
+        """
+        return values[max(0, math.ceil(q*len(values))-1)]
+
+    def summary(self, slowest: int=10) -> dict:
+        with self._lock:
+            records = list(self.records)
+        phases: dict = dict()
+        for phase in self.phases:
+            values = sorted(r[phase] for r in records if r[phase] is not None)
+            if values:
+                phases[phase] = dict({f'p{round(q*100)}': round(self.percentile(values, q), 4) for q in self.quantiles}, max=round(values[-1], 4), mean=round(sum(values) / len(values), 4))
+        hosts: dict = dict()
+        errors: dict = dict()
+        for r in records:
+            host = hosts.setdefault(r['host'], {'requests': 0, 'bytes': 0, 'seconds': 0.0, 'errors': 0})
+            host['requests'] += 1
+            host['bytes'] += r['bytes']
+            host['seconds'] += r['total']
+            reason = r['error'] or (str(r['status']) if r['status'] is not None and 400 <= r['status'] else None)
+            if reason is not None:
+                host['errors'] += 1
+                errors[reason] = errors.get(reason, 0) + 1
+        for host in hosts.values():
+            host['bytes/s'] = round(host['bytes'] / host['seconds']) if host['seconds'] else 0
+            host['seconds'] = round(host['seconds'], 3)
+        return {
+            'requests': len(records),
+            'bytes': sum(r['bytes'] for r in records),
+            'retries': sum(r['retries'] for r in records),
+            'errors': errors,
+            'seconds': round(time() - self.started, 3),
+            'phases': phases,
+            'hosts': hosts,
+            'slowest': [{'url': r['url'], 'seconds': round(r['total'], 4), 'status': r['status'], 'error': r['error']} for r in sorted(records, key=lambda r: r['total'], reverse=True)[:slowest]]
+        }
+
+    @staticmethod
+    def _label(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def prometheus(self, summary: dict) -> str:
+        """
+        node_exporterのtextfile collectorで読める形式
+        """
+        lines: list = []
+        def metric(name: str, kind: str, help: str, samples: list) -> None:
+            lines.append(f'# HELP prop_{name} {help}')
+            lines.append(f'# TYPE prop_{name} {kind}')
+            for labels, value in samples:
+                label = ','.join(f'{k}="{self._label(v)}"' for k, v in labels.items())
+                lines.append(f'prop_{name}{{{label}}} {value}' if label else f'prop_{name} {value}')
+        metric('requests_total', 'counter', 'Number of requests.', [({'host': h}, v['requests']) for h, v in summary['hosts'].items()])
+        metric('response_bytes_total', 'counter', 'Bytes of response bodies.', [({'host': h}, v['bytes']) for h, v in summary['hosts'].items()])
+        metric('host_throughput_bytes_per_second', 'gauge', 'Bytes per second of requests to the host.', [({'host': h}, v['bytes/s']) for h, v in summary['hosts'].items()])
+        metric('errors_total', 'counter', 'Number of failed requests by status code or exception.', [({'reason': k}, v) for k, v in summary['errors'].items()])
+        metric('retries_total', 'counter', 'Number of retries.', [({}, summary['retries'])])
+        metric('request_phase_seconds', 'summary', 'Seconds spent in each phase of requests.', [({'phase': phase, 'quantile': q}, values[f'p{round(q*100)}']) for phase, values in summary['phases'].items() for q in self.quantiles])
+        metric('run_seconds', 'gauge', 'Wall time of the run.', [({}, summary['seconds'])])
+        return '\n'.join(lines)+'\n'
+
+    def save(self, file: str) -> None:
+        """
+        拡張子が.promならPrometheusのtextfile形式、それ以外はJSONで書き出す
+        """
+        summary = self.summary()
+        with open(file, 'w') as f:
+            if file.endswith('.prom'):
+                f.write(self.prometheus(summary))
+            else:
+                json.dump(summary, f, indent=4, ensure_ascii=False)
+
+class profiler:
+    """
+    --profileで処理(通信, 解析, 保存, .prop_info.jsonの書き出し, パス変換など)ごとの時間と確保したメモリを集計するクラス
+    timedで包んだメソッドは、無効なときはそのまま呼ばれる
+    入れ子になった処理の時間は外側の処理のself secondsから除く
+    """
+    _store = None
+    _local = threading.local()
+
+    def __init__(self, file: str, cprofile: bool=False, memory: bool=False):
+        self._lock = threading.Lock()
+        self.file = file
+        self.phases: dict = dict()
+        self.profile = None
+        self.memory = memory
+        if cprofile:
+            import cProfile
+            self.profile = cProfile.Profile()
+        self.started = time()
+
+    @classmethod
+    def open(cls) -> 'profiler' or None:
+        """
+        計測が有効ならプロセスで共有するprofilerを返す(無効ならNone)
+        """
+        return cls._store
+
+    @classmethod
+    def start(cls, file: str, cprofile: bool=False, memory: bool=False) -> 'profiler':
+        cls._store = cls(file, cprofile, memory)
+        if memory:
+            tracemalloc.start()
+        if cls._store.profile is not None:
+            # cProfileは有効にしたスレッド(メインスレッド)だけを見る
+            cls._store.profile.enable()
+        return cls._store
+
+    @classmethod
+    def timed(cls, phase: str):
+        """
+        メソッドの実行をphaseとして計測するデコレータ
+        """
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                if cls._store is None:
+                    return func(*args, **kwargs)
+                with cls._store.phase(phase):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    def phase(self, name: str) -> 'profiler._phase':
+        return self._phase(self, name)
+
+    class _phase:
+        def __init__(self, owner: 'profiler', name: str):
+            self.owner = owner
+            self.name = name
+
+        def __enter__(self):
+            stack = getattr(profiler._local, 'stack', None)
+            if stack is None:
+                stack = profiler._local.stack = []
+            self.memory = tracemalloc.get_traced_memory()[0] if self.owner.memory else 0
+            self.child = 0.0
+            stack.append(self)
+            self.start = time()
+            return self
+
+        def __exit__(self, *_):
+            elapsed = time() - self.start
+            stack = profiler._local.stack
+            stack.pop()
+            if stack:
+                stack[-1].child += elapsed
+            allocated = tracemalloc.get_traced_memory()[0] - self.memory if self.owner.memory else 0
+            with self.owner._lock:
+                phase = self.owner.phases.setdefault(self.name, {'calls': 0, 'seconds': 0.0, 'self seconds': 0.0, 'allocated': 0})
+                phase['calls'] += 1
+                phase['seconds'] += elapsed
+                phase['self seconds'] += elapsed - self.child
+                phase['allocated'] += allocated
+            return False
+
+    def stop(self) -> dict:
+        """
+        計測を終え、処理ごとの内訳を書き出す
+        cProfileを使った場合は、同じ名前で拡張子が.pstatsのファイルも書き出す
+        """
+        wall = time() - self.started
+        result: dict = {'seconds': round(wall, 3), 'phases': dict()}
+        with self._lock:
+            phases = copy.deepcopy(self.phases)
+        for name, phase in sorted(phases.items(), key=lambda p: p[1]['self seconds'], reverse=True):
+            result['phases'][name] = {'calls': phase['calls'], 'seconds': round(phase['seconds'], 4), 'self seconds': round(phase['self seconds'], 4), 'seconds/call': round(phase['seconds'] / phase['calls'], 6)}
+            if self.memory:
+                result['phases'][name]['allocated MB'] = round(phase['allocated'] / 1048576, 3)
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            result['peak MB'] = round(tracemalloc.get_traced_memory()[1] / 1048576, 3)
+            result['top allocations'] = [{'line': str(stat.traceback), 'MB': round(stat.size / 1048576, 3), 'blocks': stat.count} for stat in snapshot.statistics('lineno')[:10]]
+            tracemalloc.stop()
+        if self.profile is not None:
+            self.profile.disable()
+            result['pstats'] = os.path.splitext(self.file)[0]+'.pstats'
+            self.profile.dump_stats(result['pstats'])
+        with open(self.file, 'w') as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+        profiler._store = None
+        return result
+
+class _timed_raw:
+    """
+    urllib3のレスポンスを読み終えたときに、読んだバイト数とかかった時間をon_completeに渡すラッパー
+    """
+    def __init__(self, raw, on_complete):
+        self._raw = raw
+        self._on_complete = on_complete
+
+    def stream(self, amt=65536, decode_content=None):
+        start = time()
+        size = 0
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            size += len(chunk)
+            yield chunk
+        self._on_complete(size, time() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+@_lazy.deferred
+def timed_adapter():
+    class timed_adapter(requests.adapters.HTTPAdapter):
+        """
+        --metricsが指定されているとき、送ったリクエストをmetricsに記録するアダプタ
+        """
+        def send(self, request, *args, **kwargs):
+            store = metrics.open()
+            if store is None:
+                return super().send(request, *args, **kwargs)
+            record = store.begin(request)
+            start = time()
+            try:
+                response = super().send(request, *args, **kwargs)
+            except Exception as e:
+                metrics.end(record, start, error=e)
+                raise
+            metrics.end(record, start, response)
+            response.raw = _timed_raw(response.raw, lambda size, seconds: metrics.finish(record, size, seconds))
+            return response
+    return timed_adapter
+
+
+@_lazy.deferred
+def cache_adapter():
+    class cache_adapter(timed_adapter):
+        """
+        GETリクエストに保存済みの検証子を付けて送り、304なら保存済みの本文を返すアダプタ
+        Sessionにマウントすると、そのSessionを使う全てのリクエストに適用される
+        """
+        def __init__(self, cache: http_cache, *args, **kwargs):
+            self.cache = cache
+            super().__init__(*args, **kwargs)
+
+        def send(self, request, *args, **kwargs):
+            cacheable = request.method == 'GET' and not any(k in request.headers for k in ('Range', 'If-None-Match', 'If-Modified-Since', 'If-Range'))
+            entry = self.cache.get(request.url) if cacheable else None
+            if entry is not None:
+                request.headers.update(self.cache.validators(entry))
+            response = super().send(request, *args, **kwargs)
+            if not cacheable:
+                return response
+            if response.status_code == 304 and entry is not None:
+                self.cache.fill(response, entry)
+                logging.getLogger('Log of Prop').log(20, f"'{request.url}' was not modified, so the cached body is used")
+                return response
+            if self.cache.opened:
+                self.cache.store.record(False)
+            if response.status_code == 200 and self.cache.storing() and self.cache.storable(response):
+                spool = self.cache.spool(request.url)
+                response.raw = _tee_raw(response.raw, spool, lambda: self.cache.store_response(request.url, response, spool))
+            elif response.status_code == 200 and entry is not None:
+                self.cache.remove(request.url)
+            return response
+    return cache_adapter
+
+
+class history:
+    """
+    ダウンロード履歴関連の関数を定義するクラス
+    基本的に./history配下のファイルのみ操作
+    履歴はドメインごとにsqliteのデータベースへ保存し、取得日時、ステータスコード、サイズも記録する
+    接続はopenでドメインごとに一つだけ開いて使い回し、終了時にclose_allで閉じる
+    """
+    root = _data_path('history')
+    _stores: dict = dict() # データベースのパス => history
+    _open_lock = threading.Lock()
+
+    def __init__(self, url: str):
+        self.domain = urlparse(url).hostname
+        self.history_file = os.path.join(history.root, self.domain+'.sqlite3')
+        os.makedirs(history.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._urls: set = None
+        self._db = sqlite3.connect(self.history_file, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS history (url TEXT PRIMARY KEY, fetched REAL, status INTEGER, size INTEGER)')
+        self._migrate(os.path.join(history.root, self.domain+'.txt'))
+
+    @classmethod
+    def open(cls, url: str) -> 'history':
+        """
+        urlのドメインの履歴を返す(同じドメインは同じ接続を使う)
+        """
+        path = os.path.join(cls.root, urlparse(url).hostname+'.sqlite3')
+        with cls._open_lock:
+            if path not in cls._stores:
+                cls._stores[path] = cls(url)
+            return cls._stores[path]
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls._open_lock:
+            for store in cls._stores.values():
+                store.close()
+            cls._stores.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _migrate(self, text_file: str) -> None:
+        """
+        以前のテキスト形式の履歴(<domain>.txt)があればデータベースに移す
+        """
+        if not os.path.isfile(text_file):
+            return
+        with open(text_file, 'r') as f:
+            urls = [(url,) for url in f.read().splitlines() if url]
+        with self._db:
+            self._db.executemany('INSERT OR IGNORE INTO history (url) VALUES (?)', urls)
+        os.remove(text_file)
+
+    def write(self, content: str or list, status: int=None, size: int=None) -> None:
+        if isinstance(content, str):
+            content = [content]
+        now = time()
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)', [(url, now, status, size) for url in content])
+            if self._urls is not None:
+                self._urls.update(content)
+
+    def read(self) -> set:
+        """
+        履歴のURLの集合を返す(データベースを読むのは最初の一回だけ)
+        """
+        with self._lock:
+            if self._urls is None:
+                self._urls = {url for url, in self._db.execute('SELECT url FROM history')}
+            return self._urls
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.read()
+
+class dns_cache:
+    """
+    名前解決の結果を実行中ずっと共有するクラス
+    成功した結果はttl秒、失敗した結果はnegative_ttl秒の間使い回し、新しく見つかったホストは裏で先に問い合わせておく
+    installするとrequests(urllib3)の名前解決もこのキャッシュを通る(mainの間だけで、終わればuninstallで元に戻す)
+    """
+    ttl = 300
+    negative_ttl = 30
+    _store = None
+    _open_lock = threading.Lock()
+    _getaddrinfo = staticmethod(socket.getaddrinfo)
+
+    def __init__(self, workers: int=4):
+        self._lock = threading.Lock()
+        self._results: dict = dict() # (host, family) => (期限, 結果またはgaierror)
+        self._pending: dict = dict() # (host, family) => Future
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prop-dns')
+
+    @classmethod
+    def open(cls) -> 'dns_cache':
+        with cls._open_lock:
+            if cls._store is None:
+                cls._store = cls()
+            return cls._store
+
+    @classmethod
+    def install(cls) -> None:
+        """
+        socket.getaddrinfoをキャッシュを通すものに置き換える
+        """
+        store = cls.open()
+        socket.getaddrinfo = store.getaddrinfo
+
+    @classmethod
+    def uninstall(cls) -> None:
+        """
+        socket.getaddrinfoを元に戻し、キャッシュを捨てる
+        """
+        with cls._open_lock:
+            if cls._store is None:
+                return
+            if getattr(socket.getaddrinfo, '__self__', None) is cls._store:
+                socket.getaddrinfo = cls._getaddrinfo
+            cls._store.executor.shutdown(wait=False)
+            cls._store = None
+
+    def _lookup(self, host: str, family: int):
+        try:
+            result = dns_cache._getaddrinfo(host, None, family, socket.SOCK_STREAM)
+            expires = time() + self.ttl
+        except gaierror as e:
+            result = e
+            expires = time() + self.negative_ttl
+        with self._lock:
+            self._results[(host, family)] = (expires, result)
+            self._pending.pop((host, family), None)
+        return result
+
+    def _future(self, host: str, family: int):
+        """
+        結果がまだ無いか期限切れならば問い合わせを始め、そのFutureを返す(結果があればNone)
+        """
+        key = (host, family)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and time() < cached[0]:
+                return None
+            if key not in self._pending:
+                self._pending[key] = self.executor.submit(self._lookup, host, family)
+            return self._pending[key]
+
+    def prefetch(self, host: str, family: int=0) -> None:
+        self._future(host, family)
+
+    def resolve(self, host: str, family: int=0) -> list:
+        future = self._future(host, family)
+        if future is not None:
+            result = future.result()
+        else:
+            result = self._results[(host, family)][1]
+        if isinstance(result, gaierror):
+            raise gaierror(*result.args)
+        return result
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """
+        socket.getaddrinfoと同じ引数で呼べる、キャッシュを通す名前解決
+        """
+        if not isinstance(host, str) or (port is not None and not isinstance(port, int)) or type not in {0, socket.SOCK_STREAM} or proto or flags:
+            return dns_cache._getaddrinfo(host, port, family, type, proto, flags)
+        start = time()
+        try:
+            result = self.resolve(host, family)
+        finally:
+            metrics.add('dns', time() - start)
+        return [(af, socktype, proto_, canonname, (sockaddr[0], port or 0)+tuple(sockaddr[2:])) for af, socktype, proto_, canonname, sockaddr in result]
+
+class rate_limiter:
+    """
+    ホストごとのトークンバケットでリクエストの間隔を決めるクラス
+    429, 503が返ってきたらそのホストのレートを半分にし(Retry-Afterがあればその時間は送らない)、正常なレスポンスが続けば上限まで少しずつ戻す
+    上限は--max-rate, 1/インターバル, 1/crawl_delayのうち一番小さいもの
+    """
+    # スロットリングとみなすステータスコード
+    throttle_status = {429, 503}
+    # レートの下限(リクエスト/秒)
+    min_rate = 1/60
+    # 上限がないホストでスロットリングされたときに下げ始めるレート
+    start_rate = 10.0
+
+    def __init__(self, option, jitter: float=0, log=None, *, clock=time, sleep=sleep):
+        self.option = option
+        self.jitter = jitter
+        self.log = log
+        # 時計と待ち方は差し替えられる(テストで実際には待たずに待つ時間を確かめるため)
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._buckets: dict = dict()
+        self._delay: dict = dict()
+        self._sessions: list = []
+
+    def set_delay(self, host: str, delay: float) -> None:
+        """
+        ホストごとのインターバルの下限(robots.txtのcrawl_delay)を設定
+        """
+        with self._lock:
+            self._delay[host] = delay
+            if host in self._buckets:
+                bucket = self._buckets[host]
+                bucket['ceiling'] = self.ceiling(host)
+                bucket['rate'] = min(bucket['rate'], bucket['ceiling'])
+
+    def interval(self, host: str) -> float:
+        return max(self.option['interval'], self._delay.get(host, 0))
+
+    def ceiling(self, host: str) -> float:
+        rates: list = [math.inf]
+        if self.option['max_rate']:
+            rates.append(self.option['max_rate'])
+        if self.interval(host) > 0:
+            rates.append(1/self.interval(host))
+        return min(rates)
+
+    def _bucket(self, host: str) -> dict:
+        if host not in self._buckets:
+            ceiling = self.ceiling(host)
+            capacity = max(1, self.option['host_workers'])
+            self._buckets[host] = {'ceiling': ceiling, 'rate': ceiling, 'tokens': capacity, 'capacity': capacity, 'stamp': self.clock(), 'blocked': 0.0}
+        return self._buckets[host]
+
+    @profiler.timed('wait')
+    def acquire(self, host: str) -> None:
+        """
+        トークンを一つ予約し、使えるようになるまで待つ
+        """
+        with self._lock:
+            bucket = self._bucket(host)
+            now = self.clock()
+            wait = max(0.0, bucket['blocked'] - now)
+            if bucket['rate'] < math.inf:
+                bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['stamp'])*bucket['rate'])
+                bucket['stamp'] = now
+                # ジッターの分もトークンを余分に使う
+                bucket['tokens'] -= 1 + uniform(0, self.jitter)*bucket['rate']
+                if bucket['tokens'] < 0:
+                    wait = max(wait, -bucket['tokens']/bucket['rate'])
+        if wait:
+            self.sleep(wait)
+
+    @staticmethod
+    def retry_after(value: str, now: float=None) -> float or None:
+        """
+        Retry-Afterの値(秒数か日付)を秒数にする
+        """
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - (time() if now is None else now))
+        except (TypeError, ValueError):
+            return None
+
+    def feedback(self, host: str, status: int, retry_after: str=None) -> None:
+        """
+        レスポンスのステータスコードからそのホストのレートを調整する
+        """
+        with self._lock:
+            bucket = self._bucket(host)
+            if status in self.throttle_status:
+                bucket['rate'] = max(self.min_rate, (bucket['rate'] if bucket['rate'] < math.inf else self.start_rate)/2)
+                bucket['tokens'] = min(bucket['tokens'], 0)
+                bucket['stamp'] = now = self.clock()
+                delay = self.retry_after(retry_after, now)
+                if delay:
+                    bucket['blocked'] = max(bucket['blocked'], now+delay)
+                rate = bucket['rate']
+            elif status < 400 and bucket['rate'] < bucket['ceiling']:
+                bucket['rate'] = min(bucket['ceiling'], bucket['rate']*1.1)
+                return
+            else:
+                return
+        if self.log:
+            self.log(30, f"'{host}' returned {status}, slowing down to {round(rate, 3)} requests/s" + (f' (retry after {retry_after}s)' if delay else ''))
+
+    def _hook(self, response, *args, **kwargs):
+        self.feedback(urlparse(response.url).hostname, response.status_code, response.headers.get('retry-after'))
+
+    def watch(self, session) -> None:
+        """
+        sessionで受け取ったレスポンス(retry_policyが送り直す前のものも含む)をすべてfeedbackに渡す
+        """
+        session.hooks['response'].append(self._hook)
+        for observers in self._observers(session):
+            observers.append(self.feedback)
+        self._sessions.append(session)
+
+    @staticmethod
+    def _observers(session) -> list:
+        return [adapter.max_retries.observers for adapter in set(session.adapters.values()) if isinstance(adapter.max_retries, retry_policy)]
+
+    def close(self) -> None:
+        for session in self._sessions:
+            session.hooks['response'].remove(self._hook)
+            for observers in self._observers(session):
+                observers.remove(self.feedback)
+        self._sessions.clear()
+
+class retry_budget:
+    """
+    一回のクロール全体で使える再試行の回数
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.limit is not None and self.limit <= self.used:
+                return False
+            self.used += 1
+            return True
+
+    def exhausted(self) -> bool:
+        with self._lock:
+            return self.limit is not None and self.limit <= self.used
+
+@_lazy.deferred
+def retry_policy():
+    class retry_policy(urllib3.util.retry.Retry):
+        """
+        全てのリクエストに共通の再試行の方針(アダプタにマウントしてurllib3に再試行させる)
+        冪等なメソッドで、接続エラーかretry_statusのステータスコードのときだけ指数バックオフ(ジッター付き)で送り直す
+        再試行するたびにbudgetを一つ使い、使い切ったらそれ以上は送り直さない(ステータスコードで送り直す場合はそのレスポンスをそのまま返す)
+        observersには再試行するレスポンスのホスト, ステータスコード, Retry-Afterが渡される
+        """
+        retry_status = frozenset({408, 425, 429, 500, 502, 503, 504})
+        backoff_base = 0.5
+        # 待ち時間の上限(urllib3 1.xにはbackoff_maxの引数がないので、get_backoff_timeでこの値を使う)
+        backoff_limit = 30
+
+        def __init__(self, *args, budget: retry_budget=None, observers: list=None, **kwargs):
+            self.budget = budget
+            self.observers: list = observers if observers is not None else []
+            super().__init__(*args, **kwargs)
+
+        @classmethod
+        def build(cls, option, budget: retry_budget=None) -> 'retry_policy':
+            return cls(total=option['reconnect'], allowed_methods=cls.DEFAULT_ALLOWED_METHODS, status_forcelist=cls.retry_status, backoff_factor=cls.backoff_base, raise_on_status=False, budget=budget)
+
+        @classmethod
+        def adapter(cls, option, budget: retry_budget=None, base=timed_adapter, *args) -> 'requests.adapters.HTTPAdapter':
+            """
+            接続プールの大きさを同時接続数に合わせたアダプタ
+            """
+            size = max(option['workers'], option['host_workers'], option['segments'], option['parallel'], requests.adapters.DEFAULT_POOLSIZE)
+            return base(*args, pool_connections=size, pool_maxsize=size, max_retries=cls.build(option, budget))
+
+        @classmethod
+        def mount(cls, session, option, budget: retry_budget=None, base=timed_adapter, *args) -> None:
+            adapter = cls.adapter(option, budget, base, *args)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        def new(self, **kw):
+            kw.setdefault('budget', self.budget)
+            kw.setdefault('observers', self.observers)
+            return super().new(**kw)
+
+        @staticmethod
+        def backoff(retries: int, base: float=backoff_base, limit: float=backoff_limit) -> float:
+            """
+            retries回目の再試行までの待ち時間(半分はランダム)
+            """
+            value = min(limit, base * 2**max(0, retries-1))
+            return value/2 + uniform(0, value/2)
+
+        def get_backoff_time(self) -> float:
+            return self.backoff(len(self.history), self.backoff_factor, self.backoff_limit) if self.history else 0
+
+        def is_retry(self, method: str, status_code: int, has_retry_after: bool=False) -> bool:
+            # budgetを使い切っていたら再試行せず、urllib3にレスポンス(とRetry-After)をそのまま返させる
+            return super().is_retry(method, status_code, has_retry_after) and (self.budget is None or not self.budget.exhausted())
+
+        def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+            new = super().increment(method, url, response, error, _pool, _stacktrace)
+            if self.budget is not None and not self.budget.take():
+                # is_retryの後に他のスレッドが使い切った場合もraise_on_statusがFalseなのでレスポンスは返される
+                raise urllib3.exceptions.MaxRetryError(_pool, url, error or urllib3.exceptions.ResponseError('the retry budget ran out'))
+            if response is not None and _pool is not None:
+                for observer in self.observers:
+                    observer(_pool.host, response.status, response.headers.get('retry-after'))
+            logging.getLogger('Log of Prop').log(20, f"retrying '{url}' of '{getattr(_pool, 'host', '')}' ({response.status if response is not None else error})")
+            return new
+    return retry_policy
+
+
+class fetch_pool:
+    """
+    ホストごとの同時接続数とレートを守りながら並列にリクエストを送るクラス
+    全体の同時接続数はworkers、ホストごとの同時接続数はhost_workersで決まり、レートはrate_limiterが決める
+    sessionを渡すとそのレスポンスでレートを調整する
+    """
+    def __init__(self, option, workers: int=None, jitter: float=3, session=None):
+        self.option = option
+        self.limiter = rate_limiter(option, jitter, logging.getLogger('Log of Prop').log)
+        if session is not None:
+            self.limiter.watch(session)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers or self.option['workers']))
+        self._lock = threading.Lock()
+        self._slots: dict = dict()
+
+    def set_delay(self, host: str, delay: float) -> None:
+        self.limiter.set_delay(host, delay)
+
+    def interval(self, host: str) -> float:
+        return self.limiter.interval(host)
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(max(1, self.option['host_workers']))
+            return self._slots[host]
+
+    def _run(self, func, url: str, *args):
+        host = urlparse(url).hostname
+        with self._slot(host):
+            self.limiter.acquire(host)
+            return func(url, *args)
+
+    def submit(self, func, url: str, *args):
+        return self.executor.submit(self._run, func, url, *args)
+
+    def map(self, func, items: dict, *args):
+        """
+        {参照元: URL}の辞書の全URLに対してfuncを実行し、終わった順に(参照元, URL, 結果)を返す
+        """
+        futures = {self.submit(func, target_url, *args): (from_url, target_url) for from_url, target_url in items.items()}
+        return self._completed(futures)
+
+    def stream(self, func, jobs, window: int=None):
+        """
+        (キー, URL, funcの引数のタプル)を順に読みながらfuncを実行し、終わった順に(キー, URL, 結果)を返す
+        実行中のものと受け取られていない結果はwindow個(指定がなければworkersの2倍)までで、jobsはその分だけ先に読む
+        """
+        window = window or 2*max(1, self.option['workers'])
+        running: dict = dict()
+        jobs = iter(jobs)
+        while True:
+            for key, url, args in itertools.islice(jobs, max(0, window - len(running))):
+                running[self.submit(func, url, *args)] = (key, url)
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, url = running.pop(future)
+                yield key, url, future.result()
+
+    @staticmethod
+    def _completed(futures: dict):
+        for future in as_completed(futures):
+            from_url, target_url = futures[future]
+            yield from_url, target_url, future.result()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.limiter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+
+class link_extractor(HTMLParser):
+    """
+    ツリーを作らずに、aタグ, rel=stylesheetのlinkタグ, imgタグの参照先だけを一度の走査で集めるクラス
+    parserオプションに"stream"を指定した場合に再帰ダウンロードで使われる
+    """
+    chunk_size = 65536
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links: dict = {'a': [], 'stylesheet': [], 'img': []}
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.links['a'].append(dict(attrs).get('href'))
+        elif tag == 'img':
+            attrs = dict(attrs)
+            self.links['img'].append(attrs.get('src') or attrs.get('data-lazy-src') or attrs.get('data-src'))
+        elif tag == 'link':
+            attrs = dict(attrs)
+            # BeautifulSoupのfind_all(rel='stylesheet')と同じく大文字小文字を区別する
+            if 'stylesheet' in (attrs.get('rel') or '').split():
+                self.links['stylesheet'].append(attrs.get('href'))
+
+    @classmethod
+    def extract(cls, source: bytes or str) -> dict:
+        if isinstance(source, bytes):
+            source = UnicodeDammit(source, is_html=True).unicode_markup or ''
+        self = cls()
+        for i in range(0, len(source), cls.chunk_size):
+            self.feed(source[i:i+cls.chunk_size])
+        self.close()
+        return self.links
+
+class tag_extractor(HTMLParser):
+    """
+    -sの条件(タグ名, 属性, text)に合う要素を、ツリーを作らずに先頭から順に取り出すクラス
+    feedした分だけ解析し、条件に合う要素のソースを取り出す(保持するのは閉じていない候補の要素だけ)
+    取り出した要素はBeautifulSoupの形式に整形して返す(ダウンロードしながらでも読み込み済みの文書でも同じ条件, 同じ出力)
+    limit個取り出したらfinishedになるので、それ以降の本文は読まなくてよい
+    CSSセレクタはツリーが必要なので扱わない(parser.html_extractionでBeautifulSoupを使う)
+    """
+    chunk_size = 65536
+    void = frozenset({'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'})
+    # BeautifulSoupと同じく、空白で区切ったどれかが一致すればよい属性
+    multi_valued = frozenset({'class', 'rel', 'rev', 'accept-charset', 'headers', 'accesskey', 'dropzone'})
+    _filters: dict = dict() # -sの条件 => 組み立てた(タグ名, 属性, text)
+
+    def __init__(self, words: dict, limit: int=None):
+        super().__init__(convert_charrefs=False)
+        self.tags, self.attrs, self.text = self.compile(words)
+        self.limit = limit or None
+        self.found = 0
+        self.finished = False
+        self._open: list = [] # 開いている要素の(タグ名, 候補なら取り出し中の要素)
+        self._captures: list = [] # 取り出し中の要素
+        self._slots = collections.deque() # 見つかった順の候補(先頭から確定したものを出す)
+
+    @classmethod
+    def compile(cls, words: dict) -> tuple:
+        """
+        -sの条件を集合に組み立てる(同じ条件は文書をまたいで使い回す)
+        """
+        key = json.dumps(words, sort_keys=True)
+        if key not in cls._filters:
+            tags = frozenset(t.lower() for t in words.get('tags') or []) or None
+            attrs = {k.lower(): frozenset(v) for k, v in words['words'].items() if k != 'text'}
+            text = words['words'].get('text')
+            cls._filters[key] = (tags, attrs, None if text is None else frozenset(text))
+        return cls._filters[key]
+
+    def _match(self, tag: str, attrs: list) -> bool:
+        if self.tags is not None and tag not in self.tags:
+            return False
+        attrs = dict(attrs)
+        for key, values in self.attrs.items():
+            if key not in attrs:
+                return False
+            value = attrs[key] or ''
+            if key in self.multi_valued:
+                if value not in values and values.isdisjoint(value.split()):
+                    return False
+            elif value not in values:
+                return False
+        return True
+
+    def _append(self, raw: str, text: str=None) -> None:
+        for slot in self._captures:
+            slot['source'].append(raw)
+            if text is not None and slot['text'] is not None:
+                slot['text'].append(text)
+
+    def _close(self, slot: dict) -> None:
+        self._captures.remove(slot)
+        slot['match'] = self.text is None or ''.join(slot['text']).strip() in self.text
+        slot['text'] = None
+
+    def _start(self, tag: str, attrs: list, closed: bool) -> None:
+        raw = self.get_starttag_text()
+        self._append(raw)
+        slot = None
+        if self._match(tag, attrs):
+            slot = {'tag': tag, 'source': [raw], 'text': [] if self.text is not None else None, 'match': None}
+            self._slots.append(slot)
+            self._captures.append(slot)
+        if closed or tag in self.void:
+            if slot is not None:
+                self._close(slot)
+        else:
+            self._open.append((tag, slot))
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        if not any(t == tag for t, _ in self._open):
+            self._append(f'</{tag}>')
+            return
+        # 閉じ忘れている内側の要素はここで閉じる
+        while self._open[-1][0] != tag:
+            _, slot = self._open.pop()
+            if slot is not None:
+                self._close(slot)
+        self._append(f'</{tag}>')
+        _, slot = self._open.pop()
+        if slot is not None:
+            self._close(slot)
+
+    def handle_data(self, data):
+        self._append(data, data)
+
+    def handle_entityref(self, name):
+        self._append(f'&{name};', html.unescape(f'&{name};'))
+
+    def handle_charref(self, name):
+        self._append(f'&#{name};', html.unescape(f'&#{name};'))
+
+    def handle_comment(self, data):
+        self._append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self._append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self._append(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self._append(f'<![{data}]>')
+
+    def close(self):
+        super().close()
+        while self._open:
+            _, slot = self._open.pop()
+            if slot is not None:
+                self._close(slot)
+
+    def results(self) -> list:
+        """
+        先頭から確定した要素のソースを返す(limitを超える分は返さない)
+        """
+        result: list = []
+        while self._slots and self._slots[0]['match'] is not None and not self.finished:
+            slot = self._slots.popleft()
+            if slot['match']:
+                self.found += 1
+                result.append(self.format(''.join(slot['source']), slot['tag']))
+                self.finished = self.limit is not None and self.limit <= self.found
+        return result
+
+    @staticmethod
+    def format(source: str, tag: str) -> str:
+        """
+        取り出した要素のソースをBeautifulSoupの形式にする
+        要素だけの断片なのでhtml.parserで読む(lxmlは単独のtdなどを捨ててしまう)
+        """
+        element = bs(source, 'html.parser').find(tag)
+        return source if element is None else str(element)
+
+    @classmethod
+    def extract(cls, chunks, words: dict, limit: int=None):
+        """
+        chunks(文字列のイテラブル)から条件に合う要素を見つけた順に返すジェネレータ
+        limit個見つかったらchunksの残りは読まない
+        """
+        self = cls(words, limit)
+        for chunk in chunks:
+            self.feed(chunk)
+            yield from self.results()
+            if self.finished:
+                return
+        self.close()
+        yield from self.results()
+
+class parser_backend:
+    """
+    HTMLの解析に使うパーサー(設定の"parser")
+    "auto"はインストールされている中で一番速いもの(lxml, html.parser)を選ぶ
+    "stream"はリンクの抽出専用なので、ツリーが必要な処理ではautoと同じものを使う
+    lxmlではリンクの抽出にBeautifulSoupのツリーを作らず、lxmlのツリーをそのまま辿る
+    CSSセレクタはコンパイルしたものを文書をまたいで使い回す
+    """
+    fastest = ('lxml', 'html.parser')
+    builtin = frozenset({'html.parser', 'stream'})
+    modules: dict = {'lxml': 'lxml', 'lxml-xml': 'lxml', 'xml': 'lxml', 'html5lib': 'html5lib'}
+    _installed: dict = dict()
+    _selectors: dict = dict() # CSSセレクタ => コンパイルしたもの
+
+    def __init__(self, name: str='auto'):
+        self.name = self.resolve(name)
+        self.tree = self.resolve('auto') if self.name == 'stream' else self.name
+
+    @classmethod
+    def installed(cls, name: str) -> bool:
+        if name in cls.builtin:
+            return True
+        if name not in cls._installed:
+            cls._installed[name] = find_spec(cls.modules.get(name, name)) is not None
+        return cls._installed[name]
+
+    @classmethod
+    def available(cls) -> list:
+        """
+        インストールされているパーサー(streamを含む)
+        """
+        return [name for name in ('lxml', 'html5lib', 'html.parser', 'stream') if cls.installed(name)]
+
+    @classmethod
+    def resolve(cls, name: str) -> str:
+        if name in (None, '', 'auto'):
+            return next(n for n in cls.fastest if cls.installed(n))
+        if not cls.installed(name):
+            error.print(f"The parser '{name}' is not installed\nPlease install it, or set \"parser\" to \"auto\" in {setting.config_file}")
+        return name
+
+    def soup(self, source: bytes or str):
+        return bs(source, self.tree)
+
+    @classmethod
+    def selector(cls, css: str):
+        if css not in cls._selectors:
+            cls._selectors[css] = soupsieve.compile(css)
+        return cls._selectors[css]
+
+    def select(self, source: bytes or str, css: str, limit: int=None) -> list:
+        return self.selector(css).select(self.soup(source), limit=limit or 0)
 
     @staticmethod
-    def get_cache(url) -> str or None:
-        return cache._caches.get(url)
+    def decode(source: bytes, encoding: str=None) -> str:
+        """
+        どのパーサーでも同じ文字コードで読む(HTTPのcharset, 文書の宣言, 推測の順)
+        """
+        return UnicodeDammit(source, [encoding] if encoding else [], is_html=True).unicode_markup or ''
 
-    def save(self, url, body: bytes) -> str:
-        file = os.path.join(self.directory, self.parse.get_filename(url))
-        with open(file, 'wb') as f:
-            f.write(body)
-        cache._caches[url] = file
+    def links(self, source: bytes or str, encoding: str=None) -> dict:
+        """
+        aタグ, rel=stylesheetのlinkタグ, imgタグの参照先を抽出(parser._linksと同じ形)
+        encodingはレスポンスのContent-Typeのcharset(指定されていた場合)
+        """
+        if isinstance(source, bytes):
+            source = self.decode(source, encoding)
+        if self.name == 'stream':
+            return link_extractor.extract(source)
+        if self.name == 'lxml':
+            try:
+                return self._lxml_links(source)
+            except Exception:
+                # 空の文書などはBeautifulSoupに任せる
+                pass
+        return parser._links(self.soup(source))
 
     @staticmethod
-    def update(option):
-        file = os.path.join('styles', '.prop_info.json')
-        if os.path.isfile(file):
-            with open(file, 'r') as f:
-                info_dict = json.load(f)
+    def _lxml_links(source: str) -> dict:
+        # lxmlは文字コードの宣言を含む文字列を受け付けない(デコード済みなので宣言は不要)
+        root = lxml_html.document_fromstring(_xml_declaration.sub('', source, count=1))
+        links: dict = {'a': [], 'stylesheet': [], 'img': []}
+        for element in root.iter('a', 'link', 'img'):
+            if element.tag == 'a':
+                links['a'].append(element.get('href'))
+            elif element.tag == 'img':
+                links['img'].append(element.get('src') or element.get('data-lazy-src') or element.get('data-src'))
+            elif 'stylesheet' in (element.get('rel') or '').split():
+                links['stylesheet'].append(element.get('href'))
+        return links
+
+class link_filter:
+    """
+    -np, -dx, -n, -st, -nd, robots.txtによるURLの絞り込みをクロールごとに一度だけ組み立てて使い回すクラス
+    既出のURLはクロール全体で一つの集合で管理する
+    """
+    def __init__(self, option, log, response_url: str, root_url: str, *, downloaded: set=frozenset(), info_dict: dict=None, robots=None):
+        self.option = option
+        self.log = log
+        self.info_dict: dict = info_dict if info_dict is not None else dict()
+        self.seen: dict = dict() # URL => 最初に見つかった参照元
+        self.aliases: dict = dict() # 既出のURLを別の書き方で参照していた参照元 => URL
+        self.hosts: set = {parser.get_hostname(response_url)} # 名前解決を始めたホスト
+        # 最初のページへのリンクはもう一度ダウンロードしない
+        self.seen[response_url] = response_url
+        self.rules: list = self._compile(response_url, root_url, downloaded)
+        if robots is not None and self.option['save_robots']:
+            # 判定は既出でもなく他のオプションでも除外されなかったURLごとに一度だけ行う
+            self.is_ok = robots.can_crawl
         else:
-            info_dict = dict()
-        if not cache._caches:
-            return
-        for url, path in tqdm(cache._caches.items()):
-            r = requests.get(url, timeout=option['timeout'], proxies=option['proxy'], headers=option['header'], verify=option['ssl'])
-            with open(path, 'wb') as f:
-                f.write(r.content)
-            tqdm.write(f"updated '{path}'")
-            if url in info_dict:
-                shutil.copy(path, info_dict[url])
-                tqdm.write(f"updated '{info_dict[url]}'")
-            sleep(0.5)
+            self.is_ok = None
 
-    def __enter__(self):
-        return self
+    def _compile(self, response_url: str, root_url: str, downloaded: set) -> list:
+        """
+        指定されているオプションの判定だけを並べる(どれかがTrueならそのURLは除外)
+        """
+        rules: list = []
+        if self.option['noparent']:
+            rules.append(lambda url: not url.startswith(response_url) and url.startswith(root_url))
+        if self.option['no_dl_external']:
+            rules.append(lambda url: not url.startswith(root_url))
+        if self.option['download_name']:
+            name = self.option['download_name']
+            rules.append(lambda url: name not in url)
+        if self.option['no_downloaded'] and downloaded:
+            rules.append(downloaded.__contains__)
+        return rules
+
+    def filter(self, hrefs: list, cwd_url: str, cut: bool=True) -> dict:
+        """
+        1ページ分の参照先(hrefやsrcの値そのまま)から、ダウンロードするものを{参照元: URL}の形で返す
+        cutがFalseの場合は-np, -dx, -n, -st, -nd, -Mを適用しない
+        """
+        data: dict = dict()
+        batch: set = set()
+        start = not cut or self.option['start'] is None
+        limit = self.option['limit'] if cut else 0
+        is_url = _url_pattern.match
+        for url in hrefs:
+            if not url or '#' in url or url in self.info_dict or url in data:
+                continue
+            dns = bool(is_url(url))
+            if dns:
+                target_url: str = url
+            else:
+                target_url: str = urljoin(cwd_url, url)
+                if not is_url(target_url):
+                    continue
+            if not start:
+                if target_url.endswith(self.option['start']):
+                    start = True
+                else:
+                    continue
+            if target_url in batch:
+                continue
+            if cut:
+                if target_url in self.seen:
+                    if self.seen[target_url] != url:
+                        self.aliases[url] = target_url
+                    continue
+                if any(rule(target_url) for rule in self.rules):
+                    continue
+            if self.option['debug']:
+                self.log(20, f"found '{target_url}'")
+            if self.is_ok is not None and not self.is_ok(target_url):
+                self.log(30, f'{target_url} is prohibited by robots.txt')
+                continue
+            if dns:
+                # 新しいホストは裏で名前解決を始めておき、結果はリクエストを送る前に確認する
+                hostname = parser.get_hostname(target_url)
+                if not hostname:
+                    continue
+                if hostname not in self.hosts:
+                    if self.option['debug']:
+                        self.log(20, f"querying the DNS server for '{hostname}' now...")
+                    dns_cache.open().prefetch(hostname)
+                    self.hosts.add(hostname)
+            data[url] = target_url
+            batch.add(target_url)
+            if cut:
+                self.seen[target_url] = url
+                if 0 < limit <= len(data):
+                    break
+        return data
 
-    def __exit__(self, *_):
-        with open(cache.configfile, 'w') as f:
-            json.dump(self._caches, f)
+    def resolve_aliases(self, WebSiteData: dict) -> None:
+        """
+        既出のURLを別の書き方で参照していた参照元にも、同じ保存先を割り当てる
+        """
+        for url, target_url in self.aliases.items():
+            first = self.seen[target_url]
+            if url not in WebSiteData and first in WebSiteData:
+                WebSiteData[url] = WebSiteData[first]
 
-class history:
+class path_converter:
     """
-    ダウンロード履歴関連の関数を定義するクラス
-    基本的に./history配下のファイルのみ操作
+    HTMLの属性値がダウンロードしたURLと完全に一致する場合だけ、保存先のパスに置き換えるクラス
+    属性値を一度の走査で取り出して辞書で引くので、URLの数に関係なくファイルの大きさに比例した時間で終わる
     """
-    if _binary:
-        root = os.path.join(_prop_directory, 'history')
-    else:
-        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history')
-    def __init__(self, url: str):
-        self.domain = urlparse(url).hostname
-        self.history_file = os.path.join(history.root, self.domain+'.txt')
-        if not os.path.isdir(history.root):
-            os.mkdir(history.root)
-
-    def write(self, content: str or list, end: str = '\n') -> None:
-        if isinstance(content, list):
-            content: str  = '\n'.join(content)
-        if content in self.read():
-            return
-        with open(self.history_file, 'a') as f:
-            f.write(content+end)
-
-    def read(self) -> set:
-        if os.path.isfile(self.history_file):
-            with open(self.history_file, 'r') as f:
-                return set(f.read().rstrip().splitlines())
-        else:
-            return set()
+    _shared = None # 子プロセスで使うpath_converter
+
+    def __init__(self, conversion_urls: dict):
+        self.table: dict = {from_: to for from_, to in conversion_urls.items() if isinstance(from_, str) and from_ and isinstance(to, str)}
+
+    def _replace(self, match) -> str:
+        equal, double, single, bare = match.groups()
+        value = double if double is not None else single if single is not None else bare
+        to = self.table.get(value)
+        if to is None and '&' in value:
+            to = self.table.get(html.unescape(value))
+        if to is None:
+            return match.group(0)
+        if double is not None:
+            return f'{equal}"{to}"'
+        elif single is not None:
+            return f"{equal}'{to}'"
+        elif any(c.isspace() for c in to):
+            return f'{equal}"{to}"'
+        return equal+to
+
+    def convert(self, source: str) -> str:
+        return _attribute_pattern.sub(self._replace, source)
+
+    def convert_file(self, path: str) -> None:
+        # utf-8以外で保存された文書もそのままのバイト列で書き戻す
+        with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+            source: str = self.convert(f.read())
+        with open(path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write(source)
+
+    @classmethod
+    def _init(cls, table: dict) -> None:
+        cls._shared = cls(table)
+
+    @classmethod
+    def _run(cls, paths: list) -> list:
+        """
+        pathsを変換し、失敗したファイルの(パス, エラー)のリストを返す(子プロセスで実行される)
+        標準入力は使えないので、失敗しても聞き直さずに次のファイルへ進む
+        """
+        errors: list = []
+        for path in paths:
+            try:
+                cls._shared.convert_file(path)
+            except Exception as e:
+                errors.append((path, f'{type(e).__name__}: {e}'))
+        return errors
 
 class parser:
     """
@@ -243,7 +1953,9 @@ class parser:
     def __init__(self, option, log, *, dl=None):
         self.option = option
         self.log = log
-        self.parser = self.option['parser']
+        self.backend = parser_backend(self.option['parser'])
+        self.parser = self.backend.name
+        self.tree_parser = self.backend.tree
         self.dl = dl
 
     @staticmethod
@@ -253,7 +1965,7 @@ class parser:
         """
         if parser.is_url(url):
             result = urlparse(url)
-            return result.scheme+'://'+result.hostname
+            return result.scheme+'://'+result.hostname+(f':{result.port}' if result.port else '')
         else:
             return None
 
@@ -264,8 +1976,7 @@ class parser:
         else:
             host = url
         if host:
-            i = socket.getaddrinfo(host, None)
-            return i
+            return dns_cache.open().resolve(host)
         else:
             raise gaierror()
 
@@ -311,15 +2022,74 @@ class parser:
         """
         引数に渡された文字列がURLか判別
         """
-        return bool(re.match(r"https?://[\w!\?/\+\-_~=;\.,\*&@#\$%\(\)'\[\]]+", url))
+        return bool(_url_pattern.match(url))
 
-    def html_extraction(self, source: bytes or str, words: dict) -> str:
-        data = bs(source, self.parser)
+    def search(self, source: bytes or str, words: dict) -> list:
+        """
+        -sの条件に合う要素のリスト(BeautifulSoupで整形したもの)
+        CSSセレクタ以外はダウンロードしながら探す場合(stream_extraction)と同じくtag_extractorで探す
+        """
         if 'css' in words:
-            code: list = data.select(words.get('css'), limit=self.option.get('limit') or None)
-        else:
-            code: list = data.find_all(name=words.get('tags'), attrs=words['words'], limit=self.option.get('limit') or None)
-        return '\n\n'.join(map(str, code))
+            return list(map(str, self.backend.select(source, words.get('css'), self.option.get('limit'))))
+        if isinstance(source, bytes):
+            source = self.backend.decode(source)
+        return list(tag_extractor.extract((source,), words, self.option.get('limit')))
+
+    @profiler.timed('parse')
+    def html_extraction(self, source: bytes or str, words: dict) -> str:
+        return '\n\n'.join(self.search(source, words))
+
+    @staticmethod
+    def worker_count(option) -> int:
+        """
+        HTMLを解析する子プロセスの数(--parse-workers, 指定がなければコア数)
+        0の場合とコアが一つの場合は子プロセスを使わない
+        """
+        workers = option['parse_workers']
+        if workers is None:
+            workers = os.cpu_count() or 1
+            workers = workers if 1 < workers else 0
+        return max(0, workers)
+
+    @staticmethod
+    def charset(response) -> str or None:
+        """
+        Content-Typeで指定されている文字コード(指定がなければNone)
+        """
+        return response.encoding if 'charset' in response.headers.get('content-type', '').lower() else None
+
+    @staticmethod
+    def iter_text(response, chunk_size: int=tag_extractor.chunk_size):
+        """
+        レスポンスの本文を読んだ分ずつ文字列にするジェネレータ
+        文字コードはContent-Typeのcharset, 最初のチャンクのmetaタグ, utf-8の順で決める
+        """
+        encoding = parser.charset(response)
+        decoder = None
+        for chunk in response.iter_content(chunk_size):
+            if decoder is None:
+                encoding = encoding or EncodingDetector.find_declared_encoding(chunk, is_html=True) or 'utf-8'
+                try:
+                    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+                except LookupError:
+                    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            yield decoder.decode(chunk)
+        if decoder is not None:
+            yield decoder.decode(b'', final=True)
+
+    def stream_extraction(self, response, words: dict):
+        """
+        レスポンスを読みながら-sの条件に合う要素を見つけた順に返すジェネレータ
+        limit個見つかったら残りの本文は読まずに接続を閉じる
+        CSSセレクタの場合は本文を全て読んでからhtml_extractionで探す
+        """
+        try:
+            if 'css' in words:
+                yield self.html_extraction(response.content, words)
+            else:
+                yield from tag_extractor.extract(self.iter_text(response), words, self.option.get('limit'))
+        finally:
+            response.close()
 
     def is_success_status(self, returncode):
         if 200 <= returncode < 400:
@@ -329,76 +2099,30 @@ class parser:
             self.log(40, '{}: {}'.format(returncode, parser.status_messages.get(returncode, "unknown")))
             return False
 
-    def delay_check(self):
+    def delay_check(self, pool, host):
         """
         指定されているインターバルがrobots.txtのcrawl_delayの数値以上か判定
-        もしcrawl_delayの数値より少なかったらインターバルをcrawl_delayの数値に置き換える
+        もしcrawl_delayの数値より少なかったらそのホストのインターバルをcrawl_delayの数値に置き換える
         """
         delay = self.robots.delay()
         if delay is not None and self.option['interval'] < delay:
-            self.log(30, f"it changed interval because it was shorter than the time stated in robots.txt  '{self.option['interval']}' => '{delay}'")
-            self.option['interval'] = delay
+            self.log(30, f"it changed interval of '{host}' because it was shorter than the time stated in robots.txt  '{self.option['interval']}' => '{delay}'")
+            pool.set_delay(host, delay)
 
-    def _cut(self, list, get, cwd_url, response, root_url, downloaded, is_ok, info_dict, cut=True):
-        data: dict = dict()
-        did_host: set = set()
-        dns = False
-        start = self.option['start'] is None
-        for tag in list:
-            if isinstance(get, str):
-                url: str = tag.get(get)
-            else:
-                for g in get:
-                    url = tag.get(g)
-                    if url:
-                        break
-                else:
-                    continue
-                url = url
-            if not url or '#' in url or url in info_dict:
-                continue
-            if self.is_url(url):
-                target_url: str = url
-                dns = True
-            else:
-                target_url: str = urljoin(cwd_url, url)
-                if not self.is_url(target_url):
-                    continue
-            if cut and not start:
-                if target_url.endswith(self.option['start']):
-                    start = True
-                else:
-                    continue
-            if cut and ((self.option['noparent'] and (not target_url.startswith(response.url) and target_url.startswith(root_url))) or target_url in set(data.values()) or ((target_url.startswith(cwd_url) and  '#' in target_url) or (self.option['no_dl_external'] and not target_url.startswith(root_url)))):
-                continue
-            if cut and (self.option['download_name'] not in target_url or (self.option['no_downloaded'] and target_url in downloaded)):
-                continue
-            if self.option['debug']:
-                self.log(20, f"found '{target_url}'")
-            if self.option['save_robots'] and not is_ok(url):
-                self.log(30, f'{target_url} is prohibited by robots.txt')
-                continue
-            if dns:
-                try:
-                    hostname = self.get_hostname(target_url)
-                    if hostname not in did_host:
-                        if not hostname:
-                            raise gaierror()
-                        if self.option['debug']:
-                            self.log(20, f"querying the DNS server for '{hostname}' now...")
-                        i = self.query_dns(hostname)
-                except gaierror:
-                    self.log(30, f"skiped {target_url} because there was no response from the DNS server")
-                    continue
-                except:
-                    pass
-                finally:
-                    dns = False
-                    did_host.add(hostname)
-            data[url] = target_url
-            if cut and 0 < self.option['limit'] <= len(data):
-                break
-        return data
+    @staticmethod
+    def _links(datas) -> dict:
+        """
+        BeautifulSoupのツリーからaタグ, rel=stylesheetのlinkタグ, imgタグの参照先を抽出
+        """
+        return {
+            'a': [tag.get('href') for tag in datas.find_all('a')],
+            'stylesheet': [tag.get('href') for tag in datas.find_all('link', rel='stylesheet')],
+            'img': [tag.get('src') or tag.get('data-lazy-src') or tag.get('data-src') for tag in datas.find_all('img')]
+        }
+
+    @profiler.timed('parse')
+    def _extract_links(self, source: bytes or str, encoding: str=None) -> dict:
+        return self.backend.links(source, encoding)
 
     def _get_count(self):
         files = list(filter(lambda p: bool(re.match(re.escape(self.option['formated']).replace(r'%\(num\)d', r'\d+').replace(r'%\(file\)s', '.*').replace(r'%\(ext\)s', '.*'), p)), os.listdir()))
@@ -413,18 +2137,205 @@ class parser:
             return max(num)+1
         return 0
 
+    @profiler.timed('network')
+    def _fetch(self, url: str, session, headers: dict, spool: str):
+        """
+        urlにGETリクエストを送る(ワーカースレッドで実行される)
+        本文はメモリに溜めずにspoolの一時ファイルへ書き出し、(レスポンス, 一時ファイルのパス)を返す
+        失敗した場合はNoneを返す
+        """
+        try:
+            self.query_dns(url)
+        except gaierror:
+            self.log(30, f"skiped {url} because there was no response from the DNS server")
+            if metrics.open() is not None:
+                metrics.open().skipped(url, 'gaierror')
+            return None
+        # 送り直しはsessionにマウントしたretry_policyが行う
+        self.log(20, f"request start: '{url}'")
+        try:
+            res: requests.models.Response = session.get(url, timeout=self.option['timeout'], proxies=self.option['proxy'], headers=headers, verify=self.option['ssl'], stream=True)
+        except Exception as e:
+            self.log(30, e)
+            if self.option['debug']:
+                self.log(20, f"didn't response '{url}'")
+            return None
+        if not self.is_success_status(res.status_code):
+            res.close()
+            return None
+        fd, path = tempfile.mkstemp(dir=spool)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in res.iter_content(65536):
+                    f.write(chunk)
+        except Exception as e:
+            os.remove(path)
+            self.log(30, e)
+            if self.option['debug']:
+                self.log(20, f"didn't response '{url}'")
+            return None
+        finally:
+            res.close()
+        if self.option['debug']:
+            tqdm.write(f"response speed: {res.elapsed.total_seconds()}s [{os.path.getsize(path)} bytes data]", file=sys.stderr)
+        return res, path
+
+    @staticmethod
+    def _spill(body: bytes, spool: str) -> str:
+        """
+        保存しないページの本文を次の階層まで一時ファイルに退避
+        """
+        fd, path = tempfile.mkstemp(suffix='.html', dir=spool)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        return path
+
+    @staticmethod
+    def _read_page(path: str, spool: str) -> bytes:
+        """
+        次の階層で解析するページを読み直す(一時ファイルは読んだら削除する)
+        """
+        with open(path, 'rb') as f:
+            source = f.read()
+        if os.path.dirname(path) == spool:
+            os.remove(path)
+        return source
+
+    @profiler.timed('info')
+    def _save_info(self, WebSiteData: dict) -> None:
+        if os.path.isdir('styles'):
+            with open(os.path.join('styles', '.prop_info.json'), 'w') as f:
+                json.dump(WebSiteData, f, indent=4, ensure_ascii=False)
+
+    @staticmethod
+    def _parse_file(path: str, backend: str, remove: bool, encoding: str=None) -> dict:
+        """
+        保存したページ(または一時ファイル)を読み直してリンクを抽出する(解析用の子プロセスで実行される)
+        本文は渡さずにパスだけを渡す
+        """
+        with open(path, 'rb') as f:
+            source = f.read()
+        if remove:
+            os.remove(path)
+        return parser_backend(backend).links(source, encoding)
+
+    def _parse_executor(self):
+        """
+        ページを解析する子プロセスのプール
+        子プロセスを使わない場合は、このスレッドで解析する(nullcontextを返す)
+        """
+        self.parse_workers = self.worker_count(self.option)
+        if self.parse_workers < 1:
+            return contextlib.nullcontext()
+        # 他のスレッドが動いている中でforkしないようにspawnで起動する
+        return ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    @staticmethod
+    @profiler.timed('parse')
+    def _wait_parsed(future) -> dict:
+        return future.result()
+
+    def _parsed(self, pages: list, spool: str, executor):
+        """
+        ページを(参照元URL, 抽出したリンク)として順に返すジェネレータ
+        executorがあれば、子プロセスで先の(子プロセスの数の2倍までの)ページを解析しておく
+        """
+        if executor is None:
+            for path, cwd_url, encoding in pages:
+                yield cwd_url, self._extract_links(self._read_page(path, spool), encoding)
+            return
+        window = collections.deque()
+        pages = iter(pages)
+        while True:
+            for path, cwd_url, encoding in itertools.islice(pages, max(0, 2*self.parse_workers - len(window))):
+                window.append((cwd_url, executor.submit(parser._parse_file, os.path.abspath(path), self.parser, os.path.dirname(path) == spool, encoding)))
+            if not window:
+                return
+            cwd_url, future = window.popleft()
+            yield cwd_url, self._wait_parsed(future)
+
+    def _load_styles(self, link_data: dict, pool, session, headers: dict, spool: str, WebSiteData: dict) -> None:
+        """
+        rel=stylesheetのlinkタグの参照先をstylesディレクトリに保存(キャッシュがあればそれを使う)
+        """
+        os.mkdir('styles')
+        self.log(20, 'loading stylesheets...')
+        before_fmt = self.dl.option['formated']
+        self.dl.option['formated'] = os.path.join('styles', '%(file)s')
+        styles: dict = dict()
+        caches = cache.open()
+        for from_url, target_url in link_data.items():
+            che = caches.get_cache(target_url)
+            if che:
+                with open(che, 'rb') as f:
+                    result = self.dl.recursive_download(target_url, f.read())
+                self.log(20, f"using cache instead of downloading '{target_url}'")
+                WebSiteData[from_url] = result
+                # --update-cacheでstylesディレクトリのファイルを更新するためにURLでも引けるようにする
+                WebSiteData.setdefault(target_url, result)
+            else:
+                styles[from_url] = target_url
+        for from_url, target_url, fetched in tqdm(pool.map(self._fetch, styles, session, headers, spool), total=len(styles), leave=False, desc="'stylesheets'"):
+            if fetched is None:
+                continue
+            res, body = fetched
+            result = self.dl.recursive_download(res.url, body, spooled=True)
+            if result:
+                with open(result, 'rb') as f:
+                    caches.put(target_url, f.read(), 'style', res.headers)
+            WebSiteData[from_url] = result
+            WebSiteData.setdefault(target_url, result)
+            self._save_info(WebSiteData)
+        self._save_info(WebSiteData)
+        self.dl.option['formated'] = before_fmt
+
+    def _stylesheets(self, parsed, links_filter: link_filter, pool, session, spool: str, WebSiteData: dict):
+        """
+        最初のページのrel=stylesheetの参照先を、そのページのリンクへのリクエストを始める前に保存する
+        (_jobsの中で読み込むとfetch_pool.streamがその間止まるので、別の段階にする)
+        最初のページを戻した解析結果を返す
+        """
+        first = next(parsed, None)
+        if first is None:
+            return parsed
+        cwd_url, links = first
+        link_data: dict = links_filter.filter(links['stylesheet'], cwd_url, cut=False) # rel=stylesheetのlinkタグを抽出
+        self._load_styles(link_data, pool, session, dict(self.option['header'], Referer=cwd_url), spool, WebSiteData)
+        return itertools.chain([first], parsed)
+
+    def _jobs(self, parsed, links_filter: link_filter, session, spool: str, bar):
+        """
+        解析したページのリンクを絞り込み、リクエストする((タグ, 参照元), URL, fetchの引数)を順に返すジェネレータ
+        fetch_pool.streamが空きのある分だけ読むので、解析はリクエストより先に進みすぎない
+        """
+        for cwd_url, links in parsed:
+            # cwd_urlはaタグの参照先に./~~が出てきたときに連結させるURL
+            if self.option['body']:
+                a_data: dict = links_filter.filter(links['a'], cwd_url) #aタグ抽出
+            else:
+                a_data: dict = dict()
+            if self.option['content']:
+                img_data: dict = links_filter.filter(links['img'], cwd_url) # imgタグ抽出
+            else:
+                img_data: dict = dict()
+            headers = dict(self.option['header'], Referer=cwd_url)
+            bar.total += len(a_data) + len(img_data)
+            for from_url, target_url in a_data.items():
+                yield ('a', from_url), target_url, (session, headers, spool)
+            for from_url, target_url in img_data.items():
+                yield ('img', from_url), target_url, (session, headers, spool)
+
     def spider(self, response, *, h=sys.stdout, session):
         """
         HTMLからaタグとimgタグの参照先を抽出し保存
+        リクエストはfetch_poolでホストごとに並列に送り、保存はメインスレッドで行う
         """
-        temporary_list: list = []
-        temporary_list_urls: list = []
         if '%(num)d' in self.option['formated']:
             count = self._get_count()
         else:
-            count = 0          
-        max = self.option['interval']+3
+            count = 0
         info_file = os.path.join('styles', '.prop_info.json')
+        pages: list = []
         if self.option['no_downloaded']:
             downloaded: set = h.read()
         else:
@@ -432,8 +2343,11 @@ class parser:
         if (not os.path.isfile(os.path.join('styles', '.prop_info.json'))) and self.option['body'] and not self.option['start'] and not self.option['check_only'] and not (self.option['no_downloaded'] and response.url.rstrip('/') in downloaded):
             root = self.dl.recursive_download(response.url, response.text, count)
             count += 1
+            if root:
+                # response.textで保存したのでutf-8
+                pages = [(root, response.url, 'utf-8')]
             WebSiteData: dict = {response.url: root}
-            h.write(response.url.rstrip('/'))
+            h.write(response.url.rstrip('/'), response.status_code, len(response.content))
         elif self.option['check_only']:
             WebSiteData: dict = {response.url: response.url}
         else:
@@ -443,203 +2357,400 @@ class parser:
                 WebSiteData.update(json.load(f))
         root_url: str = self.get_rootdir(response.url)
         # ↑ホームURLを取得
-        cwd_urls = [response.url]
-        # ↑リクエストしたURLを取得
-        # aタグの参照先に./~~が出てきたときにこの変数の値と連結させる
-        if self.option['debug']:
-            self.log(20, 'checking robots.txt...')
-        try:
-            self.robots = Parse(root_url, requests=True, headers=self.option['header'], proxies=self.option['proxy'], timeout=self.option['timeout'])
-            is_ok = self.robots.can_crawl
-            self.delay_check()
-        except NotFoundError:
-            is_ok = lambda *_: True
+        # 次の階層で解析するページは本文ではなく(保存先のパス, URL)で持ち、解析するときに読み直す
+        # 保存しないページは一時ディレクトリに書き出しておく
+        with fetch_pool(self.option, session=session) as pool, tempfile.TemporaryDirectory(prefix='prop-') as spool, self._parse_executor() as executor:
+            if not pages:
+                pages = [(self._spill(response.content, spool), response.url, self.charset(response))]
             if self.option['debug']:
-                self.log(20, 'robots.txt was none')
-        source = [response.content]
-        print(f"\033[36mhistories are saved in '{h.history_file}'\033[0m", file=sys.stderr)
-        for n in range(self.option['recursive']):
-            for source, cwd_url in zip(source, cwd_urls):
-                datas = bs(source, self.parser)
-                if self.option['body']:
-                    a_data: dict = self._cut(datas.find_all('a'), 'href', cwd_url, response, root_url, downloaded, is_ok, WebSiteData) #aタグ抽出
-                    link_data: dict = self._cut(datas.find_all('link', rel='stylesheet'), "href", cwd_url, response, root_url, downloaded, is_ok, WebSiteData, cut=False) # rel=stylesheetのlinkタグを抽出
-                if self.option['content']:
-                    img_data: dict = self._cut(datas.find_all('img'), ['src', 'data-lazy-src', 'data-src'], cwd_url, response, root_url, downloaded, is_ok, WebSiteData) # imgタグ抽出
-                self.option['header']['Referer'] = cwd_url
-                if self.option['body']:
-                    if not os.path.isdir('styles') and not self.option['check_only']:
-                        os.mkdir('styles')
-                        self.log(20, 'loading stylesheets...')
-                        before_fmt = self.dl.option['formated']
-                        self.dl.option['formated'] = os.path.join('styles', '%(file)s')
-                        for from_url, target_url in tqdm(link_data.items(), leave=False, desc="'stylesheets'"):
-                            with cache(target_url, self) as caches:
-                                che = caches.get_cache(target_url)
-                                if che:
-                                    result = os.path.join('styles', os.path.basename(che))
-                                    shutil.copy(che, result)
-                                    self.log(20, f"using cache instead of downloading '{target_url}'") 
-                                else:
-                                    for i in range(self.option['reconnect']+1):
-                                        try:
-                                            if i == 0:
-                                                self.log(20, f"request start: '{target_url}'")
-                                            else:
-                                                self.log(20, f"retrying {i}")
-                                            res: requests.models.Response = session.get(target_url, timeout=self.option['timeout'], proxies=self.option['proxy'], headers=self.option['header'], verify=self.option['ssl'])
-                                            if not self.is_success_status(res.status_code):
-                                                break
-                                            if self.option['debug']:
-                                                tqdm.write(f"response speed: {res.elapsed.total_seconds()}s [{len(res.content)} bytes data]", file=sys.stderr)
-                                            res.close()
-                                            result = self.dl.recursive_download(res.url, res.content)
-                                            caches.save(target_url, res.content)
-                                            break
-                                        except Exception as e:
-                                            if i >= self.option['reconnect']-1:
-                                                self.log(30, e)
-                                            sleep(1)
-                                            continue
-                                WebSiteData[from_url] = result
-                                if os.path.isdir('styles'):
-                                    with open(info_file, 'w') as f:
-                                        json.dump(WebSiteData, f, indent=4, ensure_ascii=False)
-                        self.dl.option['formated'] = before_fmt
-                    for from_url, target_url in tqdm(a_data.items(), leave=False, desc="'a tag'"):
-                        for i in range(self.option['reconnect']+1):
-                            try:
-                                if i == 0:
-                                    self.log(20, f"request start: '{target_url}'")
-                                else:
-                                    self.log(20, f"retrying {i}...")
-                                res: requests.models.Response = session.get(target_url, timeout=self.option['timeout'], proxies=self.option['proxy'], headers=self.option['header'], verify=self.option['ssl'])
-                                if not self.is_success_status(res.status_code):
-                                    break
-                                temporary_list.append(res.content)
-                                temporary_list_urls.append(res.url)
-                                h.write(target_url)
-                                if self.option['debug']:
-                                    tqdm.write(f"response speed: {res.elapsed.total_seconds()}s [{len(res.content)} bytes data]", file=sys.stderr)
-                                res.close()
-                                if self.option['check_only']:
-                                    WebSiteData[target_url] = 'Exists' if self.is_success_status(res.status_code) else 'Not'
-                                else:
-                                    result = self.dl.recursive_download(res.url, res.content, count)
-                                    count += 1
-                                    WebSiteData[from_url] = result
-                                    if os.path.isdir('styles'):
-                                        with open(info_file, 'w') as f:
-                                            json.dump(WebSiteData, f, indent=4, ensure_ascii=False)
-                                break
-                            except Exception as e:
-                                if i >= self.option['reconnect']-1:
-                                    self.log(30, e)
-                                sleep(1)
-                                continue
-                        else:
-                            if self.option['debug']:
-                                self.log(20, f"didn't response '{target_url}'")
+                self.log(20, 'checking robots.txt...')
+            try:
+                self.robots = robotsparsetools.Parse(root_url, requests=True, headers=self.option['header'], proxies=self.option['proxy'], timeout=self.option['timeout'])
+                self.delay_check(pool, self.get_hostname(root_url))
+            except robotsparsetools.NotFoundError:
+                self.robots = None
+                if self.option['debug']:
+                    self.log(20, 'robots.txt was none')
+            links_filter = link_filter(self.option, self.log, response.url, root_url, downloaded=downloaded, info_dict=WebSiteData, robots=self.robots)
+            print(f"\033[36mhistories are saved in '{h.history_file}'\033[0m", file=sys.stderr)
+            for n in range(self.option['recursive']):
+                next_pages: list = []
+                # 解析(子プロセス) -> リクエスト(fetch_poolのスレッド) -> 保存(このスレッド)の順に流し、各段階の間で先に進める数は限る
+                parsed = self._parsed(pages, spool, executor)
+                if self.option['body'] and not os.path.isdir('styles') and not self.option['check_only']:
+                    parsed = self._stylesheets(parsed, links_filter, pool, session, spool, WebSiteData)
+                with tqdm(total=0, leave=False, desc="'a tag, img tag'") as bar:
+                    jobs = self._jobs(parsed, links_filter, session, spool, bar)
+                    for (tag, from_url), target_url, fetched in pool.stream(self._fetch, jobs):
+                        bar.update(1)
+                        if fetched is None:
                             continue
-                        sleep(round(uniform(self.option['interval'], max), 1))
-                if self.option['content']:
-                    for from_url, target_url in tqdm(img_data.items(), leave=False, desc="'img tag'"):
-                        for i in range(self.option['reconnect']):
-                            try:
-                                if i == 0:
-                                    self.log(20, f"request start: '{target_url}'")
-                                else:
-                                    self.log(20, f"retrying {i}")
-                                res: requests.models.Response = session.get(target_url, timeout=self.option['timeout'], proxies=self.option['proxy'], headers=self.option['header'], verify=self.option['ssl'])
-                                h.write(target_url)
-                                if not self.is_success_status(res.status_code):
-                                    break
-                                if self.option['debug']:
-                                    tqdm.write(f"response speed: {res.elapsed.total_seconds()}s [{len(res.content)} bytes data]", file=sys.stderr)
-                                res.close()
-                                if self.option['check_only']:
-                                    WebSiteData[target_url] = 'Exists' if self.is_success_status(res.status_code) else 'Not'
-                                else:
-                                    result = self.dl.recursive_download(res.url, res.content, count)
-                                    count += 1
-                                    WebSiteData[from_url] = result
-                                    if os.path.isdir('styles'):
-                                        with open(info_file, 'w') as f:
-                                            json.dump(WebSiteData, f, indent=4, ensure_ascii=False)
-                                break
-                            except Exception as e:
-                                if i >= self.option['reconnect']-1:
-                                    self.log(30, e)
-                                continue
+                        # 本文は一時ファイルに書き出されているので、保存先へ移すか次の階層までそのまま置いておく
+                        res, body = fetched
+                        h.write(target_url, res.status_code, os.path.getsize(body))
+                        if self.option['check_only']:
+                            WebSiteData[target_url] = 'Exists'
+                            result = None
                         else:
-                            if self.option['debug']:
-                                self.log(20, f"didn't response '{target_url}'")
-                        sleep(round(uniform(self.option['interval'], max), 1))
-            cwd_urls = temporary_list_urls
-            temporary_list_urls: list = []
-            source = temporary_list
-            temporary_list: list = []
-            if self.option['debug']:
-                self.log(20, f'{n+1} hierarchy... '+'\033[32m'+'done'+'\033[0m')
+                            result = self.dl.recursive_download(res.url, body, count, spooled=True)
+                            count += 1
+                            WebSiteData[from_url] = result
+                            self._save_info(WebSiteData)
+                        if tag == 'a' and n+1 < self.option['recursive']:
+                            next_pages.append((result or body, res.url, self.charset(res)))
+                        elif os.path.isfile(body):
+                            os.remove(body)
+                pages = next_pages
+                if self.option['debug']:
+                    self.log(20, f'{n+1} hierarchy... '+'\033[32m'+'done'+'\033[0m')
+            if not self.option['check_only']:
+                links_filter.resolve_aliases(WebSiteData)
         if self.option['check_only']:
             for k, v in WebSiteData.items():
                 print('{}  ... {}{}\033[0m'.format(k, '\033[32m' if v == 'Exists' else '\033[31m', v))
             sys.exit()
-        elif os.path.isdir('styles'):
-            with open(info_file, 'w') as f:
-                json.dump(WebSiteData, f, indent=4, ensure_ascii=False)
+        else:
+            self._save_info(WebSiteData)
         return WebSiteData
 
+class aggregate_progress:
+    """
+    並列にダウンロードしている全てのファイルの進み具合を一つのtqdmにまとめるクラス
+    ファイルごとにpartを作り、そのupdateで全体のバイト数を進める
+    """
+    class _part:
+        def __init__(self, progress: 'aggregate_progress', length, initial: int=0):
+            self.progress = progress
+            self.n = initial
+            self.length = int(length) if length else 0
+            progress.add(self.length, initial)
+
+        def update(self, n: int) -> None:
+            self.n += n
+            self.progress.update(n)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *_):
+            pass
+
+    def __init__(self, files: int=None):
+        self.files = files # Noneなら数が決まっていない
+        self.done = 0
+        self.started = time()
+        self._lock = threading.Lock()
+        self.bar = tqdm(total=0, unit='B', unit_scale=True)
+
+    def part(self, length, initial: int=0) -> 'aggregate_progress._part':
+        return aggregate_progress._part(self, length, initial)
+
+    def add(self, length: int, initial: int=0) -> None:
+        """
+        レスポンスのContent-Lengthが分かった時点で全体の大きさに足す
+        """
+        with self._lock:
+            self.bar.total += length
+            self.bar.update(initial)
+
+    def update(self, n: int) -> None:
+        with self._lock:
+            self.bar.update(n)
+
+    def finish(self) -> None:
+        with self._lock:
+            self.done += 1
+            files = self.done if self.files is None else f'{self.done}/{self.files}'
+            self.bar.set_postfix_str(f'{files} files, {self.done / max(time() - self.started, 1e-6):.1f} files/s')
+
+    def close(self) -> None:
+        self.bar.close()
+
+class segmented_download:
+    """
+    Rangeリクエストで大きいファイルを複数の区間に分け、並列にダウンロードするクラス
+    区間ごとの進み具合は<保存先>.prop-partに記録し、中断しても次回は残りの範囲だけをダウンロードする
+    """
+    # これより小さいファイルは分割しない
+    min_size = 4*1048576
+    # 進み具合を記録する間隔(秒)
+    save_interval = 1.0
+
+    class range_changed(Exception):
+        """
+        サーバーが区間を返さなくなった(送り直しても続きは取れない)
+        """
+
+    def __init__(self, dl, response, path: str):
+        self.dl = dl
+        self.option = dl.option
+        self.url = response.url
+        self.path = path
+        self.state_file = path+'.prop-part'
+        self.length = int(response.headers['content-length'])
+        etag = response.headers.get('etag')
+        # If-Rangeに使えるのは強いETagかLast-Modifiedだけ
+        self.validator = etag if etag and not etag.startswith('W/') else response.headers.get('last-modified')
+        self._lock = threading.Lock()
+        self._saved = 0.0
+
+    @staticmethod
+    def supported(response, segments: int) -> bool:
+        if segments < 2 or response.status_code != 200 or getattr(response, 'from_cache', False):
+            return False
+        if 'bytes' not in response.headers.get('accept-ranges', '').lower() or response.headers.get('content-encoding'):
+            return False
+        try:
+            return segmented_download.min_size <= int(response.headers.get('content-length', 0))
+        except ValueError:
+            return False
+
+    def _load(self) -> list or None:
+        """
+        同じファイルを途中までダウンロードした記録があれば区間のリストを返す
+        """
+        if not (os.path.isfile(self.state_file) and os.path.isfile(self.path) and os.path.getsize(self.path) == self.length):
+            return None
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            return None
+        if state.get('url') != self.url or state.get('length') != self.length or state.get('validator') != self.validator:
+            return None
+        return state['segments']
+
+    def _save(self, segments: list, force: bool=False) -> None:
+        if not force and time() - self._saved < self.save_interval:
+            return
+        self._saved = time()
+        temp = self.state_file+'.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'url': self.url, 'length': self.length, 'validator': self.validator, 'segments': segments}, f)
+        os.replace(temp, self.state_file)
+
+    @profiler.timed('save')
+    def _fetch(self, segment: list, segments: list, progress) -> None:
+        """
+        区間[start, end]の残りをダウンロードして、保存先の同じ位置に書き込む(ワーカースレッドで実行される)
+        segmentは[start, end, ダウンロード済みのバイト数]
+        """
+        for i in range(self.option['reconnect']+1):
+            start, end, done = segment
+            if end < start+done:
+                return
+            headers = dict(self.option['header'], Range=f'bytes={start+done}-{end}')
+            if self.validator:
+                headers['If-Range'] = self.validator
+            try:
+                with self.dl.session.get(self.url, cookies=self.option['cookie'], auth=self.option['auth'], timeout=self.option['timeout'], proxies=self.option['proxy'], headers=headers, verify=self.option['ssl'], stream=True) as r:
+                    if r.status_code != 206:
+                        raise self.range_changed(f'{r.status_code}: the server stopped returning the range (the file may have been changed)')
+                    with open(self.path, 'r+b') as f:
+                        f.seek(start+done)
+                        for b in r.iter_content(chunk_size=65536):
+                            n = f.write(b[:end+1-start-segment[2]])
+                            with self._lock:
+                                segment[2] += n
+                                progress.update(n)
+                                self._save(segments)
+                if start+segment[2] <= end:
+                    # urllib3 1.xはContent-Lengthより短い本文をエラーにしない
+                    raise urllib3.exceptions.ProtocolError(f'the range ended at {start+segment[2]-1}')
+                return
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                # 本文の途中で切れた場合はretry_policyでは送り直されないので、残りの範囲をここで取り直す
+                if i >= self.option['reconnect'] or not self.dl.retries.take():
+                    raise
+                self.log(30, f"retrying the range {start+segment[2]}-{end} of '{self.url}' ({e})")
+                sleep(retry_policy.backoff(i+1))
+
+    def log(self, level, msg):
+        self.dl.log(level, msg)
+
+    def run(self, count: int) -> int:
+        """
+        count個の区間に分けてダウンロードし、ファイルの大きさを返す
+        """
+        segments = self._load()
+        if segments is None:
+            size = math.ceil(self.length / count)
+            segments = [[start, min(start+size, self.length)-1, 0] for start in range(0, self.length, size)]
+            with open(self.path, 'wb') as f:
+                f.truncate(self.length)
+        else:
+            self.log(20, f"resuming '{self.path}'")
+        self._save(segments, force=True)
+        try:
+            done = sum(s[2] for s in segments)
+            with (self.dl.progress.part(self.length, done) if self.dl.progress else tqdm(total=self.length, initial=done, unit="B", unit_scale=True)) as progress, ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                for future in [executor.submit(self._fetch, segment, segments, progress) for segment in segments]:
+                    future.result()
+        finally:
+            with self._lock:
+                self._save(segments, force=True)
+        os.remove(self.state_file)
+        return self.length
+
 class downloader:
     """
     再帰ダウンロードやリクエスト&パースする関数を定義するクラス
     start_download以降の関数は再帰ダウンロード関連の関数
     """
+    conversion_threshold = 16777216 # 変換するHTMLの合計がこれ以上(バイト)なら子プロセスを使う(子プロセスを起動する時間の方が長くならないように)
+    conversion_batch = 8 # 子プロセスに一度に渡すHTMLの数
+
     def __init__(self, url: str, option, parsers='html.parser'):
         self.url = url # リスト
-        self.parser: str = parsers
         self.option = option
         self.session = requests.Session()
+        if self.option['metrics']:
+            metrics.install()
+        self.retries = retry_budget(self.option['retry_budget'])
+        if self.option['http_cache']:
+            retry_policy.mount(self.session, self.option, self.retries, cache_adapter, http_cache(limit=self.option['cache_size']*1048576))
+        else:
+            retry_policy.mount(self.session, self.option, self.retries)
+        # 複数のURLを指定した場合の間隔(スロットリングされるまでは待たない)
+        self.limiter = rate_limiter(dict(option, interval=0))
+        self.limiter.watch(self.session)
         logger = logging.getLogger('Log of Prop')
         self.log = logger.log
         self.parse = parser(self.option, self.log, dl=self)
+        self.parser: str = parser_backend(parsers).tree
+        # -Pで並列にダウンロードしているときのまとめたプログレスバー
+        self.progress: aggregate_progress = None
+        # ダウンロードに失敗したURLと理由
+        self.failures: list = []
+        # 区間に分けたダウンロードが途中で失敗したファイル(.prop-partから再開できる)
+        self.incomplete: list = []
+        # 最後にファイルへ保存したレスポンスのステータスコード, 保存先, バイト数(--stdinの結果に使う)
+        self.result: dict = None
 
     def start(self) -> None:
         """
-        URLに対してリスエストを送る前準備と実行
+        URLに対してリスエストを送る前準備と実行
+        """
+        methods: dict = {'get': self.session.get, 'post': self.session.post, 'put': self.session.put, 'delete': self.session.delete}
+        instance: requests = methods.get(self.option['types'])
+        if self.option['debug']:
+            self.log(20, """
+request urls: {}
+\033[35m[settings]\033[0m
+{}
+            """.format(self.url, '\n'.join([f'\033[34m{k}\033[0m: {v}' for k, v in self.option.items()])))
+        resolver = dns_cache.open()
+        for url in self.url:
+            # 後のURLのホストは裏で先に名前解決しておく
+            if self.parse.get_hostname(url):
+                resolver.prefetch(self.parse.get_hostname(url))
+        if 1 < self.option['parallel'] and 1 < len(self.url) and self.option['filename'] and not self.option['recursive'] and not self.option['check_only']:
+            self.start_parallel(instance)
+            return
+        for url in self.url:
+            self._start(url, instance)
+
+    def _start(self, url: str, instance) -> None:
+        try:
+            hostname = self.parse.get_hostname(url)
+            if not hostname:
+                self.log(40, f"'{url}' is not url")
+                self.failures.append((url, 'not url'))
+                return
+            if self.option['debug']:
+                self.log(20, f"querying the DNS server for '{hostname}' now...")
+            i = self.parse.query_dns(hostname)
+            self.limiter.acquire(hostname)
+            if self.option['debug']:
+                self.log(20, f"request start {url} [{i[0][-1][0]}]")
+            self.request(url, instance)
+        except gaierror:
+            self.log(20, f"skiped '{url}' because there was no response from the DNS server")
+            self.failures.append((url, 'no response from the DNS server'))
+            if metrics.open() is not None:
+                metrics.open().skipped(url, 'gaierror')
+        except Exception as e:
+            if self.option['caperror']:
+                self.log(40, f'\033[31m{str(e)}\033[0m')
+            self.failures.append((url, str(e)))
+
+    def start_stdin(self) -> None:
+        """
+        標準入力からURLを一行ずつ読み続け、-Pで指定された数まで同時にダウンロードする
+        実行中のURLが多いときは読むのを待ち、終わったURLから結果を一行のJSONとして標準出力に書き出す
+        """
+        methods: dict = {'get': self.session.get, 'post': self.session.post, 'put': self.session.put, 'delete': self.session.delete}
+        instance: requests = methods.get(self.option['types'])
+        workers = max(1, self.option['parallel'])
+        resolver = dns_cache.open()
+        lock = threading.Lock()
+        def output(future):
+            with lock:
+                print(json.dumps(future.result(), ensure_ascii=False), flush=True)
+                self.progress.finish()
+        self.progress = aggregate_progress(None)
+        running: set = set()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for line in sys.stdin:
+                    url = line.strip()
+                    if not url:
+                        continue
+                    url = complete_url(url)
+                    if self.parse.get_hostname(url):
+                        resolver.prefetch(self.parse.get_hostname(url))
+                    if workers*2 <= len(running):
+                        running = wait(running, return_when=FIRST_COMPLETED).not_done
+                    future = executor.submit(self._start_record, url, instance)
+                    future.add_done_callback(output)
+                    running.add(future)
+        finally:
+            self.progress.close()
+            self.progress = None
+
+    def _start_record(self, url: str, instance) -> dict:
+        """
+        一つのURLをダウンロードして、その結果を返す(--stdinで使う)
+        """
+        dl = self.fork([url], dict(self.option))
+        dl.failures = []
+        started = time()
+        dl._start(url, instance)
+        record: dict = {'url': url, 'ok': not dl.failures}
+        record.update(dl.result or {})
+        if dl.failures:
+            record['error'] = dl.failures[0][1]
+        record['elapsed'] = round(time() - started, 3)
+        return record
+
+    def start_parallel(self, instance) -> None:
+        """
+        -Pで指定された数までのURLを同時にダウンロードし、進み具合は一つのバーにまとめて表示する
+        失敗したURLは最後にまとめて表示する(途中で止めない)
         """
-        methods: dict = {'get': self.session.get, 'post': self.session.post, 'put': self.session.put, 'delete': self.session.delete}
-        instance: requests = methods.get(self.option['types'])
-        if self.option['debug']:
-            self.log(20, """
-request urls: {}
-\033[35m[settings]\033[0m
-{}
-            """.format(self.url, '\n'.join([f'\033[34m{k}\033[0m: {v}' for k, v in self.option.items()])))
-        for url in self.url:
-            try:
-                hostname = self.parse.get_hostname(url)
-                if not hostname:
-                    self.log(40, f"'{url}' is not url")
-                    continue
-                if self.option['debug']:
-                    self.log(20, f"querying the DNS server for '{hostname}' now...")
-                i = self.parse.query_dns(hostname)
-                if self.option['debug']:
-                    self.log(20, f"request start {url} [{i[0][-1][0]}]")
-                self.request(url, instance)
-            except gaierror:
-                self.log(20, f"skiped '{url}' because there was no response from the DNS server")
-                continue
-            except Exception as e:
-                if self.option['caperror']:
-                    self.log(40, f'\033[31m{str(e)}\033[0m')
-                continue
-
+        self.progress = aggregate_progress(len(self.url))
+        try:
+            with ThreadPoolExecutor(max_workers=self.option['parallel']) as executor:
+                # URLごとにformatedなどを書き換えるので、オプションはURLごとに複製する
+                futures = [executor.submit(self.fork(self.url, dict(self.option))._start, url, instance) for url in self.url]
+                for future in as_completed(futures):
+                    future.result()
+                    self.progress.finish()
+        finally:
+            self.progress.close()
+            self.progress = None
+        for url, reason in self.failures:
+            tqdm.write(f"\033[31mfailed: {url} ({reason})\033[0m", file=sys.stderr)
+        self.log(20, f'{len(self.url)-len(self.failures)}/{len(self.url)} files downloaded')
+
+    @profiler.timed('network')
     def request(self, url: str, instance) -> str or List[requests.models.Response, str]:
         self.option['formated']: str = self.option['format'].replace('%(root)s', self.parse.get_hostname(url))
         if self.option['types'] != 'post':
-            r: requests.models.Response = instance(url, params=self.option['payload'], allow_redirects=self.option['redirect'], cookies=self.option['cookie'], auth=self.option['auth'], timeout=self.option['timeout'], proxies=self.option['proxy'], headers=self.option['header'], verify=self.option['ssl'], stream=True)
+            # そのままファイルに保存する本文はHTTPキャッシュに二重に持たない
+            saving = self.option['filename'] and not (self.option['recursive'] or self.option['search'] or self.option['only_body'] or self.option['info'])
+            with http_cache.no_store() if saving else contextlib.nullcontext():
+                r: requests.models.Response = instance(url, params=self.option['payload'], allow_redirects=self.option['redirect'], cookies=self.option['cookie'], auth=self.option['auth'], timeout=self.option['timeout'], proxies=self.option['proxy'], headers=self.option['header'], verify=self.option['ssl'], stream=True)
         else:
             if self.option['upload']:
                 name, form = self.option['upload']
@@ -656,11 +2767,13 @@ request urls: {}
         if self.option['debug'] and not self.option['info']:
             print(f'\n\033[35m[response headers]\033[0m\n\n'+'\n'.join([f'\033[34m{k}\033[0m: {v}' for k, v in r.headers.items()])+'\n', file=sys.stderr)
         if not self.parse.is_success_status(r.status_code):
+            self.failures.append((url, '{}: {}'.format(r.status_code, parser.status_messages.get(r.status_code, 'unknown'))))
+            self.result = {'status': r.status_code}
             return
         if self.option['check_only'] and not self.option['recursive']:
             print(f'{url}  ... \033[32mExists\033[0m')
             return
-        h = history(r.url)
+        h = history.open(r.url)
         if self.option['recursive']:
             if self.option['filename'] is os.path.basename:
                 self.option['filename']: str = '.'
@@ -682,13 +2795,18 @@ request urls: {}
             self._print(r, [r.headers], file=self.get_fmt(r))
             return
         elif self.option['search']:
-            result = self.parse.html_extraction(r.text, self.option['search'])
+            # 見つかった要素から書き出す(limit個見つかったらそこでダウンロードをやめる)
             save_filename = self.get_fmt(r)
-            if save_filename:
-                with open(save_filename, 'w') as f:
-                    f.write(result)
-            else:
-                print(result)
+            f = open(save_filename, 'w') if save_filename else sys.stdout
+            try:
+                for i, code in enumerate(self.parse.stream_extraction(r, self.option['search'])):
+                    f.write('\n\n'+code if i else code)
+                    f.flush()
+                if not save_filename:
+                    f.write('\n')
+            finally:
+                if save_filename:
+                    f.close()
             return
         elif self.option['only_body']:
             try:
@@ -705,15 +2823,23 @@ request urls: {}
         length = r.headers.get('content-length')
         save_filename = self.get_fmt(r)
         if save_filename:
-            if length:
+            if self.option['types'] == 'get' and segmented_download.supported(r, self.option['segments']):
+                r.close()
+                try:
+                    size = segmented_download(self, r, save_filename).run(self.option['segments'])
+                except Exception:
+                    self.incomplete.append(save_filename)
+                    raise
+            elif length:
                 with open(save_filename, 'wb') as f:
-                    self.save(f.write, length, r)
+                    size = self.save(f.write, length, r)
             else:
                 with open(save_filename, 'wb') as f:
-                    f.write(r.content)
+                    size = f.write(r.content)
         else:
-            self.save(tqdm.write, length, r)
-        h.write(r.url)
+            size = self.save(tqdm.write, length, r)
+        h.write(r.url, r.status_code, size)
+        self.result = {'status': r.status_code, 'file': save_filename, 'size': size}
 
     def get_fmt(self, r):
         if self.option['filename']:
@@ -727,11 +2853,15 @@ request urls: {}
         else:
             return None
 
-    def save(self, write, length, r):
+    @profiler.timed('save')
+    def save(self, write, length, r) -> int:
+        """
+        レスポンスの本文を書き出し、書き出したバイト数を返す
+        """
         if write == tqdm.write:
             try:
                 if 1048576 <= int(length) and not self.ask_continue("The output will be large, but they will be printed to stdout.\nContinue?"):
-                    return
+                    return 0
             except:
                 pass
             with tqdm(total=int(length) if length else None, unit="B", unit_scale=True) as p:
@@ -739,10 +2869,11 @@ request urls: {}
                     write(b.decode(errors='backslashreplace'), end='')
                     p.update(len(b))
         else:
-            with tqdm(total=int(length) if length else None, unit="B", unit_scale=True) as p:
+            with (self.progress.part(length) if self.progress else tqdm(total=int(length) if length else None, unit="B", unit_scale=True)) as p:
                 for b in r.iter_content(chunk_size=16384):
                     write(b)
                     p.update(len(b))
+        return p.n
 
     def _print(self, response, output=None, file=None) -> None:
         if file:
@@ -773,10 +2904,6 @@ request urls: {}
             sys.stdout.close()
             sys.stdout = sys.__stdout__
 
-    def _split_list(self, array, N):
-        n = math.ceil(len(array) / N)
-        return [array[index:index+n] for index in range(0, len(array), n)]
-
     def start_conversion(self, info: tuple) -> None:
         """
         ファイルパス変換をスタートする
@@ -786,24 +2913,31 @@ request urls: {}
             self.local_path_conversion(info)
             self.log(20, 'convert... '+'\033[32m' + 'done' + '\033[0m')
 
-    def recursive_download(self, url: str, source: bytes or str, number: int=0) -> str:
+    @profiler.timed('save')
+    def recursive_download(self, url: str, source: bytes or str, number: int=0, *, spooled: bool=False) -> str:
         """
         HTMLから見つかったファイルをダウンロード
+        spooledの場合、sourceは本文を書き出した一時ファイルのパスで、保存先にコピーして一時ファイルは消す
+        (mkstempの一時ファイルは0600なので、移動せずに普通に作ったファイルへコピーする)
         """
         exts = self.parse.splitext(self.parse.delete_query(url))
         # フォーマットを元に保存ファイル名を決める
         save_filename: str = self.option['formated'].replace('%(file)s', ''.join(self.parse.splitext(self.parse.get_filename(url)))).replace('%(num)d', str(number)).replace('%(ext)s', exts[1].lstrip('.'))
         if os.path.isfile(save_filename) and not self.ask_continue(f'{save_filename} has already existed\nCan I overwrite?'):
+            if spooled:
+                os.remove(source)
             return save_filename
         while True:
             try:
-                if isinstance(source, str):
+                if spooled:
+                    shutil.copyfile(source, save_filename)
+                    os.remove(source)
+                elif isinstance(source, str):
                     with open(save_filename, 'w') as f:
                         f.write(source)
                 else:
                     with open(save_filename, 'wb') as f:
                         f.write(source)
-                sleep(0.5)
                 break
             except Exception as e:
                 # エラーがでた場合、Warningログを表示し続けるか標準入力を受け取る[y/n]
@@ -816,41 +2950,42 @@ request urls: {}
             self.log(20, f'saved: {url} => {os.path.abspath(save_filename)}')
         return save_filename
 
+    @profiler.timed('conversion')
     def local_path_conversion(self, conversion_urls) -> None:
-        if self.option['conversion'] and self.option['body']:
-            if self.option['multiprocess']:
-                to_path = list(conversion_urls.values())
-                splited_path_list = self._split_list(to_path, 4) # 4分割
-                processes: list = []
-                for path in splited_path_list[1:]:
-                    # 分けた内3つをサブプロセスで変換する
-                    # 残り一つはメインプロセスで変換
-                    p = Process(target=self.conversion_path, args=(path, conversion_urls, self.option['formated']))
-                    p.start()
-                    processes.append(p)
-                try:
-                    self.conversion_path(splited_path_list[0], conversion_urls, self.option['formated'])
-                finally:
-                    for n, p in enumerate(processes):
-                        # 作成した全てのサブプロセスの終了を待つ
-                        p.join()
-                        self.log(20, f'#{n+1}'+'\033[32m'+'done'+'\033[0m')
-            else:
-                self.conversion_path(list(conversion_urls.values()), conversion_urls, self.option['formated'])
+        """
+        保存したHTMLの参照先をローカルのパスに変換する
+        HTMLの合計がconversion_threshold以上か-mの場合は、コア数の子プロセスにconversion_batch個ずつ渡して変換する(空いた子プロセスが次を取る)
+        URLとパスの対応は子プロセスごとに一度だけ渡す
+        """
+        if not (self.option['conversion'] and self.option['body']):
+            return
+        paths: list = [path for path in dict.fromkeys(conversion_urls.values()) if isinstance(path, str) and path.endswith('.html')]
+        workers = min(os.cpu_count() or 1, math.ceil(len(paths) / self.conversion_batch))
+        if workers < 2 or not (self.option['multiprocess'] or self.conversion_threshold <= sum(os.path.getsize(path) for path in paths if os.path.isfile(path))):
+            self.conversion_path(paths, conversion_urls, self.option['formated'])
+            return
+        converter = path_converter(conversion_urls)
+        done, failures = 0, 0
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=path_converter._init, initargs=(converter.table,)) as executor:
+            futures: dict = {executor.submit(path_converter._run, paths[i:i+self.conversion_batch]): min(self.conversion_batch, len(paths)-i) for i in range(0, len(paths), self.conversion_batch)}
+            for future in as_completed(futures):
+                for path, e in future.result():
+                    failures += 1
+                    self.log(30, f"failed to convert '{path}' ({e})")
+                done += futures[future]
+                if self.option['debug']:
+                    self.log(20, f'converted {done}/{len(paths)} files')
+        self.log(20, f'converted {done-failures} files in {workers} processes'+(f' ({failures} failed)' if failures else ''))
 
     def conversion_path(self, task, all_download_data, save_fmt: str) -> None:
         # URL変換
+        converter = path_converter(all_download_data)
         for path in task:
             while True:
                 try:
-                    if not path.endswith('.html'):
+                    if not isinstance(path, str) or not path.endswith('.html'):
                         break
-                    with open(path, 'r') as f:
-                        source: str = f.read()
-                    for from_, to in all_download_data.items():
-                        source = source.replace(from_, to)
-                    with open(path, 'w') as f:
-                        f.write(source)
+                    converter.convert_file(path)
                     if self.option['debug']:
                         self.log(20, f"converted '{path}'")
                     break
@@ -864,7 +2999,7 @@ request urls: {}
     def ask_continue(self, msg) -> bool:
         while True:
             print(f'{msg}[y/N]:  ', file=sys.stderr, end='')
-            answer = sys.stdin.readline()
+            res = sys.stdin.readline().strip().lower()
             if res in {'y', 'n', 'yes', 'no'}:
                 break
             print('\033[1A\r', end='')
@@ -874,6 +3009,639 @@ request urls: {}
         sys.stderr.flush()
         return res in {'y', 'yes'}
 
+    def fork(self, url: list, option) -> 'downloader':
+        """
+        セッション(クッキー, 接続プール, 再試行の回数)とレート制限を共有し、URLとオプションだけが違うdownloaderを作る
+        """
+        dl = copy.copy(self)
+        dl.url = url
+        dl.option = option
+        dl.parse = parser(option, self.log, dl=dl)
+        dl.parser = dl.parse.tree_parser
+        return dl
+
+class batch:
+    """
+    -Rで指定されたファイルの各行をコマンドラインとして実行するクラス
+    ファイルは一行ずつ読みながら実行し、全ての行でセッションを共有する
+    独立した行は-wで指定された数(指定がなければ1)まで同時に実行し、セッションの状態を変える行(ログインなど)や同時に実行できない行は、それまでの行が終わってから単独で実行する
+    失敗した行はログに出して次の行に進み、最後に失敗した行があったかを返す
+    """
+    def __init__(self, option, log):
+        self.option = option
+        self.log = log
+        self.dl: downloader = None
+
+    @staticmethod
+    def exclusive(url: list, option) -> bool:
+        """
+        単独で実行する必要がある行か判定
+        (GET以外のリクエストやデータを送るリクエスト, クッキー, アップロード, 標準入力や標準出力を使う, 作業ディレクトリを移動する再帰ダウンロード)
+        """
+        return option['types'] != 'get' or option['payload'] is not None or bool(option['cookie']) or bool(option['upload']) or '-' in url or not option['filename'] or bool(option['recursive'])
+
+    def _parse(self, number: int, line: str) -> tuple or None:
+        try:
+            url, _, option = argument(['prop']+_argsplit(line))
+        except SystemExit:
+            self.log(40, f"line {number}: skipped '{line}'")
+            return None
+        return [complete_url(link) for link in url], option
+
+    def _run(self, url: list, option) -> list:
+        """
+        一行を実行し、失敗したURLと理由のリストを返す
+        """
+        if self.dl is None:
+            self.dl = downloader(url, option, option['parser'])
+            dl = self.dl
+        else:
+            dl = self.dl.fork(url, option)
+        # forkしたdownloaderは失敗や未完成のファイルのリストも共有しているので、行ごとに分ける
+        dl.failures = []
+        dl.incomplete = []
+        dl.start()
+        return dl.failures + [(path, 'incomplete') for path in dl.incomplete]
+
+    def _check(self, number: int, future) -> bool:
+        """
+        終わった行の結果を受け取り、失敗していればログに出してFalseを返す
+        """
+        try:
+            failures = future.result()
+        except SystemExit as e:
+            # オプションの誤りなどはerror.printで表示済み
+            failures = [(None, f'exited with status {e.code}')]
+        except Exception as e:
+            failures = [(None, str(e) or repr(e))]
+        for url, reason in failures:
+            self.log(40, f'line {number}: {reason}' if url is None else f'line {number}: {url} ({reason})')
+        return not failures
+
+    def run(self, file: str) -> bool:
+        """
+        全ての行を実行し、全て成功したかを返す
+        """
+        workers = max(1, self.option['batch_workers'])
+        running: dict = dict() # 実行中の行 => 行番号
+        ok = True
+        with ThreadPoolExecutor(max_workers=workers) as executor, open(file, 'r') as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                parsed = self._parse(number, line)
+                if parsed is None:
+                    ok = False
+                    continue
+                url, option = parsed
+                if self.dl is None or self.exclusive(url, option):
+                    wait(running)
+                    for future in list(running):
+                        ok = self._check(running.pop(future), future) and ok
+                    future = executor.submit(self._run, url, option)
+                    wait([future])
+                    ok = self._check(number, future) and ok
+                    continue
+                # 実行中の行が多すぎる場合は、どれかが終わるまでファイルを読み進めない
+                if workers <= len(running):
+                    for future in wait(running, return_when=FIRST_COMPLETED).done:
+                        ok = self._check(running.pop(future), future) and ok
+                running[executor.submit(self._run, url, option)] = number
+            wait(running)
+            for future in list(running):
+                ok = self._check(running.pop(future), future) and ok
+        return ok
+
+class bulk_parse:
+    """
+    -pに渡されたディレクトリやglobのファイル、標準入力の複数の文書(-0でNUL区切り, --ndjsonで一行に一つのJSON)を子プロセスで解析するクラス
+    結果は終わった順に{"source": 元のパス, "result": 結果}のJSON Linesで書き出す
+    文書はbatch_size個ずつ子プロセスに渡し、渡したまま終わっていないものは子プロセスの数の2倍までにする
+    """
+    batch_size = 16
+    extensions = ('.html', '.htm', '.xhtml')
+    _parser = None # 子プロセスで使うparser
+
+    def __init__(self, option, log):
+        self.option = option
+        self.log = log
+
+    @staticmethod
+    def is_bulk(path: str) -> bool:
+        """
+        -pの引数が複数の文書(ディレクトリかglob)を指しているか
+        """
+        return os.path.isdir(path) or glob.has_magic(path)
+
+    @classmethod
+    def files(cls, path: str):
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    if file.lower().endswith(cls.extensions):
+                        yield os.path.join(root, file)
+        else:
+            for file in sorted(glob.iglob(path, recursive=True)):
+                if os.path.isfile(file):
+                    yield file
+
+    @staticmethod
+    def _split(stream, sep: bytes=b'\0', size: int=65536):
+        """
+        streamをsepで区切った文書を順に返す(空の文書は飛ばす)
+        """
+        pending: list = []
+        for chunk in iter(lambda: stream.read(size), b''):
+            *done, rest = chunk.split(sep)
+            for piece in done:
+                pending.append(piece)
+                document = b''.join(pending)
+                pending = []
+                if document:
+                    yield document
+            pending.append(rest)
+        document = b''.join(pending)
+        if document:
+            yield document
+
+    def documents(self, source: dict):
+        """
+        (元のパス, ファイルのパス, 本文)を順に返す(ファイルは子プロセスで読む)
+        """
+        if 'paths' in source:
+            for file in self.files(source['paths']):
+                yield file, file, None
+        elif self.option['delimiter'] == 'ndjson':
+            for n, line in enumerate(sys.stdin.buffer):
+                if not line.strip():
+                    continue
+                try:
+                    document = json.loads(line)
+                except ValueError as e:
+                    yield f'<stdin>:{n}', None, e
+                    continue
+                if isinstance(document, dict):
+                    yield document.get('source') or f'<stdin>:{n}', None, document.get('html') or ''
+                else:
+                    yield f'<stdin>:{n}', None, str(document)
+        else:
+            for n, document in enumerate(self._split(sys.stdin.buffer)):
+                yield f'<stdin>:{n}', None, document
+
+    @classmethod
+    def _init(cls, option) -> None:
+        cls._parser = parser(option, None)
+
+    @classmethod
+    def _run(cls, documents: list) -> list:
+        """
+        文書を解析して結果のリストを返す(子プロセスで実行される)
+        """
+        records: list = []
+        option = cls._parser.option
+        for source, path, body in documents:
+            try:
+                if isinstance(body, Exception):
+                    raise body
+                if path is not None:
+                    with open(path, 'rb') as f:
+                        body = f.read()
+                if option['search']:
+                    result = cls._parser.search(body, option['search'])
+                else:
+                    result = cls._parser.backend.soup(body).text
+                records.append({'source': source, 'result': result})
+            except Exception as e:
+                records.append({'source': source, 'error': f'{type(e).__name__}: {e}'})
+        return records
+
+    def run(self, source: dict) -> None:
+        if not self.option['search'] and not self.option['only_body']:
+            error.print('Please specify what to extract with -s or -Y')
+        option = dict(self.option, parse=None)
+        workers = parser.worker_count(option)
+        documents = self.documents(source)
+        batches = iter(lambda: list(itertools.islice(documents, self.batch_size)), [])
+        output = open(self.option['filename'], 'w') if self.option['filename'] else sys.stdout
+        count: list = [0, 0]
+        def write(records: list) -> None:
+            for record in records:
+                output.write(json.dumps(record, ensure_ascii=False)+'\n')
+            output.flush()
+            count[0] += len(records)
+            count[1] += sum('error' in record for record in records)
+        try:
+            if workers < 1:
+                self._init(option)
+                for chunk in batches:
+                    write(self._run(chunk))
+            else:
+                running: set = set()
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=bulk_parse._init, initargs=(option,)) as executor:
+                    for chunk in batches:
+                        if 2*workers <= len(running):
+                            done, running = wait(running, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                write(future.result())
+                        running.add(executor.submit(bulk_parse._run, chunk))
+                    for future in as_completed(running):
+                        write(future.result())
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.log(20, f'parsed {count[0]} documents ({count[1]} errors)')
+
+@_lazy.deferred
+def benchmark_handler():
+    class benchmark_handler(http_server.BaseHTTPRequestHandler):
+        """
+        benchmark_serverが返す擬似的なサイト
+        /p<n>.htmlはfanout個のページと1個の画像(/a<n>.bin)へのリンクを含むページ、/large.binはRangeリクエストに対応した大きいファイル
+        """
+        protocol_version = 'HTTP/1.1'
+        # /large.binの中身(この1MBを繰り返す)
+        block = bytes(range(256))*4096
+
+        def setup(self):
+            super().setup()
+            # ヘッダーと本文を別々に書き込むので、Nagleアルゴリズムで遅れないようにする
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_GET(self):
+            site: dict = self.server.site
+            if site['latency']:
+                sleep(site['latency'])
+            path = urlparse(self.path).path
+            page = re.fullmatch(r'/p(\d+)\.html', path)
+            asset = re.fullmatch(r'/a(\d+)\.bin', path)
+            if page and int(page.group(1)) < site['pages']:
+                self._send(benchmark.site_page(int(page.group(1)), site).encode(), 'text/html')
+            elif asset:
+                self._send(self.block[:site['asset']] * (site['asset'] // len(self.block) + 1), 'application/octet-stream', site['asset'])
+            elif path == '/large.bin':
+                self._large(site['large']*1048576)
+            else:
+                self._send(b'', 'text/plain', status=404)
+
+        def _send(self, body: bytes, content_type: str, length: int=None, status: int=200) -> None:
+            body = body[:length] if length is not None else body
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _large(self, length: int) -> None:
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            start, end = 0, length-1
+            if match:
+                start, end = int(match.group(1)), min(int(match.group(2) or length-1), length-1)
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{length}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end-start+1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', f'"large-{length}"')
+            self.end_headers()
+            position = start
+            while position <= end:
+                offset = position % len(self.block)
+                chunk = self.block[offset:offset+end-position+1]
+                self.wfile.write(chunk)
+                position += len(chunk)
+
+        def log_message(self, *_):
+            pass
+    return benchmark_handler
+
+
+@_lazy.deferred
+def benchmark_server():
+    class benchmark_server(http_server.ThreadingHTTPServer):
+        """
+        ベンチマーク用の擬似的なサイトを返すローカルのHTTPサーバー(別スレッドで動かす)
+        """
+        daemon_threads = True
+
+        def __init__(self, site: dict):
+            super().__init__(('127.0.0.1', 0), benchmark_handler)
+            self.site = site
+            self.url = f'http://127.0.0.1:{self.server_port}'
+
+        def __enter__(self):
+            threading.Thread(target=self.serve_forever, daemon=True).start()
+            return self
+
+        def __exit__(self, *_):
+            self.shutdown()
+            self.server_close()
+    return benchmark_server
+
+
+class benchmark:
+    """
+    擬似的なデータを使って各処理のスループットを計測するクラス(--benchmark)
+    各ケースは子プロセスで実行し、経過時間と最大RSSも記録する
+    ネットワークを使うケースはbenchmark_serverのローカルなサイトに対して実行するので、外部には接続しない
+    """
+    # 擬似的なサイトとデータの大きさ(--benchmarkにkey=valueで指定できる)
+    site: dict = {'pages': 200, 'fanout': 5, 'asset': 16384, 'latency': 0.002, 'depth': 4, 'size': 4, 'files': 200, 'large': 64, 'segments': 4, 'runs': 10}
+
+    def __init__(self, option, log):
+        self.option = dict(option, debug=False, save_robots=False, no_downloaded=False, download_name='', start=None, noparent=False, limit=0)
+        self.log = log
+        self.cases: dict = {'links': self.links, 'extract': self.extract, 'conversion': self.conversion, 'spider': self.spider, 'html_extraction': self.html_extraction, 'local_path_conversion': self.local_path_conversion, 'download': self.download, 'startup': self.startup, 'backends': self.backends}
+        self.site = dict(benchmark.site)
+
+    @staticmethod
+    def site_page(n: int, site: dict) -> str:
+        """
+        擬似的なサイトのn番目のページ
+        """
+        links = ''.join(f'<li><a href="p{(n*site["fanout"]+k+1) % site["pages"]}.html">page {k}</a></li>' for k in range(site['fanout']))
+        return f'<html><head><title>page {n}</title></head><body><h1>page {n}</h1><ul>{links}</ul><img src="a{n % 50}.bin"><p>{"lorem ipsum " * 100}</p></body></html>'
+
+    @staticmethod
+    def _page(n: int) -> str:
+        """
+        相対パス、絶対パス、外部サイト、重複を混ぜたn個のaタグを含むHTMLを生成
+        """
+        hrefs: list = []
+        for i in range(n):
+            kind = i % 4
+            if kind == 0:
+                hrefs.append(f'page{i}.html')
+            elif kind == 1:
+                hrefs.append(f'/dir{i % 50}/page{i}.html?q={i}')
+            elif kind == 2:
+                hrefs.append(f'https://external{i % 20}.example.org/{i}.html')
+            else:
+                hrefs.append(f'page{i // 2}.html')
+        return '<html><body>'+''.join(f'<a href="{h}">{i}</a>' for i, h in enumerate(hrefs))+'</body></html>'
+
+    def links(self, n: int=50000, rounds: int=5) -> dict:
+        """
+        1ページあたりn個のリンクの絞り込みにかかる時間を計測
+        """
+        cwd_url = 'https://www.example.com/dir0/index.html'
+        hrefs = parser._links(bs(self._page(n), 'html.parser'))['a']
+        start = time()
+        for _ in range(rounds):
+            link_filter(self.option, self.log, cwd_url, parser.get_rootdir(cwd_url)).filter(hrefs, cwd_url)
+        elapsed = time() - start
+        return {'links': n*rounds, 'seconds': round(elapsed, 3), 'links/s': round(n*rounds / elapsed)}
+
+    def extract(self, n: int=50000, rounds: int=3) -> dict:
+        """
+        n個のリンクを含むページからのリンク抽出を、BeautifulSoup(html.parser)とstreamで比較
+        """
+        source = self._page(n).encode()
+        result: dict = {'bytes': len(source)*rounds}
+        for name, func in (('html.parser', lambda: parser._links(bs(source, 'html.parser'))), ('stream', lambda: link_extractor.extract(source))):
+            start = time()
+            for _ in range(rounds):
+                func()
+            elapsed = time() - start
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result[f'{name} MB/s'] = round(len(source)*rounds / elapsed / 1048576, 2)
+            result[f'{name} peak MB'] = round(peak / 1048576, 1)
+        return result
+
+    @staticmethod
+    def _legacy_conversion(source: str, conversion_urls: dict) -> str:
+        """
+        以前のパス変換(URLごとにファイル全体をstr.replaceする)
+        """
+        for from_, to in conversion_urls.items():
+            source = source.replace(from_, to)
+        return source
+
+    def conversion(self, files: int=200, urls: int=2000, links: int=200) -> dict:
+        """
+        files個のページ(それぞれlinks個のリンクを含む)のパス変換を、urls個のURLについて以前の方法と比較
+        """
+        conversion_urls: dict = {f'https://www.example.com/dir{i % 50}/page{i}.html': f'page{i}.html' for i in range(urls)}
+        targets = list(conversion_urls)
+        pages = ['<html><body>'+''.join(f'<a href="{targets[(f*links+i) % urls]}">{i}</a><p>{"x"*200}</p>' for i in range(links))+'</body></html>' for f in range(files)]
+        size = sum(map(len, pages))
+        result: dict = {'files': files, 'urls': urls, 'bytes': size}
+        converter = path_converter(conversion_urls)
+        for name, func in (('legacy', lambda p: self._legacy_conversion(p, conversion_urls)), ('single-pass', converter.convert)):
+            start = time()
+            for page in pages:
+                func(page)
+            elapsed = time() - start
+            result[f'{name} seconds'] = round(elapsed, 3)
+            result[f'{name} MB/s'] = round(size / elapsed / 1048576, 2)
+        return result
+
+    @staticmethod
+    def _directory_size(path: str) -> (int, int):
+        """
+        ディレクトリ以下のHTMLファイルの数と全ファイルの合計サイズ
+        """
+        pages, size = 0, 0
+        for root, _, files in os.walk(path):
+            for file in files:
+                pages += file.endswith('.html')
+                size += os.path.getsize(os.path.join(root, file))
+        return pages, size
+
+    def _downloader(self, url: list, **option) -> downloader:
+        return downloader(url, dict(self.option, **option), self.option['parser'])
+
+    def spider(self, temp: str) -> dict:
+        """
+        擬似的なサイトを再帰ダウンロード(-r depth -I 0)してページ/秒とバイト/秒を計測
+        """
+        output = os.path.join(temp, 'spider')
+        with benchmark_server(self.site) as server:
+            dl = self._downloader([server.url+'/p0.html'], recursive=self.site['depth'], interval=0, http_cache=False, filename=output, output=False, body=True, content=True)
+            start = time()
+            dl.start()
+            elapsed = time() - start
+        pages, size = self._directory_size(output)
+        return {'pages': pages, 'bytes': size, 'seconds': round(elapsed, 3), 'pages/s': round(pages / elapsed, 1), 'MB/s': round(size / elapsed / 1048576, 2)}
+
+    def html_extraction(self, temp: str) -> dict:
+        """
+        size MBのページからclassで要素を探す(-s)時間を、BeautifulSoupのツリーからCSSセレクタで探す場合と比較
+        limit=5の場合は先頭の5個が見つかるまでの時間
+        """
+        block = ''.join(f'<div class="{"target" if i % 10 == 0 else "other"}"><a href="p{i}.html">{i}</a><p>{"lorem ipsum " * 10}</p></div>' for i in range(1000))
+        source = '<html><body>'+block*max(1, round(self.site['size']*1048576 / len(block)))+'</body></html>'
+        words: dict = {'words': {'class': ['target']}, 'tags': ['div']}
+        parse = parser(self.option, self.log)
+        result: dict = {'bytes': len(source)}
+        # ダウンロードしながら探す場合(stream_extraction)と同じく、chunk_sizeずつ渡す
+        stream = lambda: '\n\n'.join(tag_extractor.extract((source[i:i+tag_extractor.chunk_size] for i in range(0, len(source), tag_extractor.chunk_size)), words, parse.option['limit']))
+        cases = (('stream', None, stream), ('stream limit=5', 5, stream), ('BeautifulSoup', None, lambda: parse.html_extraction(source, {'css': 'div.target'})))
+        for name, limit, func in cases:
+            parse.option['limit'] = limit
+            start = time()
+            found = func().count('class="target"')
+            elapsed = time() - start
+            result[f'{name} found'] = found
+            result[f'{name} seconds'] = round(elapsed, 3)
+            if limit is None:
+                result[f'{name} MB/s'] = round(len(source) / elapsed / 1048576, 2)
+        return result
+
+    def local_path_conversion(self, temp: str) -> dict:
+        """
+        保存済みのfiles個のページ(再帰ダウンロードの結果と同じ形)のパス変換にかかる時間を計測
+        """
+        output = os.path.join(temp, 'conversion')
+        os.mkdir(output)
+        site = dict(self.site, pages=self.site['files'])
+        conversion_urls: dict = dict()
+        for n in range(site['pages']):
+            path = os.path.join(output, f'p{n}.html')
+            with open(path, 'w') as f:
+                f.write(self.site_page(n, site))
+            conversion_urls[f'p{n}.html'] = path
+            conversion_urls[f'a{n % 50}.bin'] = os.path.join(output, f'a{n % 50}.bin')
+        _, size = self._directory_size(output)
+        dl = self._downloader([], conversion=True, body=True, formated='%(file)s')
+        start = time()
+        dl.local_path_conversion(conversion_urls)
+        elapsed = time() - start
+        return {'files': site['pages'], 'bytes': size, 'seconds': round(elapsed, 3), 'MB/s': round(size / elapsed / 1048576, 2)}
+
+    def download(self, temp: str) -> dict:
+        """
+        large MBのファイルを一つダウンロード(区間に分けた場合とそうでない場合)してバイト/秒を計測
+        """
+        result: dict = {'bytes': self.site['large']*1048576}
+        with benchmark_server(dict(self.site, latency=0)) as server:
+            for segments in sorted({1, self.site['segments']}):
+                dl = self._downloader([server.url+'/large.bin'], filename=os.path.join(temp, f'large-{segments}.bin'), output=False, http_cache=False, segments=segments)
+                start = time()
+                dl.start()
+                elapsed = time() - start
+                if os.path.getsize(os.path.join(temp, f'large-{segments}.bin')) != result['bytes']:
+                    raise IOError(f'the downloaded file is broken ({segments} segments)')
+                result[f'{segments} segments seconds'] = round(elapsed, 3)
+                result[f'{segments} segments MB/s'] = round(self.site['large'] / elapsed, 2)
+        return result
+
+    def startup(self) -> dict:
+        """
+        propの起動にかかる時間(runs回の中央値と最小値)を計測
+        importだけの時間, --version, 設定を読んで終わる--log-fileと、importの直後に読み込まれている重いモジュールを記録する
+        """
+        heavy = ('requests', 'urllib3', 'bs4', 'tqdm', 'fake_useragent', 'robotsparsetools', 'http.server', 'sqlite3', 'multiprocessing')
+        code = 'import sys, time; start = time.perf_counter(); import prop.__main__; print(time.perf_counter() - start); print(",".join(m for m in %r if m in sys.modules))' % (heavy,)
+        commands: dict = {'import': [sys.executable, '-c', code], '--version': [sys.executable, '-m', 'prop', '--version'], '--log-file': [sys.executable, '-m', 'prop', '--log-file']}
+        result: dict = dict()
+        for name, command in commands.items():
+            times: list = []
+            for _ in range(max(1, self.site['runs'])):
+                start = time()
+                output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True).stdout.splitlines()
+                # importだけの時間は子プロセスの中で測る
+                times.append(float(output[0]) if name == 'import' else time() - start)
+                if name == 'import':
+                    result['imported'] = ','.join(output[1:]) or '-'
+            times.sort()
+            result[f'{name} ms'] = round(times[len(times) // 2]*1000, 1)
+            result[f'{name} min ms'] = round(times[0]*1000, 1)
+        return result
+
+    def backends(self) -> dict:
+        """
+        インストールされているパーサーごとに、擬似的なサイトのページからのリンク抽出とCSSセレクタでの検索(-s)のスループットを計測
+        CSSセレクタはコンパイルしたものを使い回す場合と、BeautifulSoupのselectで毎回渡す場合を比較する
+        """
+        sources = [self.site_page(n, self.site).encode() for n in range(self.site['pages'])]
+        size = sum(map(len, sources))
+        css = 'ul > li a[href$=".html"]'
+        result: dict = {'pages': len(sources), 'bytes': size, 'auto': parser_backend('auto').name}
+        for name in parser_backend.available():
+            backend = parser_backend(name)
+            cases = [('links', backend.links)]
+            if name != 'stream':
+                cases += [('select', lambda source: backend.select(source, css)), ('soup.select', lambda source: backend.soup(source).select(css))]
+            for case, func in cases:
+                # 最初の一回(モジュールの読み込み)は含めない
+                func(sources[0])
+                start = time()
+                for source in sources:
+                    func(source)
+                elapsed = time() - start
+                result[f'{name} {case} pages/s'] = round(len(sources) / elapsed, 1)
+                result[f'{name} {case} MB/s'] = round(size / elapsed / 1048576, 2)
+        return result
+
+    def _child(self, name: str, queue) -> None:
+        """
+        子プロセスでケースを一つ実行し、結果と最大RSSをqueueに入れる
+        履歴とキャッシュは一時ディレクトリに作り、ログと進み具合は表示しない
+        """
+        try:
+            with tempfile.TemporaryDirectory(prefix='prop-benchmark-') as temp:
+                history.root = os.path.join(temp, 'history')
+                history._stores.clear()
+                cache.root = os.path.join(temp, 'cache')
+                cache._store = None
+                logging.getLogger('Log of Prop').setLevel(logging.ERROR)
+                sys.stdout = sys.stderr = open(os.devnull, 'w')
+                start = time()
+                case = self.cases[name]
+                result: dict = case(temp) if name in {'spider', 'html_extraction', 'local_path_conversion', 'download'} else case()
+                result['wall seconds'] = round(time() - start, 3)
+                if resource is not None:
+                    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    # Linuxはキロバイト, macOSはバイト
+                    result['peak RSS MB'] = round(rss / (1048576 if sys.platform == 'darwin' else 1024), 1)
+            queue.put(result)
+        except BaseException as e:
+            queue.put({'error': repr(e)})
+
+    def parameters(self, params: list) -> list:
+        """
+        --benchmarkの引数のうちkey=valueを擬似的なサイトの設定にし、残りをケースの名前として返す
+        """
+        names: list = []
+        for param in params:
+            key, _, value = param.partition('=')
+            if not value:
+                names.append(param)
+            elif key in self.site:
+                try:
+                    self.site[key] = type(self.site[key])(value)
+                except ValueError:
+                    self.log(40, f"'{param}' is invalid value")
+            else:
+                self.log(40, f"'{key}' is unknown parameter")
+        return names
+
+    def run(self, names: list) -> dict:
+        results: dict = dict()
+        for name in self.parameters(names) or self.cases:
+            if name not in self.cases:
+                self.log(40, f"'{name}' is unknown benchmark")
+                continue
+            queue = Queue()
+            process = Process(target=self._child, args=(name, queue))
+            process.start()
+            results[name] = queue.get()
+            process.join()
+            print(f'\033[35m[{name}]\033[0m '+'  '.join(f'\033[34m{k}\033[0m: {v}' for k, v in results[name].items()), file=sys.stderr)
+        if self.option['filename']:
+            # バージョン間で比較できるように、環境と設定と一緒に保存する
+            with open(self.option['filename'], 'w') as f:
+                json.dump({'version': str(VERSION), 'python': platform.python_version(), 'platform': platform.platform(), 'time': round(time()), 'site': self.site, 'option': dict({k: self.option[k] for k in ('workers', 'host_workers', 'parse_workers')}, parser=parser_backend(self.option['parser']).name), 'results': results}, f, indent=4, ensure_ascii=False)
+            self.log(20, f"saved the results in '{self.option['filename']}'")
+        return results
+
 def tor(port=9050):
     return {'http': f'socks5://127.0.0.1:{port}', 'https': f'socks5://127.0.0.1:{port}'}
 
@@ -973,6 +3741,11 @@ $ prop -s tags=a limit=2 [URL]
 
 >>> Extract a tag from the top to the second
 
+Except for the css selector, the elements are searched while downloading (the found elements are output in order),
+so the download stops as soon as the specified number of elements are found
+The elements are output in the format of BeautifulSoup, and text= matches the text of the element
+With -p, the elements are searched and output in the same way
+
 Below is an example of attribute specification (there are others)
 
 class=class name
@@ -998,6 +3771,9 @@ No output error message even if an error occurs
 
 -R, --read-file [file path]
 Reads the URL to download from the specified file
+Lines run one at a time unless -w, --workers is given, in which case lines that download to files with GET run in parallel (up to -w),
+while lines that log in (POST, -d etc.), use cookies, print to stdout or download recursively run alone after the lines before them finish
+A line that fails is logged as "line N: error" and the next line is run, and prop exits with status 1 at the end
 
 -B, --basic-auth [user id] [password]
 Perform Basic authentication
@@ -1011,6 +3787,56 @@ You can specify the file to upload at the time of post (multiple files cannot be
 -D, --debug
 Display detailed information at the time of request
 
+-G, --segments [num]
+Download a large file (4MB or more) by dividing it into the specified number of ranges and downloading them in parallel
+It's used only when the output destination is a file and the server supports range requests (otherwise, it is downloaded normally)
+If the download is interrupted, only the remaining ranges are downloaded next time
+
+-P, --parallel [num]
+When multiple URLs are specified, download up to the specified number of them at the same time
+It's used only when the output destination is set by -o or -O (the progress of all files is shown in one bar)
+URLs that failed are listed at the end without stopping the other downloads
+
+--metrics [file path]
+Record the time of each request (DNS, connect and TLS, time to first byte, transfer), the bytes and the retries,
+and save the summary (percentiles, throughput per host, the slowest URLs and the number of errors) in the file at the end
+If the file name ends with .prom, it's saved in the Prometheus textfile format, otherwise it's saved as JSON
+
+--profile [file path]
+Measure the time spent in each phase (network, waiting for the rate limit, HTML parsing, saving files,
+rewriting styles/.prop_info.json and the path conversion) and save the breakdown as JSON in the file at the end
+"seconds" includes the nested phases and "self seconds" doesn't (the phases running in worker threads are added up)
+
+--cprofile
+Used with --profile, run cProfile on the main thread (where pages are parsed, saved and converted)
+and save the stats next to the file of --profile with the extension .pstats (Ex: python -m pstats prof.pstats)
+
+--tracemalloc
+Used with --profile, trace the memory allocations with tracemalloc and add the allocated MB of each phase,
+the peak and the lines that allocated the most memory to the breakdown (the run becomes slower)
+
+--stdin
+Keep reading URLs (one per line) from stdin and download them with up to -P, --parallel downloads at the same time
+The output destination must be set by -o (directory) or -O, and the result of each URL is printed to stdout as one line of JSON when it finishes
+Ex: cat urls.txt | prop --stdin -P 8 -o out | jq -r 'select(.ok | not) | .url'
+
+--max-rate [requests per second]
+Specify the maximum number of requests per second sent to the same host (the default is no limit other than the interval)
+When a server returns 429 or 503, requests to that host are slowed down (and paused while Retry-After says so),
+and they are sped up again toward this limit while the responses are healthy
+
+--retry-budget [num]
+Specify the maximum number of retries in one run (the default is 100)
+Requests are retried with exponential backoff only when the method is idempotent (not POST)
+and the connection failed or the status code is 408, 425, 429, 500, 502, 503 or 504
+The number of retries per request is set by "reconnect" in the config file
+
+--no-http-cache
+Don't use the HTTP cache
+Normally, responses of GET requests that have ETag or Last-Modified are stored in the cache directory,
+and when the same URL is requested again, only the headers are transferred if it hasn't been modified (304 Not Modified)
+The bodies of files saved as they are with -o or -O are not stored (their validators are still used if they were stored before)
+
 -----Below are the options related to recursive downloads-----
 
 -r, --recursive [Recursion count (optional)]
@@ -1072,14 +3898,29 @@ Specifies the interval for recursive downloads
 The default is 1 second
 
 -m, --multiprocess
-It use multi-thread processing when converting the URL reference destination of the downloaded
-What you do with multithreading The processing time is greatly reduced
-Recommended to specify
+Convert the URL references of the downloaded pages to local paths in processes (as many as the CPU cores) even if there are few pages
+The pages are handed to the processes a few at a time, so one large page doesn't hold up the others
+Processes are used automatically when the pages total 16MB or more
 
 -nd, --no-downloaded
 It don't download urls written in histories
 This option doesn't work properly if you delete the files under the {history_directory} (even if you delete it, it will be newly generated when you download it again)
 
+-w, --workers [num]
+Specify the number of requests sent at the same time during recursive downloads
+The default is 8
+With -R, it is also the number of lines run at the same time (the lines run one at a time unless -w is given)
+
+--host-workers [num]
+Specify the number of requests sent at the same time to the same host during recursive downloads
+The interval (-I, --interval option and Crawl-delay of robots.txt) is kept for each host
+The default is 1
+
+--parse-workers [num]
+Specify the number of processes that parse pages and extract links during recursive downloads
+Pages are parsed in these processes while the requests are sent and the files are saved, so parsing and waiting for the network overlap
+The default is the number of CPU cores (0 parses pages in the main process)
+
 -----The following special options-----
 
 -V, --version
@@ -1108,29 +3949,100 @@ Show the file which logs are written
 Show the directory which files which histories are written are stored
 
 --cache-directory
-Show the directory which caches(stylesheet) were stored
+Show the directory which caches(stylesheet and HTTP cache) were stored
+
+--cache-stats
+Show the number of entries, the total size, the hit rate and the bytes which weren't transferred thanks to the caches
+
+--cache-size [MB]
+Specify the upper limit of the total size of the caches
+If it's exceeded, the caches which weren't used for the longest time are removed
+The default is 1024
 
 -U, --upgrade
 Update the prop
 
+--benchmark [name...]
+Measure the throughput of the processing of prop with generated data
+If the name is omitted, all of the following are measured
+
+- links
+  Filtering links of recursive downloads (links/s)
+
+- extract
+  Extracting links from HTML with html.parser and stream (MB/s and peak memory)
+
+- conversion
+  Converting URL references to local paths, compared with the previous implementation (MB/s)
+
+- spider
+  Recursive download of a generated site served by a local server (pages/s, MB/s)
+
+- html_extraction
+  Searching elements of a large page with -s, compared with searching the tree of BeautifulSoup (MB/s)
+
+- local_path_conversion
+  Converting the saved pages of a recursive download (MB/s)
+
+- download
+  Downloading a large file with and without -G, --segments (MB/s)
+
+- startup
+  Starting prop (only importing, --version and --log-file) and the heavy modules loaded just by importing (ms)
+
+- backends
+  Extracting links and searching with a CSS selector for each installed parser, over the pages of the generated site (pages/s, MB/s)
+  The CSS selector is also searched with BeautifulSoup's select, which doesn't reuse the compiled selector
+
+Each case runs in a child process, and the wall time and peak RSS are also measured
+The generated site and data can be changed with key=value (the defaults are below)
+
+pages=200 fanout=5 asset=16384 latency=0.002 depth=4 size=4 files=200 large=64 segments=4 runs=10
+
+pages, fanout: the number of pages of the site (and of backends) and links per page
+asset: the size of the image of each page (bytes)
+latency: the delay of each response of the local server (seconds)
+depth: the level of the recursive download
+size: the size of the page of html_extraction (MB)
+files: the number of pages of local_path_conversion
+large, segments: the size of the file (MB) and the number of segments of download
+runs: the number of times of each command of startup
+
+If -o is specified, the results are saved in the file as JSON with the version and the environment
+Ex: prop --benchmark spider download pages=1000 latency=0.01 -o result.json
+
 --update-cache
 Update downloaded caches
+The caches are checked in parallel with conditional requests, and only the caches which were modified are updated
 And, if you use this option in the directory that 'styles' directory exists, files in the 'styles' directory will be also updated
 
--p, --parse [file path (optional)]
+-p, --parse [file path, directory or glob (optional)]
 Get HTML from file or standard input and parse it
 You can use the -s option to specify the search tag, class, and id
 If you specify a URL when you specify this option, an error will occur
+If a directory (the .html, .htm and .xhtml files in it) or a glob such as "site/**/*.html" is specified, all the documents are parsed in parallel processes (--parse-workers)
+The results are output as JSON Lines ({"source": path, "result": result}) in the order they finish
+-s or -Y is required in this case
+
+-0, --null
+Read multiple HTML documents separated by NUL characters from standard input with -p and parse them like a directory
+The source of each document is "<stdin>:[number]"
+
+--ndjson
+Read multiple HTML documents from standard input with -p, one JSON per line
+Each line is {"source": name, "html": HTML} or a JSON string of HTML
 
 [About parser and default settings]
 
-The default HTML parser is html.parser, but you can also use an external parser
-When using lxml
-(1) Enter "pip install lxml" to install lxml
-(2) Change the value of "parser" in {config_file} as follows
+The default HTML parser is "auto", which uses the fastest parser installed (lxml if it is installed, otherwise html.parser)
+To make it faster, enter "pip install lxml" to install lxml
+You can also choose the parser ("lxml", "html5lib", "html.parser") by changing the value of "parser" in {config_file} as follows
 {
     "parser": "lxml"
 }
+
+If you specify "stream" as the parser, recursive downloads collect links in one pass without building the tree of HTML
+It reduces the memory to parse large pages ("auto" is used for the other processing)
 You can also change the default settings by changing the contents of {config_file}
 Setting Example
 {
@@ -1166,9 +4078,17 @@ The options that can be changed are as follows
     "info": false,
     "multiprocess": false,
     "ssl": true,
-    "parser": "html.parser",
+    "parser": "auto",
     "no_dl_external": true,
-    "save_robots": true // this recommended to specify true
+    "save_robots": true, // this recommended to specify true
+    "workers": 8,
+    "host_workers": 1,
+    "http_cache": true,
+    "cache_size": 1024,
+    "segments": 1,
+    "max_rate": null,
+    "retry_budget": 100,
+    "parallel": 1
 }
 """.replace("{config_file}", setting.config_file).replace("{log_file}", setting.log_file).replace('{history_directory}', history.root))
 
@@ -1200,12 +4120,16 @@ def _argsplit(args):
             result.append(v.strip("'\""))
     return result
 
-def argument() -> (list, dict, logging.Logger.log):
+def argument(argv: list=None) -> (list, dict, logging.Logger.log):
+        arg = conversion_arg(sys.argv if argv is None else argv)
+        if arg[1:] in (['-V'], ['--version']):
+            # 設定ファイルの場所を調べる(importlib.metadata)必要もないので、すぐに終わる
+            print(VERSION)
+            sys.exit()
         option: setting = setting()
         option.config_load()
         skip: int = 1
         url: list = []
-        arg = conversion_arg(sys.argv)
         if len(arg) == 1:
             print("""
 prop <options> URL [URL...]
@@ -1266,7 +4190,7 @@ prop <options> URL [URL...]
                     _stderr = sys.stderr
                     with open(os.devnull, "w") as null:
                         sys.stderr = null
-                        ua = UserAgent()
+                        ua = fake_useragent.UserAgent()
                         sys.stderr = _stderr
                 except Exception as e:
                     sys.stderr = _stderr
@@ -1274,7 +4198,7 @@ prop <options> URL [URL...]
                 try:
                     fake = ua[arg[n+1]]
                     skip += 1
-                except (IndexError, FakeUserAgentError):
+                except (IndexError, fake_useragent.FakeUserAgentError):
                     fake = ua.random
                 option.options['header']['User-Agent'] = fake
             elif args == '-d' or args == '-H' or args == '--data' or args == '--header' or args == '-c' or args == '--cookie':
@@ -1358,22 +4282,16 @@ prop <options> URL [URL...]
                     file: str = arg[n+1]
                 except IndexError:
                     error.print(f"{args} [filepath]\nPlease specify value of '{args}'")
-                urls: list = []
-                options: list = []
-                with open(file, 'r') as f:
-                    instruct = list(filter(lambda s: s != '', f.read().splitlines()))
-                for n, a in enumerate(instruct):
-                    del sys.argv[1:]
-                    sys.argv.extend(_argsplit(a))
-                    url, log, option = argument()
-                    urls.append(url)
-                    options.append(option)
-                return urls, log, options
+                if not os.path.isfile(file):
+                    error.print(f"The existence couldn't be confirmed: {file}")
+                # 各行はmainでbatchが読みながら実行する
+                option.config('read_file', file)
+                skip += 1
             elif args == '-B' or args == '--basic-auth':
                 try:
                     user: str = arg[n+1]
                     password: str = arg[n+2]
-                    option.config('auth', HTTPBasicAuth(user, password))
+                    option.config('auth', requests.auth.HTTPBasicAuth(user, password))
                     skip += 2
                 except:
                     error.print(f"{args} [UserName] [Password]\nThe specifying the argument of the '{args}' option is incorrect")
@@ -1406,6 +4324,79 @@ prop <options> URL [URL...]
                     error.print(f"{args} [string]\nPlease specify value of '{args}'")
             elif args == '-np' or args == '--no-parent':
                 option.config('noparent', True)
+            elif args == '-G' or args == '--segments':
+                try:
+                    segments = int(arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [num]\nPlease specify value of '{args}'")
+                except ValueError:
+                    error.print(f"Please specify int to value of '{args}'")
+                option.config('segments', segments)
+            elif args == '--stdin':
+                option.config('stdin', True)
+            elif args == '--metrics':
+                try:
+                    option.config('metrics', arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [file path]\nPlease specify value of '{args}'")
+            elif args == '--profile':
+                try:
+                    option.config('profile', arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [file path]\nPlease specify value of '{args}'")
+            elif args == '--parse-workers':
+                try:
+                    parse_workers = int(arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [num]\nPlease specify value of '{args}'")
+                except ValueError:
+                    error.print(f"Please specify int to value of '{args}'")
+                option.config('parse_workers', parse_workers)
+            elif args == '--cprofile':
+                option.config('cprofile', True)
+            elif args == '--tracemalloc':
+                option.config('tracemalloc', True)
+            elif args == '-P' or args == '--parallel':
+                try:
+                    parallel = int(arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [num]\nPlease specify value of '{args}'")
+                except ValueError:
+                    error.print(f"Please specify int to value of '{args}'")
+                option.config('parallel', parallel)
+            elif args == '--max-rate':
+                try:
+                    max_rate = float(arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [requests per second]\nPlease specify value of '{args}'")
+                except ValueError:
+                    error.print(f"Please specify int or float to value of '{args}'")
+                option.config('max_rate', max_rate)
+            elif args == '--retry-budget':
+                try:
+                    budget = int(arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [num]\nPlease specify value of '{args}'")
+                except ValueError:
+                    error.print(f"Please specify int to value of '{args}'")
+                option.config('retry_budget', budget)
+            elif args == '--no-http-cache':
+                option.config('http_cache', False)
+            elif args == '--cache-size':
+                try:
+                    option.config('cache_size', int(arg[n+1]))
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [MB]\nPlease specify value of '{args}'")
+                except ValueError:
+                    error.print(f"Please specify int to value of '{args}'")
             elif args in {'-nc', '-nb', '--no-content', '--no-body', '--update-cache', '-U', '--upgrade'}:
                 continue
             elif args == '-M' or args == '--limit':
@@ -1459,6 +4450,20 @@ prop <options> URL [URL...]
                     error.print(f"Please specify int or float to value of '{args}'")
             elif args == '-m' or args == '--multiprocess':
                 option.config('multiprocess', True)
+            elif args == '-w' or args == '--workers' or args == '--host-workers':
+                try:
+                    workers = int(arg[n+1])
+                    skip += 1
+                except IndexError:
+                    error.print(f"{args} [num]\nPlease specify value of '{args}'")
+                except ValueError:
+                    error.print(f"Please specify int to value of '{args}'")
+                if workers < 1:
+                    error.print(f"Please specify 1 or more to value of '{args}'")
+                option.config('host_workers' if args == '--host-workers' else 'workers', workers)
+                if args != '--host-workers':
+                    # -Rの行はコマンドラインで-wを指定した場合だけ並列に実行する
+                    option.config('batch_workers', workers)
             elif args == '--tor':
                 try:
                     port = int(arg[n+1])
@@ -1471,14 +4476,31 @@ prop <options> URL [URL...]
                 option.config('check_only', True)
                 option.config('filename', os.getcwd())
             elif args == '-p' or args == '--parse':
-                try:
-                    path = arg[n+1]
+                path = arg[n+1] if n+1 < len(arg) else ''
+                if os.path.isfile(path):
                     with open(path, 'r') as f:
                         html = f.read()
                     skip += 1
-                except (IndexError, FileNotFoundError):
-                    html = sys.stdin.read()
-                option.config('parse', html)
+                    option.config('parse', html)
+                elif path and bulk_parse.is_bulk(path):
+                    # ディレクトリやglobはbulk_parseでまとめて解析する
+                    option.config('parse', {'paths': path})
+                    skip += 1
+                else:
+                    # 標準入力は-0, --ndjsonの指定を見てから読む
+                    option.config('parse', {'stdin': True})
+            elif args == '-0' or args == '--null':
+                option.config('delimiter', 'null')
+            elif args == '--ndjson':
+                option.config('delimiter', 'ndjson')
+            elif args == "--benchmark":
+                names: list = []
+                for name in arg[n+1:]:
+                    if name.startswith('-'):
+                        break
+                    names.append(name)
+                    skip += 1
+                option.config('benchmark', names)
             elif args == "--config-file":
                 print(setting.config_file)
                 sys.exit()
@@ -1491,6 +4513,13 @@ prop <options> URL [URL...]
             elif args == "--cache-directory":
                 print(cache.root)
                 sys.exit()
+            elif args == "--cache-stats":
+                if os.path.isdir(cache.root):
+                    for k, v in cache.open(option.options['cache_size']*1048576).stats().items():
+                        print(f'\033[34m{k}\033[0m: {v}')
+                else:
+                    print('No cache')
+                sys.exit()
             elif args == "--purge-log":
                 if os.path.isfile(setting.log_file):
                     os.remove(setting.log_file)
@@ -1516,18 +4545,30 @@ prop <options> URL [URL...]
                 sys.exit()
             else:
                 url.append(args)
-        return url, option.fh.file, option.options
+        if option.options['parse'] == {'stdin': True} and option.options['delimiter'] is None:
+            option.config('parse', sys.stdin.read())
+        return url, option.fh, option.options
+
+def complete_url(link: str) -> str:
+    """
+    "-"なら標準入力から一行読み、スキームがなければhttp://を付ける
+    """
+    if link == '-':
+        return sys.stdin.readline().rstrip()
+    elif not parser.is_url(link):
+        return 'http://' + link
+    return link
 
 def main() -> None:
     url, log_file, option = argument()
     if '--update-cache' in sys.argv:
-        cache.update(option if isinstance(option, dict) else setting.options)
+        cache.update(option)
         sys.exit()
     elif '-U' in sys.argv or '--upgrade' in sys.argv:
-        if _binary:
+        if _is_binary():
             res = requests.get("https://api.github.com/repos/mino-38/prop/releases", timeout=option['timeout'], proxies=option['proxy'], headers=option['header'], verify=option['ssl'])
             new_version = res.json()[0]["tag_name"]
-            if VERSION < parse(new_version):
+            if parse(VERSION) < parse(new_version):
                 with open(os.path.join(tempfile.gettempdir(), "prop-updater.bin"), "wb") as f, open(os.path.join(tempfile.gettempdir(), "prop-updater.sh"), "w") as s:
                     f.write(requests.get("https://github.com/mino-38/prop/releases/latest/download/prop", timeout=option['timeout'], proxies=option['proxy'], headers=option['header'], verify=option['ssl']).content)
                     s.write("""
@@ -1550,38 +4591,56 @@ rm -f %(script)s
             subprocess.run(["pip", "install", "--upgrade", "prop-request"])
         sys.exit()
     for index, link in enumerate(url):
-        if link == '-':
-            link = sys.stdin.readline().rstrip()
-        elif not parser.is_url(link):
-            link = 'http://' + link
-        url[index] = link
+        url[index] = complete_url(link)
+    if (option['cprofile'] or option['tracemalloc']) and not option['profile']:
+        error.print('--cprofile and --tracemalloc are used with --profile [file path]')
+    if option['profile']:
+        profiler.start(option['profile'], option['cprofile'], option['tracemalloc'])
+    dns_cache.install()
     with log_file:
-        if url != [] and not (isinstance(option, dict) and option['parse']):
-            if isinstance(option, list):
-                dl: downloader = downloader(url[0], option[0], option[0]['parser'])
-                dl.start()
-                for u, o in zip(url[1:], option[1:]):
-                    dl.url = u
-                    dl.option = o
-                    dl.parse.option = o
-                    dl.start()
-            else:
+        try:
+            if 'benchmark' in option:
+                benchmark(option, logging.getLogger('Log of Prop').log).run(option['benchmark'])
+            elif 'read_file' in option:
+                if not batch(option, logging.getLogger('Log of Prop').log).run(option['read_file']):
+                    sys.exit(1)
+            elif option['stdin']:
+                if not option['filename'] or option['recursive']:
+                    error.print('--stdin saves the files, so please specify the output directory with -o or use -O (-r cannot be used)')
+                downloader(url, option, option['parser']).start_stdin()
+            elif url != [] and not option['parse']:
                 dl: downloader = downloader(url, option, option['parser'])
                 dl.start()
-        elif option['parse']:
-            dl: downloader = downloader(url, option, option['parser'])
-            if option['only_body']:
-                s = bs(option['parse'], dl.parser)
-                result = s.text
-            else:
-                result = dl.parse.html_extraction(option['parse'], option['search'])
-            if option['filename']:
-                with open(option['filename'], 'w') as f:
-                    f.write(result)
-            else:
-                print(result)
-        elif url == []:
-            error.print('Missing value for URL\nPlease specify URL')
+                if dl.incomplete:
+                    for path in dl.incomplete:
+                        logging.getLogger('Log of Prop').log(40, f"'{path}' is incomplete (run the same command again to resume it)")
+                    sys.exit(1)
+            elif isinstance(option['parse'], dict):
+                bulk_parse(option, logging.getLogger('Log of Prop').log).run(option['parse'])
+            elif option['parse']:
+                dl: downloader = downloader(url, option, option['parser'])
+                if option['only_body']:
+                    s = bs(option['parse'], dl.parser)
+                    result = s.text
+                else:
+                    result = dl.parse.html_extraction(option['parse'], option['search'])
+                if option['filename']:
+                    with open(option['filename'], 'w') as f:
+                        f.write(result)
+                else:
+                    print(result)
+            elif url == []:
+                error.print('Missing value for URL\nPlease specify URL')
+            if option['metrics'] and metrics.open() is not None:
+                metrics.open().save(option['metrics'])
+                logging.getLogger('Log of Prop').log(20, f"saved the metrics of {len(metrics.open().records)} requests in '{option['metrics']}'")
+        finally:
+            history.close_all()
+            dns_cache.uninstall()
+            # sys.exitで終わる場合も計測結果は書き出す
+            if profiler.open() is not None:
+                result = profiler.open().stop()
+                logging.getLogger('Log of Prop').log(20, f"saved the profile of {result['seconds']}s in '{option['profile']}' ("+', '.join(f"{k}: {v['self seconds']}s" for k, v in result['phases'].items())+')')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # ログインするとクッキーが付く
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'session=ok; Path=/')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def do_GET(self):
+        if 'session=ok' not in self.headers.get('Cookie', ''):
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def test_batch():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        with tempfile.TemporaryDirectory() as temp:
+            with open(os.path.join(temp, 'batch.txt'), 'w') as f:
+                f.write(f'{url}/before -o {temp}/before\n')
+                f.write(f'-x post {url}/login -o {temp}/login\n\n')
+                for i in range(20):
+                    f.write(f'{url}/{i} -o {temp}/{i}\n')
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '-w', '4', '-R', os.path.join(temp, 'batch.txt')], stderr=subprocess.PIPE, text=True)
+            # ログイン前の行は失敗して終了ステータスは1になるが、残りの行は実行する
+            assert p.returncode == 1 and f'line 1: {url}/before (403: Forbidden)' in p.stderr and not os.path.exists(os.path.join(temp, 'before'))
+            for i in range(20):
+                with open(os.path.join(temp, str(i))) as f:
+                    assert f.read() == f'/{i}'
+    finally:
+        server.shutdown()
+
+
+class Slow(BaseHTTPRequestHandler):
+    active = 0
+    most = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        # 同時に処理しているリクエストの数を数える
+        with Slow.lock:
+            Slow.active += 1
+            Slow.most = max(Slow.most, Slow.active)
+        time.sleep(0.2)
+        with Slow.lock:
+            Slow.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *_):
+        pass
+
+
+def test_batch_workers():
+    # -wを指定しなければ一行ずつ実行する
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Slow)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        with tempfile.TemporaryDirectory() as temp:
+            with open(os.path.join(temp, 'batch.txt'), 'w') as f:
+                for i in range(6):
+                    f.write(f'{url}/{i} -o {temp}/{i}\n')
+            Slow.most = 0
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '-R', os.path.join(temp, 'batch.txt')])
+            assert p.returncode == 0 and Slow.most == 1
+            Slow.most = 0
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '-w', '3', '-R', os.path.join(temp, 'batch.txt')])
+            assert p.returncode == 0 and 1 < Slow.most <= 3
+    finally:
+        server.shutdown()
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
+
+def test_benchmark():
+    with tempfile.TemporaryDirectory() as temp:
+        output = os.path.join(temp, 'result.json')
+        p = subprocess.run([sys.executable, '-c', RUN, temp, '--benchmark', 'spider', 'local_path_conversion', 'download', 'pages=20', 'files=20', 'large=5', '-o', output])
+        with open(output) as f:
+            result = json.load(f)
+    assert p.returncode == 0 and result['site']['pages'] == 20
+    assert result['results']['spider']['pages'] == 20 and result['results']['download']['4 segments MB/s'] > 0
+    assert all('error' not in r and 'wall seconds' in r for r in result['results'].values())
+
+
+def test_startup():
+    # --versionやimportだけでは重いモジュールを読み込まない
+    code = 'import sys, prop.__main__; print(",".join(m for m in ("requests", "bs4", "tqdm", "fake_useragent", "robotsparsetools", "sqlite3") if m in sys.modules))'
+    p = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True)
+    assert p.returncode == 0 and p.stdout.strip() == ''
+    code = 'import sys, runpy; sys.argv = ["prop", "--version"]\ntry:\n    runpy.run_module("prop", run_name="__main__")\nexcept SystemExit:\n    pass\nprint("requests" in sys.modules, "importlib.metadata" in sys.modules)'
+    p = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True)
+    assert p.stdout.splitlines()[-1] == 'False False'
+
+
+def test_backends():
+    with tempfile.TemporaryDirectory() as temp:
+        output = os.path.join(temp, 'result.json')
+        p = subprocess.run([sys.executable, '-c', RUN, temp, '--benchmark', 'backends', 'pages=20', '-o', output])
+        with open(output) as f:
+            result = json.load(f)['results']['backends']
+    assert p.returncode == 0 and result['pages'] == 20 and result['auto'] in ('lxml', 'html.parser')
+    assert result['html.parser select pages/s'] > 0 and result['stream links pages/s'] > 0 and f"{result['auto']} links pages/s" in result
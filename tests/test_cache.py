@@ -0,0 +1,173 @@
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from prop.__main__ import cache
+
+# キャッシュの置き場所を一時ディレクトリに変えてpropを実行する
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
+
+def store(temp: str, limit: int) -> cache:
+    cache.root = temp
+    cache.configfile = os.path.join(temp, '.cache_info')
+    return cache(limit)
+
+
+def objects(temp: str) -> list:
+    return [file for _, _, files in os.walk(os.path.join(temp, 'objects')) for file in files]
+
+
+def test_dedup():
+    with tempfile.TemporaryDirectory() as temp:
+        c = store(temp, 1024)
+        assert c.put('http://a/1.css', b'body', 'style') == c.put('http://b/2.css', b'body', 'style')
+        assert c.stats()['entries'] == 2 and c.stats()['objects'] == 1 and len(objects(temp)) == 1
+        # 片方のURLを消しても、もう片方が使っている本文は残る
+        c.remove('http://a/1.css', 'style')
+        assert c.entry('http://b/2.css', 'style') is not None and len(objects(temp)) == 1
+        c.remove('http://b/2.css', 'style')
+        assert objects(temp) == [] and c.stats()['size'] == 0
+
+
+def test_lru():
+    with tempfile.TemporaryDirectory() as temp:
+        c = store(temp, 30)
+        for name in 'abc':
+            c.put(f'http://x/{name}', name.encode()*10, 'http')
+            time.sleep(0.01)
+        # aを使ったので、dを入れると最後に使われたのが一番古いbが消える
+        assert c.entry('http://x/a', 'http') is not None
+        time.sleep(0.01)
+        c.put('http://x/d', b'd'*10, 'http')
+        assert [c.entry(f'http://x/{name}', 'http') is not None for name in 'abcd'] == [True, False, True, True]
+        assert c.stats()['size'] == 30 and len(objects(temp)) == 3
+
+
+def test_too_large():
+    with tempfile.TemporaryDirectory() as temp:
+        c = store(temp, 10)
+        assert c.put('http://x/a', b'a'*5, 'style') is not None
+        # 上限より大きい本文は保存せず、古いキャッシュも使わない
+        assert c.put('http://x/a', b'a'*11, 'style') is None
+        assert c.entry('http://x/a', 'style') is None and objects(temp) == []
+        spool = os.path.join(temp, 'spool')
+        with open(spool, 'wb') as f:
+            f.write(b'b'*11)
+        assert c.put_file('http://x/b', spool, 'http') is None and not os.path.exists(spool) and c.stats()['entries'] == 0
+
+
+def test_legacy_import():
+    with tempfile.TemporaryDirectory() as temp:
+        os.makedirs(os.path.join(temp, 'example.com'))
+        path = os.path.join(temp, 'example.com', 'style.css')
+        with open(path, 'w') as f:
+            f.write('body {}')
+        with open(os.path.join(temp, '.cache_info'), 'w') as f:
+            json.dump({'https://example.com/style.css': path}, f)
+        c = store(temp, 1024)
+        with open(c.get_cache('https://example.com/style.css')) as f:
+            assert f.read() == 'body {}'
+        assert not os.path.exists(os.path.join(temp, '.cache_info')) and not os.path.exists(os.path.join(temp, 'example.com'))
+
+
+def test_update_no_cache():
+    # キャッシュがなければ何も表示しない
+    with tempfile.TemporaryDirectory() as temp:
+        p = subprocess.run([sys.executable, '-c', RUN, temp, '--update-cache'], cwd=temp, stdout=subprocess.PIPE, text=True)
+    assert p.returncode == 0 and p.stdout == ''
+
+
+def test_cache_stats():
+    with tempfile.TemporaryDirectory() as temp:
+        c = store(temp, 1024)
+        c.put('http://x/a', b'abc', 'style')
+        c.get_cache('http://x/a')
+        c.get_cache('http://x/b')
+        c._db.close()
+        p = subprocess.run([sys.executable, '-c', RUN, temp, '--cache-stats'], stdout=subprocess.PIPE, text=True)
+    stats = dict(line.replace('\033[34m', '').replace('\033[0m', '').split(': ') for line in p.stdout.splitlines())
+    assert p.returncode == 0 and stats['entries'] == '1' and stats['hits'] == '1' and stats['misses'] == '1' and stats['bytes saved'] == '3'
+
+
+class Handler(BaseHTTPRequestHandler):
+    conditional: list = []
+
+    def do_GET(self):
+        Handler.conditional.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        body = b'<p>cached</p>'
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def test_http_cache():
+    Handler.conditional = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/page.html'
+    try:
+        with tempfile.TemporaryDirectory() as temp:
+            # -pだけでは索引を作らない
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '-p', '-s', 'tags=p'], input='<p>x</p>', stdout=subprocess.PIPE, text=True)
+            assert p.returncode == 0 and not os.path.exists(os.path.join(temp, 'index.sqlite3'))
+            # -oで保存する本文はキャッシュしない
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '-o', os.path.join(temp, 'page.html'), url])
+            assert p.returncode == 0 and objects(temp) == []
+            outputs = [subprocess.run([sys.executable, '-c', RUN, temp, url], stdout=subprocess.PIPE, text=True).stdout for _ in range(2)]
+    finally:
+        server.shutdown()
+    assert outputs == ['<p>cached</p>', '<p>cached</p>']
+    # 二回目は検証子を付けて送り、304なら保存した本文を使う
+    assert Handler.conditional == [None, None, '"v1"']
+
+
+class SiteHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+
+def test_update_cache():
+    with tempfile.TemporaryDirectory() as site, tempfile.TemporaryDirectory() as temp:
+        for name, body in {'index.html': '<link rel="stylesheet" href="a.css"><link rel="stylesheet" href="b.css">', 'a.css': 'a {}', 'b.css': 'b {}'}.items():
+            with open(os.path.join(site, name), 'w') as f:
+                f.write(body)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(SiteHandler, directory=site))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        output = os.path.join(temp, 'output')
+        try:
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '-o', output, '-r', '1', '-I', '0', f'http://127.0.0.1:{server.server_port}/index.html'])
+            assert p.returncode == 0 and sorted(os.listdir(os.path.join(output, 'styles'))) == ['.prop_info.json', 'a.css', 'b.css']
+            # b.cssだけを変更する
+            with open(os.path.join(site, 'b.css'), 'w') as f:
+                f.write('b { color: red }')
+            os.utime(os.path.join(site, 'b.css'), (time.time()+10, time.time()+10))
+            os.utime(os.path.join(output, 'styles', 'a.css'), (0, 0))
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '--update-cache'], cwd=output, stdout=subprocess.PIPE, text=True)
+        finally:
+            server.shutdown()
+        assert p.returncode == 0 and p.stdout.splitlines()[-1] == 'unchanged: 1, updated: 1, failed: 0'
+        # 確認しただけではヒットに数えない
+        stats = subprocess.run([sys.executable, '-c', RUN, temp, '--cache-stats'], stdout=subprocess.PIPE, text=True).stdout
+        assert 'hits: 0' in stats.replace('\033[34m', '').replace('\033[0m', '')
+        # 変わっていないstylesheetは書き直さない
+        assert os.path.getmtime(os.path.join(output, 'styles', 'a.css')) == 0
+        with open(os.path.join(output, 'styles', 'b.css')) as f:
+            assert f.read() == 'b { color: red }'
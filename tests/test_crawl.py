@@ -0,0 +1,216 @@
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import prop.__main__ as m
+
+PAGES = {
+    'index.html': '<a href="1.html">1</a><a href="2.html">2</a><a href="3.html">3</a><img src="a.png">',
+    '1.html': '<a href="4.html">4</a>',
+    '2.html': '<p>2</p>',
+    '3.html': '<p>3</p>',
+    '4.html': '<p>4</p>',
+}
+
+
+class Handler(SimpleHTTPRequestHandler):
+    throttled: set = set()
+    charset: str = ''
+    received: list = [] # (時刻, パス)
+
+    def do_GET(self):
+        Handler.received.append((time.time(), self.path))
+        # 初回だけ429を返すページ
+        if self.path in self.throttled:
+            self.throttled.discard(self.path)
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+    def guess_type(self, path):
+        # charsetを指定する場合はContent-Typeに付ける
+        content_type = super().guess_type(path)
+        return f'{content_type}; charset={self.charset}' if self.charset and content_type == 'text/html' else content_type
+
+    def log_message(self, *_):
+        pass
+
+
+# キャッシュ, 履歴, ログを一時ディレクトリに置き、parserを指定すれば設定ファイルの代わりに使ってpropを実行する
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); m.setting._config = {"parser": sys.argv[2]} if sys.argv[2] else None; sys.argv = ["prop", *sys.argv[3:]]; m.main()'
+
+
+@contextlib.contextmanager
+def serve(pages: dict=PAGES):
+    """
+    pagesを置いたローカルサーバーを立て、index.htmlのURLを返す
+    """
+    with tempfile.TemporaryDirectory() as site:
+        for name, body in pages.items():
+            os.makedirs(os.path.dirname(os.path.join(site, name)), exist_ok=True)
+            with open(os.path.join(site, name), 'w', encoding=Handler.charset or 'utf-8') as f:
+                f.write(body)
+        with open(os.path.join(site, 'a.png'), 'wb') as f:
+            f.write(b'\x89PNG')
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=site))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            yield f'http://127.0.0.1:{server.server_port}/index.html'
+        finally:
+            server.shutdown()
+
+
+def crawl(*args, pages: dict=PAGES, read: str=None, backend: str=''):
+    with serve(pages) as url, tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as temp:
+        p = subprocess.run([sys.executable, '-c', RUN, data, backend, '-o', temp, '-r', '2', *args, url])
+        if read is None:
+            return p.returncode, sorted(os.listdir(temp))
+        # 保存したファイルの中身も返す
+        with open(os.path.join(temp, read)) as f:
+            return p.returncode, sorted(os.listdir(temp)), f.read()
+
+
+def test_crawl():
+    assert crawl('-I', '0', '-w', '4', '--host-workers', '4') == (0, ['1.html', '2.html', '3.html', '4.html', 'a.png', 'index.html', 'styles'])
+
+
+def test_parse_workers():
+    # 解析を子プロセスで行っても結果は同じ
+    assert crawl('-I', '0', '--parse-workers', '2') == (0, ['1.html', '2.html', '3.html', '4.html', 'a.png', 'index.html', 'styles'])
+
+
+def test_multiprocess_conversion():
+    # -mでは子プロセスでパスを変換する
+    assert crawl('-I', '0', '-m') == (0, ['1.html', '2.html', '3.html', '4.html', 'a.png', 'index.html', 'styles'])
+
+
+def test_link_filter():
+    # robots.txtは相対パスのリンクにも効き、別の書き方で参照した取得済みのページは同じファイルに変換する
+    pages = dict(PAGES, **{'index.html': '<a href="1.html">1</a><a href="sub/a.html">a</a><a href="secret.html">s</a><a href="2.html#top">2</a>', 'sub/a.html': '<a href="../1.html">1</a><a href="../index.html">i</a>', 'secret.html': '<p>s</p>', 'robots.txt': 'User-agent: *\nDisallow: /secret.html\n'})
+    assert crawl('-I', '0', pages=pages, read='a.html') == (0, ['1.html', '4.html', 'a.html', 'index.html', 'styles'], '<a href="1.html">1</a><a href="index.html">i</a>')
+    # -nは指定した文字列を含むURLだけを取得する
+    assert crawl('-I', '0', '-n', '3.html') == (0, ['3.html', 'index.html', 'styles'])
+
+
+def test_stream():
+    # streamでもBeautifulSoupと同じページを取得して同じように変換する(コメントの中のリンクは無視し、scriptの中は同じく拾う)
+    pages = dict(PAGES, **{'index.html': '<LINK REL="stylesheet" href="s.css"><link rel="Stylesheet" href="t.css"><A HREF=\'1.html\'>1</A><a href="2.html">2</a><img data-src="a.png"><!-- <a href="3.html"> --><script>"<a href=4.html>"</script>', 's.css': 'p {}', 't.css': 'a {}'})
+    expected = (0, ['1.html', '2.html', '4.html', 'a.png', 'index.html', 'styles'], '<LINK REL="stylesheet" href="styles/s.css"><link rel="Stylesheet" href="t.css"><A HREF=\'1.html\'>1</A><a href="2.html">2</a><img data-src="a.png"><!-- <a href="3.html"> --><script>"<a href=4.html>"</script>')
+    for backend in ('stream', 'html.parser', 'auto'):
+        assert crawl('-I', '0', pages=pages, read='index.html', backend=backend) == expected, backend
+
+
+def test_conversion():
+    # 引用符の有無や文字参照に関係なく属性値全体が一致するものだけを保存先に変換し、本文や他の値の一部は変えない
+    pages = dict(PAGES, **{'index.html': '<a href=sub/a.html>a</a><a href = \'sub/a.html\'>a</a><a href="sub/b.html?x=1&amp;y=2">b</a><p title="see sub/a.html">sub/a.html</p>', 'sub/a.html': '<p>a</p>', 'sub/b.html': '<p>b</p>'})
+    assert crawl('-I', '0', pages=pages, read='index.html') == (0, ['a.html', 'b.html', 'index.html', 'styles'], '<a href=a.html>a</a><a href = \'a.html\'>a</a><a href="b.html">b</a><p title="see sub/a.html">sub/a.html</p>')
+
+
+def test_spill():
+    # -Cでは保存しないページを一時ディレクトリに書き出して次の階層を読み、終われば消す
+    with serve() as url, tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as spool, tempfile.TemporaryDirectory() as temp:
+        p = subprocess.run([sys.executable, '-c', RUN, data, '', '-o', temp, '-r', '2', '-I', '0', '-C', url], stdout=subprocess.PIPE, text=True, env=dict(os.environ, TMPDIR=spool))
+        assert p.returncode == 0 and os.listdir(temp) == [] and os.listdir(spool) == []
+    # 2階層目の4.htmlは書き出した1.htmlから見つかる
+    assert sorted(line.split()[0].rsplit('/', 1)[-1] for line in p.stdout.splitlines() if 'Exists' in line) == ['1.html', '2.html', '3.html', '4.html', 'a.png']
+
+
+def test_charset():
+    # 文字コードの宣言がない文書もContent-Typeのcharsetで読む
+    pages = dict(PAGES, **{'1.html': '<p>ページ</p><a href="ページ.html">ページ</a>', 'ページ.html': '<p>4</p>'})
+    del pages['4.html']
+    Handler.charset = 'Shift_JIS'
+    try:
+        code, files = crawl('-I', '0', pages=pages)
+    finally:
+        Handler.charset = ''
+    assert code == 0 and 'ページ.html' in files
+    # どのパーサーでも同じリンクになる
+    check = 'import prop.__main__ as m; print(all(m.parser_backend(name).links(\'<a href="ページ.html">ページ</a>\'.encode("shift_jis"), "shift_jis")["a"] == ["ページ.html"] for name in m.parser_backend.available()))'
+    assert subprocess.run([sys.executable, '-c', check], capture_output=True, text=True).stdout.strip() == 'True'
+
+
+def limiter(**option) -> tuple:
+    """
+    実際には待たず、待つように言われた時間を記録して時計を進めるrate_limiterを作る
+    """
+    now = [1000.0]
+    waits: list = []
+
+    def sleep(seconds: float):
+        waits.append(seconds)
+        now[0] += seconds
+
+    return m.rate_limiter(dict({'interval': 0, 'max_rate': None, 'host_workers': 1}, **option), clock=lambda: now[0], sleep=sleep), waits, now
+
+
+def test_rate_limiter():
+    # 上限がなければ待たず、--max-rateがあればその間隔で待つ
+    limit, waits, _ = limiter()
+    limit.acquire('a.test')
+    limit.acquire('a.test')
+    assert waits == []
+    limit, waits, _ = limiter(max_rate=2)
+    for _ in range(3):
+        limit.acquire('a.test')
+    assert waits == [0.5, 0.5]
+
+
+def test_rate_limiter_retry_after():
+    # 429のRetry-Afterの間はそのホストにだけ送らない
+    limit, waits, now = limiter()
+    limit.feedback('a.test', 429, '2')
+    limit.acquire('b.test')
+    assert waits == []
+    limit.acquire('a.test')
+    assert waits == [2]
+    # 日付で指定されたRetry-Afterは時計からの残り時間にする
+    limit, waits, now = limiter()
+    now[0] = 1445412480.0 - 3
+    limit.feedback('a.test', 503, 'Wed, 21 Oct 2015 07:28:00 GMT')
+    limit.acquire('a.test')
+    assert waits == [3]
+
+
+def test_throttle():
+    Handler.throttled = {'/2.html', '/a.png'}
+    assert crawl('-I', '0', '-w', '4', '--host-workers', '4', '--max-rate', '20') == (0, ['1.html', '2.html', '3.html', '4.html', 'a.png', 'index.html', 'styles'])
+    # 429が返ってきたページも送り直して取得する
+    assert not Handler.throttled
+
+
+def test_retry_after():
+    # 送り直さない場合は429のページを一度だけ要求し、残りのページは取得を続ける
+    Handler.throttled = {'/2.html'}
+    Handler.received = []
+    assert crawl('-I', '0', '-w', '1', '--host-workers', '1', '--retry-budget', '0') == (0, ['1.html', '3.html', '4.html', 'a.png', 'index.html', 'styles'])
+    paths = [path for _, path in Handler.received]
+    assert paths.count('/2.html') == 1 and paths.index('/2.html') < len(paths) - 1
+
+
+def test_metrics():
+    with tempfile.TemporaryDirectory() as temp:
+        assert crawl('-I', '0', '--no-http-cache', '--metrics', os.path.join(temp, 'metrics.json'))[0] == 0
+        with open(os.path.join(temp, 'metrics.json')) as f:
+            summary = json.load(f)
+    assert summary['requests'] == 6 and not summary['errors'] and summary['bytes'] > 0
+    assert set(summary['phases']) == {'dns', 'connect', 'ttfb', 'transfer', 'total'} and len(summary['slowest']) == 6
+
+
+def test_profile():
+    with tempfile.TemporaryDirectory() as temp:
+        assert crawl('-I', '0', '--profile', os.path.join(temp, 'profile.json'), '--cprofile', '--tracemalloc')[0] == 0
+        with open(os.path.join(temp, 'profile.json')) as f:
+            result = json.load(f)
+        assert {'network', 'parse', 'save', 'info', 'conversion'} <= set(result['phases']) and result['top allocations']
+        assert result['phases']['parse']['calls'] == 4 and os.path.isfile(os.path.join(temp, 'profile.pstats'))
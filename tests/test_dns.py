@@ -0,0 +1,64 @@
+import socket
+import subprocess
+import sys
+import tempfile
+from socket import gaierror
+
+import prop.__main__ as m
+
+
+def resolver(monkeypatch) -> tuple:
+    """
+    問い合わせた回数を数える名前解決と、進め方を変えられる時計でdns_cacheを作る
+    """
+    calls: list = []
+    now = [1000.0]
+
+    def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+        calls.append(host)
+        if host == 'missing.invalid':
+            raise gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', 0))]
+
+    monkeypatch.setattr(m.dns_cache, '_getaddrinfo', staticmethod(getaddrinfo))
+    monkeypatch.setattr(m, 'time', lambda: now[0])
+    return m.dns_cache(workers=1), calls, now
+
+
+def test_ttl(monkeypatch):
+    store, calls, now = resolver(monkeypatch)
+    assert store.getaddrinfo('example.com', 80)[0][4] == ('192.0.2.1', 80)
+    now[0] += store.ttl - 1
+    store.resolve('example.com')
+    assert calls == ['example.com']
+    # 期限が切れたら問い合わせ直す
+    now[0] += 2
+    store.resolve('example.com')
+    assert calls == ['example.com', 'example.com']
+    store.executor.shutdown()
+
+
+def test_negative(monkeypatch):
+    store, calls, now = resolver(monkeypatch)
+    for _ in range(2):
+        try:
+            store.resolve('missing.invalid')
+            assert False
+        except gaierror as e:
+            assert e.args[0] == socket.EAI_NONAME
+    assert calls == ['missing.invalid']
+    now[0] += store.negative_ttl + 1
+    try:
+        store.resolve('missing.invalid')
+    except gaierror:
+        pass
+    assert calls == ['missing.invalid', 'missing.invalid']
+    store.executor.shutdown()
+
+
+def test_uninstall():
+    # mainが終わればsocket.getaddrinfoは元に戻る
+    check = 'import os, socket, sys, prop.__main__ as m; m.setting.log_file = os.path.join(sys.argv[1], "log.log"); original = socket.getaddrinfo; sys.argv = ["prop", "-p", "<p>a</p>"]; m.main(); print(socket.getaddrinfo is original, m.dns_cache._store)'
+    with tempfile.TemporaryDirectory() as temp:
+        p = subprocess.run([sys.executable, '-c', check, temp], stdout=subprocess.PIPE, text=True)
+    assert p.returncode == 0 and p.stdout.strip().endswith('True None')
@@ -0,0 +1,49 @@
+import functools
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# 履歴とキャッシュの置き場所を一時ディレクトリに変えてpropを実行する
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main(); print(m.history._stores)'
+
+
+class Handler(SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+
+def test_migrate():
+    with tempfile.TemporaryDirectory() as site, tempfile.TemporaryDirectory() as temp:
+        for name, body in {'index.html': '<a href="1.html">1</a><a href="2.html">2</a>', '1.html': '<p>1</p>', '2.html': '<p>2</p>'}.items():
+            with open(os.path.join(site, name), 'w') as f:
+                f.write(body)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=site))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        root = f'http://127.0.0.1:{server.server_port}/'
+        # 以前のテキスト形式の履歴
+        with open(os.path.join(temp, '127.0.0.1.txt'), 'w') as f:
+            f.write(root+'1.html\n')
+        output = os.path.join(temp, 'output')
+        try:
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '-o', output, '-r', '1', '-I', '0', '-nd', root+'index.html'], stdout=subprocess.PIPE, text=True)
+        finally:
+            server.shutdown()
+        # 履歴にあるページは取得せず、終了時には接続を閉じている
+        assert p.returncode == 0 and p.stdout.strip() == '{}'
+        assert sorted(os.listdir(output)) == ['2.html', 'index.html', 'styles']
+        assert not os.path.exists(os.path.join(temp, '127.0.0.1.txt'))
+        db = sqlite3.connect(os.path.join(temp, '127.0.0.1.sqlite3'))
+        urls = {url for url, in db.execute('SELECT url FROM history')}
+        db.close()
+    assert {root+'1.html', root+'2.html'} <= urls
+
+
+def test_shared_connection():
+    with tempfile.TemporaryDirectory() as temp:
+        check = 'import sys, prop.__main__ as m; m.history.root = sys.argv[1]; a = m.history.open("http://127.0.0.1/a"); print(a is m.history.open("http://127.0.0.1/b"), a is m.history.open("http://localhost/")); m.history.close_all(); print(m.history._stores)'
+        p = subprocess.run([sys.executable, '-c', check, temp], stdout=subprocess.PIPE, text=True)
+    assert p.stdout.split('\n')[:2] == ['True False', '{}']
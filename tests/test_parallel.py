@@ -0,0 +1,52 @@
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
+
+class Handler(SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+
+def test_parallel():
+    with tempfile.TemporaryDirectory() as site, tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as temp:
+        for i in range(10):
+            with open(os.path.join(site, f'{i}.bin'), 'wb') as f:
+                f.write(os.urandom(1024*i))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=site))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}'
+        try:
+            p = subprocess.run([sys.executable, '-c', RUN, data, '-P', '4', '-o', temp, *[f'{url}/{i}.bin' for i in range(10)], f'{url}/missing.bin'], stderr=subprocess.PIPE, text=True)
+        finally:
+            server.shutdown()
+        assert p.returncode == 0 and f'failed: {url}/missing.bin (404: Not Found)' in p.stderr
+        for i in range(10):
+            with open(os.path.join(site, f'{i}.bin'), 'rb') as f, open(os.path.join(temp, f'{i}.bin'), 'rb') as g:
+                assert f.read() == g.read()
+
+
+def test_stdin():
+    with tempfile.TemporaryDirectory() as site, tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as temp:
+        for i in range(5):
+            with open(os.path.join(site, f'{i}.txt'), 'w') as f:
+                f.write(str(i))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=site))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}'
+        try:
+            p = subprocess.run([sys.executable, '-c', RUN, data, '--stdin', '-P', '2', '-o', temp], input=''.join(f'{url}/{i}.txt\n' for i in range(6)), stdout=subprocess.PIPE, text=True)
+        finally:
+            server.shutdown()
+        records = {r['url']: r for r in map(json.loads, p.stdout.splitlines())}
+        assert p.returncode == 0 and len(records) == 6
+        assert records[f'{url}/5.txt']['ok'] is False and records[f'{url}/5.txt']['status'] == 404
+        for i in range(5):
+            assert records[f'{url}/{i}.txt']['ok'] and records[f'{url}/{i}.txt']['size'] == 1
@@ -1,11 +1,50 @@
+import json
+import os
 import subprocess
+import sys
 import tempfile
 
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
 def test_parse():
     answer = '<a href="./test1">test</a>\n\n<img src="./test2"/>'
     code = answer+'\n<p>test</p>'
-    with tempfile.NamedTemporaryFile(suffix='.html', mode='w+') as f:
+    with tempfile.NamedTemporaryFile(suffix='.html', mode='w+') as f, tempfile.TemporaryDirectory() as data:
         f.write(code)
         f.flush()
-        p = subprocess.run(['prop', '-p', f.name, '-s', 'tags=a,img'], stdout=subprocess.PIPE)
+        p = subprocess.run([sys.executable, '-c', RUN, data, '-p', f.name, '-s', 'tags=a,img'], stdout=subprocess.PIPE)
     assert p.returncode == 0 and p.stdout.decode().strip() == answer
+
+
+def test_parse_format():
+    # -pの結果はBeautifulSoupで整形する
+    with tempfile.NamedTemporaryFile(suffix='.html', mode='w+') as f, tempfile.TemporaryDirectory() as data:
+        f.write("<A HREF='x'>Q</A><img src=b.png><p>a<br>b</p>")
+        f.flush()
+        p = subprocess.run([sys.executable, '-c', RUN, data, '-p', f.name, '-s', 'tags=a,img,p'], stdout=subprocess.PIPE, text=True)
+    assert p.returncode == 0 and p.stdout.strip() == '<a href="x">Q</a>\n\n<img src="b.png"/>\n\n<p>a<br/>b</p>'
+
+
+def test_bulk_parse():
+    with tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as temp:
+        os.makedirs(os.path.join(temp, 'sub'))
+        for i in range(40):
+            with open(os.path.join(temp, 'sub' if i % 2 else '', f'{i}.html'), 'w') as f:
+                f.write(f'<p>{i}</p><a href="{i}">{i}</a>')
+        with open(os.path.join(temp, 'note.txt'), 'w') as f:
+            f.write('<a href="x">x</a>')
+        for target in (temp, os.path.join(temp, '**', '*.html')):
+            p = subprocess.run([sys.executable, '-c', RUN, data, '-p', target, '-s', 'tags=a', '--parse-workers', '2'], stdout=subprocess.PIPE, text=True)
+            records = {r['source']: r['result'] for r in map(json.loads, p.stdout.splitlines())}
+            assert p.returncode == 0 and len(records) == 40
+            for i in range(40):
+                assert records[os.path.join(temp, 'sub' if i % 2 else '', f'{i}.html')] == [f'<a href="{i}">{i}</a>']
+
+
+def test_bulk_stdin():
+    with tempfile.TemporaryDirectory() as data:
+        p = subprocess.run([sys.executable, '-c', RUN, data, '-p', '-0', '-s', 'tags=a'], input='<a href="0">0</a>\0\0<a href="1">1</a>', stdout=subprocess.PIPE, text=True)
+        assert p.returncode == 0 and [json.loads(line) for line in p.stdout.splitlines()] == [{'source': '<stdin>:0', 'result': ['<a href="0">0</a>']}, {'source': '<stdin>:1', 'result': ['<a href="1">1</a>']}]
+        p = subprocess.run([sys.executable, '-c', RUN, data, '-p', '--ndjson', '-Y'], input='{"source": "a.html", "html": "<p>a</p>"}\n"<p>b</p>"\nbroken\n', stdout=subprocess.PIPE, text=True)
+    records = [json.loads(line) for line in p.stdout.splitlines()]
+    assert p.returncode == 0 and records[:2] == [{'source': 'a.html', 'result': 'a'}, {'source': '<stdin>:1', 'result': 'b'}] and 'error' in records[2]
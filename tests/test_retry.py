@@ -0,0 +1,66 @@
+import contextlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import prop.__main__ as m
+
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests: list = []
+
+    def do_GET(self):
+        # 常に503を返すページ
+        Handler.requests.append(self.path)
+        self.send_response(503)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *_):
+        pass
+
+
+@contextlib.contextmanager
+def serve():
+    Handler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+
+
+def run(*args):
+    with serve() as url, tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as temp:
+        p = subprocess.run([sys.executable, '-c', RUN, data, '--no-http-cache', *args, '-o', temp, *[f'{url}/{i}' for i in range(2)]], stderr=subprocess.PIPE, text=True)
+    return p, sorted(Handler.requests)
+
+
+def test_retry():
+    # 一つ目のURLで再試行の回数(reconnect=5)より先にbudgetを使い切り、二つ目のURLは送り直さない
+    p, requests = run('--retry-budget', '2')
+    assert requests == ['/0', '/0', '/0', '/1']
+    assert p.stderr.count('retrying') == 2
+
+
+def test_no_retry():
+    p, requests = run('--retry-budget', '0')
+    assert requests == ['/0', '/1'] and 'retrying' not in p.stderr
+
+
+def test_exhausted():
+    # budgetを使い切ったら送り直さず、503のレスポンスをRetry-Afterごとそのまま返す(フックにも渡る)
+    session = m.requests.Session()
+    m.retry_policy.mount(session, {'reconnect': 5, 'workers': 1, 'host_workers': 1, 'segments': 1, 'parallel': 1}, m.retry_budget(0))
+    seen: list = []
+    session.hooks['response'].append(lambda response, *args, **kwargs: seen.append(response.status_code))
+    with serve() as url:
+        response = session.get(f'{url}/0')
+    assert (response.status_code, response.headers['Retry-After'], seen, Handler.requests) == (503, '1', [503], ['/0'])
@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
+
+class Handler(BaseHTTPRequestHandler):
+    sent = 0
+
+    def do_GET(self):
+        # 終わらないページ
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write('<html><body><p class="x">最初</p>'.encode())
+        try:
+            for i in range(100000):
+                self.wfile.write(f'<div class="item"><a href="{i}.html">{i}</a><p>{"lorem " * 50}</p></div>'.encode())
+                Handler.sent = i
+        except OSError:
+            pass
+
+    def log_message(self, *_):
+        pass
+
+
+class Page(BaseHTTPRequestHandler):
+    body = "<A HREF='x'>Q</A><img src=b.png><ul><li>a<li>b</ul>"
+
+    def do_GET(self):
+        body = self.body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def test_search():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+    try:
+        with tempfile.TemporaryDirectory() as data:
+            p = subprocess.run([sys.executable, '-c', RUN, data, '-s', 'tags=a', 'limit=3', url], stdout=subprocess.PIPE, text=True, timeout=30)
+            assert p.returncode == 0 and p.stdout == '<a href="0.html">0</a>\n\n<a href="1.html">1</a>\n\n<a href="2.html">2</a>\n'
+            assert Handler.sent < 50000
+            p = subprocess.run([sys.executable, '-c', RUN, data, '-s', 'class=x', 'limit=1', url], stdout=subprocess.PIPE, text=True, timeout=30)
+            assert p.stdout == '<p class="x">最初</p>\n'
+    finally:
+        server.shutdown()
+
+
+def test_search_source():
+    # ダウンロードしながら探しても、-pで読み込んだ文書から探しても、同じ条件で同じ形式の要素を出力する(textは要素のテキスト)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Page)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory() as data:
+            page = os.path.join(data, 'page.html')
+            with open(page, 'w') as f:
+                f.write(Page.body)
+            for words, expected in ((['tags=a,img,li'], '<a href="x">Q</a>\n\n<img src="b.png"/>\n\n<li>a<li>b</li></li>\n\n<li>b</li>\n'), (['text=b'], '<li>b</li>\n')):
+                streamed = subprocess.run([sys.executable, '-c', RUN, data, '--no-http-cache', '-s', *words, f'http://127.0.0.1:{server.server_port}/'], stdout=subprocess.PIPE, text=True, timeout=30)
+                parsed = subprocess.run([sys.executable, '-c', RUN, data, '-p', page, '-s', *words], stdout=subprocess.PIPE, text=True, timeout=30)
+                assert streamed.returncode == parsed.returncode == 0 and streamed.stdout == parsed.stdout == expected, words
+    finally:
+        server.shutdown()
@@ -0,0 +1,97 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RUN = 'import os, sys, prop.__main__ as m; m.cache.root = m.history.root = sys.argv[1]; m.cache.configfile = os.path.join(sys.argv[1], ".cache_info"); m.setting.log_file = os.path.join(sys.argv[1], "log.log"); sys.argv = ["prop", *sys.argv[2:]]; m.main()'
+
+BODY = os.urandom(5*1048576)
+
+
+class Handler(BaseHTTPRequestHandler):
+    served = 0
+    truncate: set = set() # 本文の途中で切る区間の末尾
+    always = False # 送り直しても切る
+
+    def do_GET(self):
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(BODY)}')
+        else:
+            start, end = 0, len(BODY)-1
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"body"')
+        self.send_header('Content-Length', str(end-start+1))
+        self.end_headers()
+        if match and end in Handler.truncate:
+            if not Handler.always:
+                Handler.truncate.discard(end)
+            self.wfile.write(BODY[start:start+(end-start+1)//2])
+            self.close_connection = True
+            return
+        if match:
+            Handler.served += end-start+1
+        self.wfile.write(BODY[start:end+1])
+
+    def log_message(self, *_):
+        pass
+
+
+def test_segments():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/big.bin'
+    try:
+        with tempfile.TemporaryDirectory() as temp:
+            path = os.path.join(temp, 'big.bin')
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '--no-http-cache', '-G', '4', '-o', path, url])
+            with open(path, 'rb') as f:
+                assert p.returncode == 0 and f.read() == BODY and Handler.served == len(BODY)
+            # 最後の区間だけ残っている状態から再開する
+            size = len(BODY) // 4
+            with open(path, 'r+b') as f:
+                f.seek(size*3)
+                f.write(b'\0'*(len(BODY)-size*3))
+            with open(path+'.prop-part', 'w') as f:
+                json.dump({'url': url, 'length': len(BODY), 'validator': '"body"', 'segments': [[i*size, min((i+1)*size, len(BODY))-1, size if i < 3 else 0] for i in range(4)]}, f)
+            Handler.served = 0
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '--no-http-cache', '-G', '4', '-o', path, url])
+            with open(path, 'rb') as f:
+                assert p.returncode == 0 and f.read() == BODY and Handler.served == len(BODY)-size*3
+            assert not os.path.exists(path+'.prop-part')
+    finally:
+        server.shutdown()
+
+
+def test_truncated_segment():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/big.bin'
+    size = len(BODY) // 4
+    try:
+        with tempfile.TemporaryDirectory() as temp:
+            path = os.path.join(temp, 'big.bin')
+            # 二つ目の区間が一度だけ途中で切れても、残りを取り直して完成させる
+            Handler.truncate, Handler.always = {size*2-1}, False
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '--no-http-cache', '-G', '4', '-o', path, url], stderr=subprocess.PIPE, text=True)
+            with open(path, 'rb') as f:
+                assert p.returncode == 0 and f.read() == BODY and 'retrying the range' in p.stderr
+            assert not os.path.exists(path+'.prop-part')
+            # 取り直せない場合は失敗で終わり、続きから再開できるように記録を残す
+            Handler.truncate, Handler.always = {size*2-1}, True
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '--no-http-cache', '--retry-budget', '1', '-G', '4', '-o', path, url], stderr=subprocess.PIPE, text=True)
+            assert p.returncode != 0 and 'is incomplete' in p.stderr and os.path.exists(path+'.prop-part')
+            Handler.truncate = set()
+            p = subprocess.run([sys.executable, '-c', RUN, temp, '--no-http-cache', '-G', '4', '-o', path, url])
+            with open(path, 'rb') as f:
+                assert p.returncode == 0 and f.read() == BODY
+            assert not os.path.exists(path+'.prop-part')
+    finally:
+        server.shutdown()